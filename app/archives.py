@@ -0,0 +1,104 @@
+import os
+import tarfile
+import zipfile
+import zlib
+from typing import BinaryIO, Iterator, Optional, Tuple, Union
+
+from app.uploads import reject, too_large
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp", ".bmp")
+
+ARCHIVE_CONTENT_TYPES = (
+    "application/zip",
+    "application/x-zip-compressed",
+    "application/x-tar",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-gtar",
+)
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+# raised reading a corrupt member: bad CRC or headers, truncated or corrupt compressed
+# data, or (for zip) an unsupported compression method or encryption
+_ZIP_MEMBER_ERRORS = (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError, RuntimeError)
+_TAR_ERRORS = (tarfile.TarError, zlib.error, EOFError, OSError)
+
+
+def is_archive(filename: Optional[str], content_type: Optional[str]) -> bool:
+    """Whether an uploaded file is a zip or tar archive of images."""
+    if content_type in ARCHIVE_CONTENT_TYPES:
+        return True
+    return bool(filename) and filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def _is_image_member(name: str) -> bool:
+    basename = os.path.basename(name)
+    # skip hidden files and macOS resource forks
+    if basename.startswith(".") or "__MACOSX" in name:
+        return False
+    return basename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def iter_archive_images(fileobj: BinaryIO, max_bytes: Optional[int] = None) -> Iterator[Tuple[str, Union[bytes, Exception]]]:
+    """
+    Read the images in a zip or tar (optionally compressed) archive one at a time.
+
+    Args:
+        max_bytes: members larger than this are not read, and are yielded with an
+            `UploadRejected` error in place of their bytes.
+
+    Yields:
+        tuple: member name and image bytes, for each member with an image file extension,
+            or an `UploadRejected` error in place of the bytes of a member that is too
+            large or cannot be read. A tar archive is not read past a corrupt member,
+            as its stream cannot be followed beyond it.
+
+    Raises:
+        ValueError: if the file is not a readable zip or tar archive.
+    """
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        try:
+            archive = zipfile.ZipFile(fileobj)
+        except zipfile.BadZipFile:
+            raise ValueError("Uploaded zip archive could not be read.")
+        with archive:
+            for info in archive.infolist():
+                if not info.is_dir() and _is_image_member(info.filename):
+                    # the declared size also bounds how much is decompressed
+                    if max_bytes is not None and info.file_size > max_bytes:
+                        yield info.filename, too_large(max_bytes)
+                        continue
+                    try:
+                        image_bytes = archive.read(info)
+                    except _ZIP_MEMBER_ERRORS:
+                        image_bytes = reject("Could not read image from the archive.", "corrupt_archive_member")
+                    yield info.filename, image_bytes
+        return
+
+    fileobj.seek(0)
+    try:
+        # stream mode reads members in order without seeking back through the archive
+        archive = tarfile.open(fileobj=fileobj, mode="r|*")
+    except _TAR_ERRORS:
+        raise ValueError("Uploaded archive must be a zip or tar file.")
+    with archive:
+        members = iter(archive)
+        while True:
+            try:
+                member = next(members, None)
+            except _TAR_ERRORS:
+                raise ValueError("Uploaded tar archive could not be read past its last image.")
+            if member is None:
+                return
+            if not (member.isfile() and _is_image_member(member.name)):
+                continue
+            if max_bytes is not None and member.size > max_bytes:
+                yield member.name, too_large(max_bytes)
+                continue
+            try:
+                image_bytes = archive.extractfile(member).read()
+            except _TAR_ERRORS:
+                yield member.name, reject("Could not read image from the archive.", "corrupt_archive_member")
+                return
+            yield member.name, image_bytes
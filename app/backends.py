@@ -0,0 +1,113 @@
+import logging
+import os
+import tempfile
+from typing import Callable
+
+import torch
+from torch import nn
+
+from app.preprocess import IMAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# inference backends that can be selected with AIHAB_INFERENCE_BACKEND
+BACKENDS = ("eager", "int8", "bf16", "compile", "torchscript", "onnx")
+
+
+def bf16_supported() -> bool:
+    """Whether this CPU has native bfloat16 support (AVX512-BF16 or AMX)."""
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+class InferenceBackend:
+    """
+    A model prepared for inference in one of `BACKENDS`.
+
+    Calling the backend with a float32 batch returns float32 logits, whatever the
+    backend runs internally. The original eager model is kept on `model` for anything
+    that needs the module itself, such as Grad-CAM hooks.
+    """
+
+    def __init__(self, name: str, model: nn.Module, prepared: Callable[[torch.Tensor], torch.Tensor]):
+        self.name = name
+        self.model = model
+        # the module or function that actually runs the batch
+        self.prepared = prepared
+
+    def __call__(self, batch: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.prepared(batch)
+
+
+def _example_input(memory_format: torch.memory_format) -> torch.Tensor:
+    return torch.randn((2, 3) + IMAGE_SIZE).contiguous(memory_format=memory_format)
+
+
+def build_backend(model: nn.Module, name: str, memory_format: torch.memory_format = torch.contiguous_format) -> InferenceBackend:
+    """
+    Prepare an eager fp32 model for inference with the named backend.
+
+    Falls back to eager if bf16 is requested on a CPU without bfloat16 support.
+
+    Raises:
+        ValueError: if the backend name is not one of `BACKENDS`.
+        ImportError: if the onnx backend is requested without onnxruntime installed.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'. Must be one of {', '.join(BACKENDS)}.")
+
+    if name == "int8":
+        # weights of the Linear layers (nearly all of Swin's compute) stored as int8,
+        # activations quantised on the fly
+        quantized = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+        return InferenceBackend(name, model, quantized)
+
+    if name == "bf16":
+        if not bf16_supported():
+            logger.warning("bfloat16 is not supported on this CPU, using the eager backend.")
+            return InferenceBackend("eager", model, model)
+
+        def run(batch):
+            with torch.autocast("cpu", dtype=torch.bfloat16):
+                return model(batch).float()
+        return InferenceBackend(name, model, run)
+
+    if name == "compile":
+        # batch size varies with load, so compile for a dynamic batch dimension
+        return InferenceBackend(name, model, torch.compile(model, dynamic=True))
+
+    if name == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, _example_input(memory_format))
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+        return InferenceBackend(name, model, traced)
+
+    if name == "onnx":
+        return InferenceBackend(name, model, _build_onnx(model, memory_format))
+
+    return InferenceBackend(name, model, model)
+
+
+def _build_onnx(model: nn.Module, memory_format: torch.memory_format) -> Callable[[torch.Tensor], torch.Tensor]:
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError("The onnx backend requires onnxruntime (pip install -r requirements-onnx.txt).")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "model.onnx")
+        torch.onnx.export(
+            model,
+            (_example_input(memory_format),),
+            path,
+            input_names=["input"],
+            output_names=["logits"],
+            dynamic_shapes=({0: torch.export.Dim("batch")},),
+            dynamo=True,
+        )
+        session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+
+    def run(batch):
+        logits = session.run(None, {"input": batch.contiguous().numpy()})[0]
+        return torch.from_numpy(logits)
+    return run
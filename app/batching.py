@@ -0,0 +1,160 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, List, Sequence
+
+_STOP = object()
+
+
+class MicroBatcher:
+    """
+    Collect items submitted from many threads and process them in batches.
+
+    The first item to arrive opens a batch window. Items arriving within `max_wait_ms`
+    of it (up to `max_batch_size` items) are passed to `run_batch` together on a single
+    background thread, and each caller's future is resolved with its own result.
+    Items submitted together with `submit_many` are kept in the same batch.
+
+    Args:
+        run_batch: function taking a list of items and returning a list of results in the same order.
+        max_batch_size: maximum number of items per batch.
+        max_wait_ms: how long to hold a batch open waiting for more items.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        name: str = "micro-batcher",
+    ):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size must be at least 1.")
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = None
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._batch_sizes = Counter()
+
+    def submit(self, item: Any) -> Future:
+        """
+        Queue an item for the next batch.
+
+        Returns:
+            Future: resolved with the item's result, or with the exception raised by `run_batch`.
+
+        Raises:
+            RuntimeError: if the batcher has been stopped.
+        """
+        self._ensure_started()
+        future = Future()
+        self._queue.put(([item], [future]))
+        return future
+
+    def submit_many(self, items: Sequence[Any]) -> List[Future]:
+        """
+        Queue items to be processed together, e.g. the tiles of one image. Up to
+        `max_batch_size` of them at a time go into one batch, rather than being split
+        between the end of one batch and the start of the next.
+
+        Returns:
+            list: a future for each item, as from `submit`.
+        """
+        self._ensure_started()
+        futures = [Future() for _ in items]
+        for start in range(0, len(items), self.max_batch_size):
+            end = start + self.max_batch_size
+            self._queue.put((list(items[start:end]), futures[start:end]))
+        return futures
+
+    def stop(self):
+        """Stop the background thread once the items already queued have been processed."""
+        with self._lock:
+            self._stopped = True
+            if self._thread is None:
+                return
+            self._queue.put((_STOP, None))
+            thread = self._thread
+        thread.join()
+
+    def stats(self) -> dict:
+        """Items waiting for a batch and the realised batch-size distribution, for tuning the batch window against latency."""
+        with self._lock:
+            sizes = dict(sorted(self._batch_sizes.items()))
+        batches = sum(sizes.values())
+        items = sum(size * count for size, count in sizes.items())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait_ms,
+            "queued": self._queue.qsize(),
+            "batches": batches,
+            "items": items,
+            "mean_batch_size": items / batches if batches else 0.0,
+            "batch_size_distribution": sizes,
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError(f"{self.name} has been stopped.")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        max_wait = self.max_wait_ms / 1000
+        # items submitted together that did not fit in the last batch
+        held = None
+        while True:
+            items, futures = held or self._queue.get()
+            held = None
+            if items is _STOP:
+                return
+            batch = list(zip(items, futures))
+            stop = False
+
+            # hold the batch open until it is full or the window closes
+            deadline = time.monotonic() + max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items, futures = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if items is _STOP:
+                    stop = True
+                    break
+                if len(batch) + len(items) > self.max_batch_size:
+                    held = (items, futures)
+                    break
+                batch.extend(zip(items, futures))
+
+            self._process(batch)
+            if stop:
+                return
+
+    def _process(self, batch):
+        # skip items whose caller has already given up
+        batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        try:
+            results = self.run_batch([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,147 @@
+"""
+Build the embedding index (AIHAB_EMBEDDING_INDEX) from a directory of reference survey images.
+
+Every image under the directory is embedded with the model version the API will
+query the index with, as /embed does (the pooled input to the classifier head), and
+identified by its path relative to the directory. Metadata for the references (e.g.
+habitat code or quadrat) can be given as a CSV file with an `image` column of those
+paths; its other columns are returned with each similar reference.
+
+Embeddings are stored at unit length as a float16 `embeddings.npy`, which the API
+memory-maps, with an `index.json` describing them. With `--lists`, the references are
+partitioned by spherical k-means into that many lists (IVF) and stored list by list,
+with the lists' centroids in `centroids.npy`, so each query only scores the lists
+nearest to it (AIHAB_EMBEDDING_INDEX_PROBES). Without it, every query scores every
+reference, which is fine up to a few hundred thousand references.
+
+Usage (from the repository root):
+    python -m app.build_embedding_index references/ --output data/index/references [--metadata references.csv] [--lists 256]
+"""
+import argparse
+import csv
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from app.config import CHANNELS_LAST, DEFAULT_MODEL_VERSION, MODEL_SOURCES
+from app.embeddings import CENTROIDS_FILENAME, EMBEDDINGS_FILENAME, INDEX_CONFIG_FILENAME, normalise
+from app.predict import create_model, login_hf
+from app.preprocess import BatchBuffer, decode_image
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".tif", ".tiff", ".bmp"}
+
+
+def find_images(directory: str) -> List[str]:
+    """Paths of the images under a directory, relative to it, in a stable order."""
+    paths = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, "/"))
+    return sorted(paths)
+
+
+def embed_references(model: torch.nn.Module, directory: str, paths: List[str], batch_size: int) -> Tuple[List[str], np.ndarray]:
+    """Unit-length embeddings of the images that could be decoded, and their paths."""
+    buffer = BatchBuffer(batch_size, channels_last=CHANNELS_LAST)
+    embedded, embeddings = [], []
+    for start in range(0, len(paths), batch_size):
+        images = []
+        for path in paths[start:start + batch_size]:
+            try:
+                with open(os.path.join(directory, path), "rb") as file:
+                    images.append(decode_image(file.read()))
+                embedded.append(path)
+            except (OSError, ValueError) as e:
+                print(f"Skipping {path}: {e}")
+        if not images:
+            continue
+        with torch.no_grad():
+            # the same pooled features the API returns, from the backbone's output
+            features = model.forward_head(model.forward_features(buffer.fill(images)), pre_logits=True)
+        embeddings.append(normalise(features.float().numpy()))
+        print(f"Embedded {min(start + batch_size, len(paths))} of {len(paths)} images.", end="\r")
+    print()
+    if not embeddings:
+        raise SystemExit(f"None of the images under {directory} could be decoded.")
+    return embedded, np.concatenate(embeddings)
+
+
+def partition(embeddings: np.ndarray, lists: int, iterations: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Spherical k-means of unit-length embeddings.
+
+    Returns:
+        tuple: [lists, dim] unit-length centroids, and the list each embedding is assigned to.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(embeddings @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, embeddings)
+        counts = np.bincount(assignments, minlength=lists)
+        # lists left empty restart from a random embedding
+        empty = counts == 0
+        sums[empty] = embeddings[rng.choice(len(embeddings), int(empty.sum()))]
+        centroids = normalise(sums)
+    return centroids, np.argmax(embeddings @ centroids.T, axis=1)
+
+
+def read_metadata(path: str) -> dict:
+    with open(path, newline="") as file:
+        return {record.pop("image"): record for record in csv.DictReader(file)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", help="directory of reference survey images")
+    parser.add_argument("--output", default="data/index/references", help="directory to write the index to")
+    parser.add_argument("--metadata", help="CSV file with an image column (paths relative to the images directory) and metadata columns")
+    parser.add_argument("--model-version", default=DEFAULT_MODEL_VERSION, help="model version (of AIHAB_MODELS) to embed the images with")
+    parser.add_argument("--lists", type=int, default=0, help="IVF lists to partition the references into (0 for an exact index)")
+    parser.add_argument("--iterations", type=int, default=20, help="k-means iterations when partitioning")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.model_version not in MODEL_SOURCES:
+        raise SystemExit(f"Unknown model version '{args.model_version}'. Must be one of {', '.join(MODEL_SOURCES)}.")
+    paths = find_images(args.images)
+    if not paths:
+        raise SystemExit(f"No images found under {args.images}.")
+
+    login_hf()
+    model = create_model(MODEL_SOURCES[args.model_version])
+    ids, embeddings = embed_references(model, args.images, paths, args.batch_size)
+    if not 0 <= args.lists <= len(ids):
+        raise SystemExit(f"--lists must be between 0 and the number of images embedded ({len(ids)}).")
+
+    config = {"model_version": args.model_version, "dim": embeddings.shape[1], "lists": args.lists}
+    centroids = None
+    if args.lists:
+        centroids, assignments = partition(embeddings, args.lists, args.iterations)
+        # store each list's references contiguously
+        order = np.argsort(assignments, kind="stable")
+        embeddings = embeddings[order]
+        ids = [ids[index] for index in order]
+        config["offsets"] = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=args.lists))]).tolist()
+    config["ids"] = ids
+    if args.metadata:
+        metadata = read_metadata(args.metadata)
+        config["metadata"] = [metadata.get(path, {}) for path in ids]
+
+    os.makedirs(args.output, exist_ok=True)
+    # the arrays are written before their description, so a partly written index is not loaded
+    np.save(os.path.join(args.output, EMBEDDINGS_FILENAME), embeddings.astype(np.float16))
+    if centroids is not None:
+        np.save(os.path.join(args.output, CENTROIDS_FILENAME), centroids.astype(np.float32))
+    with open(os.path.join(args.output, INDEX_CONFIG_FILENAME), "w") as file:
+        json.dump(config, file)
+    print(f"Wrote an index of {len(ids)} references ({args.lists or 'no'} lists) to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Build the location prior grid (AIHAB_LOCATION_PRIOR) from habitat observations.
+
+Observations are read from a CSV file with `latitude`, `longitude` and `habitat`
+(UKHab code) columns. Each code is counted towards the model class it falls under
+(e.g. `g1a` towards `g1`); codes above the model's classes are skipped. Counts are
+binned into a latitude/longitude grid over Great Britain of roughly `--cell-km`
+cells, summed over a square of `--smoothing` cells either side, and turned into log
+ratios log(p(class | cell) / p(class)), shrunk towards 0 by `--pseudo-count`
+observations. Cells with no observations nearby are left at 0, i.e. no prior.
+
+The grid is written as a float16 `grid.npy`, which the API memory-maps, and a
+`grid.json` describing it.
+
+Usage (from the repository root):
+    python -m app.build_location_prior observations.csv --output data/priors/location [--cell-km 1] [--smoothing 2]
+"""
+import argparse
+import csv
+import json
+import math
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+
+from app.labels import HABITAT_CODES
+from app.priors import GRID_CONFIG_FILENAME, GRID_FILENAME
+
+# extent of the grid, covering Great Britain and its islands
+LAT_MIN, LAT_MAX = 49.8, 61.0
+LON_MIN, LON_MAX = -8.8, 2.0
+
+KM_PER_DEGREE_LAT = 111.32
+
+
+def class_index(code: str, codes: Sequence[str] = HABITAT_CODES) -> Optional[int]:
+    """Index of the model class a UKHab code falls under, or None if it is above all of them."""
+    code = code.strip().lower()
+    # the most specific class the code starts with, e.g. g1c for g1c and g1 for g1a
+    matches = [index for index, class_code in enumerate(codes) if code.startswith(class_code)]
+    return max(matches, key=lambda index: len(codes[index]), default=None)
+
+
+def box_sum(counts: np.ndarray, radius: int) -> np.ndarray:
+    """Sum of each cell's (2 * radius + 1)^2 neighbourhood, over the first two axes."""
+    if radius <= 0:
+        return counts
+    for axis in (0, 1):
+        padded = np.concatenate([
+            np.zeros_like(counts.take([0], axis=axis)),
+            np.cumsum(counts, axis=axis),
+        ], axis=axis)
+        size = counts.shape[axis]
+        upper = np.minimum(np.arange(size) + radius + 1, size)
+        lower = np.maximum(np.arange(size) - radius, 0)
+        counts = padded.take(upper, axis=axis) - padded.take(lower, axis=axis)
+    return counts
+
+
+def build_grid(path: str, cell_km: float, smoothing: int, pseudo_count: float) -> tuple:
+    cell_lat = cell_km / KM_PER_DEGREE_LAT
+    # roughly square cells at the latitude of central Britain
+    cell_lon = cell_km / (KM_PER_DEGREE_LAT * math.cos(math.radians(55)))
+    rows = math.ceil((LAT_MAX - LAT_MIN) / cell_lat)
+    columns = math.ceil((LON_MAX - LON_MIN) / cell_lon)
+    counts = np.zeros((rows, columns, len(HABITAT_CODES)), dtype=np.float64)
+
+    used = skipped = 0
+    with open(path, newline="") as file:
+        for record in csv.DictReader(file):
+            try:
+                latitude, longitude = float(record["latitude"]), float(record["longitude"])
+            except (KeyError, TypeError, ValueError):
+                skipped += 1
+                continue
+            index = class_index(record.get("habitat") or "")
+            row = int((latitude - LAT_MIN) // cell_lat)
+            column = int((longitude - LON_MIN) // cell_lon)
+            if index is None or not (0 <= row < rows and 0 <= column < columns):
+                skipped += 1
+                continue
+            counts[row, column, index] += 1
+            used += 1
+    if not used:
+        raise SystemExit(f"No usable observations in {path}.")
+
+    # overall class frequencies, smoothed so classes never observed don't divide by zero
+    totals = counts.sum(axis=(0, 1))
+    overall = (totals + 1) / (totals.sum() + len(totals))
+
+    counts = box_sum(counts, smoothing)
+    cell_totals = counts.sum(axis=2, keepdims=True)
+    local = (counts + pseudo_count * overall) / (cell_totals + pseudo_count)
+    grid = np.where(cell_totals > 0, np.log(local / overall), 0).astype(np.float16)
+
+    config = {
+        "classes": list(HABITAT_CODES),
+        "lat_min": LAT_MIN,
+        "lon_min": LON_MIN,
+        "cell_lat": cell_lat,
+        "cell_lon": cell_lon,
+        "cell_km": cell_km,
+        "smoothing": smoothing,
+        "pseudo_count": pseudo_count,
+        "observations": used,
+        "skipped": skipped,
+    }
+    return grid, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("observations", help="CSV file with latitude, longitude and habitat columns")
+    parser.add_argument("--output", default="data/priors/location", help="directory to write grid.npy and grid.json to")
+    parser.add_argument("--cell-km", type=float, default=1.0, help="approximate width and height of a cell")
+    parser.add_argument("--smoothing", type=int, default=2, help="cells either side that a cell's observations count towards")
+    parser.add_argument("--pseudo-count", type=float, default=10.0, help="observations' worth of shrinkage towards no prior")
+    args = parser.parse_args()
+
+    grid, config = build_grid(args.observations, args.cell_km, args.smoothing, args.pseudo_count)
+    os.makedirs(args.output, exist_ok=True)
+    # the grid is written before its description, so a partly written prior is not loaded
+    np.save(os.path.join(args.output, GRID_FILENAME), grid)
+    with open(os.path.join(args.output, GRID_CONFIG_FILENAME), "w") as file:
+        json.dump(config, file, indent=2)
+    print(
+        f"Wrote a {grid.shape[0]} x {grid.shape[1]} cell prior ({grid.nbytes / 1e6:.0f} MB) to {args.output} "
+        f"from {config['observations']} observations ({config['skipped']} skipped)."
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Build the species evidence (AIHAB_SPECIES_EVIDENCE) from species records in habitats.
+
+Records are read from a CSV file with `species` (scientific name, e.g. `Quercus robur`
+or `quercus_robur`) and `habitat` (UKHab code) columns, one row per record of a
+species in a habitat, e.g. from vegetation survey plots. Each code is counted towards
+the model class it falls under (e.g. `g1a` towards `g1`); codes above the model's
+classes are skipped. For each species with at least `--min-records` records, the
+counts are turned into log-likelihood ratios log(p(species | class) / p(species)),
+i.e. log(p(class | species) / p(class)), shrunk towards 0 by `--pseudo-count` records.
+Ratios smaller than `--min-evidence` either way are dropped, so the matrix only holds
+the species and classes that tell them apart.
+
+The vocabulary is written as `species.json` and the matrix as CSR arrays (`indptr`,
+`indices` and `data`) in `species.npz`.
+
+Usage (from the repository root):
+    python -m app.build_species_evidence records.csv --output data/priors/species [--pseudo-count 10] [--min-evidence 0.05]
+"""
+import argparse
+import csv
+import json
+import os
+
+import numpy as np
+
+from app.build_location_prior import class_index
+from app.labels import HABITAT_CODES
+from app.species import MATRIX_FILENAME, VOCABULARY_FILENAME, normalise_species
+
+
+def build_matrix(path: str, pseudo_count: float, min_evidence: float, min_records: int) -> tuple:
+    species_rows = {}
+    records = []
+    skipped = 0
+    with open(path, newline="") as file:
+        for record in csv.DictReader(file):
+            name = normalise_species(record.get("species") or "")
+            index = class_index(record.get("habitat") or "")
+            if not name or index is None:
+                skipped += 1
+                continue
+            records.append((species_rows.setdefault(name, len(species_rows)), index))
+    if not records:
+        raise SystemExit(f"No usable records in {path}.")
+
+    counts = np.zeros((len(species_rows), len(HABITAT_CODES)), dtype=np.float64)
+    rows, columns = np.array(records).T
+    np.add.at(counts, (rows, columns), 1)
+
+    # overall class frequencies, smoothed so classes never recorded don't divide by zero
+    totals = counts.sum(axis=0)
+    overall = (totals + 1) / (totals.sum() + len(totals))
+
+    species_totals = counts.sum(axis=1, keepdims=True)
+    local = (counts + pseudo_count * overall) / (species_totals + pseudo_count)
+    ratios = np.log(local / overall)
+    ratios[np.abs(ratios) < min_evidence] = 0
+    ratios[species_totals[:, 0] < min_records] = 0
+
+    # vocabulary in name order, keeping only species with some evidence
+    names = sorted(name for name, row in species_rows.items() if ratios[row].any())
+    ratios = ratios[[species_rows[name] for name in names]]
+    nonzero = ratios != 0
+    arrays = {
+        "indptr": np.concatenate([[0], np.cumsum(nonzero.sum(axis=1))]).astype(np.int64),
+        "indices": np.nonzero(nonzero)[1].astype(np.int32),
+        "data": ratios[nonzero].astype(np.float32),
+    }
+    config = {
+        "classes": list(HABITAT_CODES),
+        "species": names,
+        "pseudo_count": pseudo_count,
+        "min_evidence": min_evidence,
+        "min_records": min_records,
+        "records": len(records),
+        "skipped": skipped,
+    }
+    return arrays, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("records", help="CSV file with species and habitat columns")
+    parser.add_argument("--output", default="data/priors/species", help="directory to write species.npz and species.json to")
+    parser.add_argument("--pseudo-count", type=float, default=10.0, help="records' worth of shrinkage towards no evidence")
+    parser.add_argument("--min-evidence", type=float, default=0.05, help="smallest log ratio kept in the matrix")
+    parser.add_argument("--min-records", type=int, default=5, help="records a species needs to be included")
+    args = parser.parse_args()
+
+    arrays, config = build_matrix(args.records, args.pseudo_count, args.min_evidence, args.min_records)
+    os.makedirs(args.output, exist_ok=True)
+    # the matrix is written before the vocabulary, so a partly written directory is not loaded
+    np.savez(os.path.join(args.output, MATRIX_FILENAME), **arrays)
+    with open(os.path.join(args.output, VOCABULARY_FILENAME), "w") as file:
+        json.dump(config, file, indent=2)
+    print(
+        f"Wrote evidence for {len(config['species'])} species ({len(arrays['data'])} non-zero entries) to {args.output} "
+        f"from {config['records']} records ({config['skipped']} skipped)."
+    )
+
+
+if __name__ == "__main__":
+    main()
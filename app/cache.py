@@ -0,0 +1,154 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+class LogitsCache:
+    """
+    LRU cache of model logits keyed on a hash of the image bytes and the model version.
+
+    Logits are cached rather than finished responses, so requests for the same image
+    that differ only in `top_n` or `ukhab_predicted_level` can be answered without
+    running the model again. The cache is bounded both by number of entries and by
+    the bytes held in memory.
+
+    If `persist_dir` is given, entries are also written there as `.npy` files so the
+    cache survives restarts; files are removed when their entry is evicted, and the
+    most recently written files are loaded back by `load`.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, persist_dir: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.persist_dir = persist_dir
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    @staticmethod
+    def key(image_bytes: bytes, model_version: str) -> str:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(model_version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(image_bytes)
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[torch.Tensor]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            logits = self._entries.get(key)
+            if logits is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return logits
+
+    def put(self, key: str, logits: torch.Tensor):
+        if not self.enabled:
+            return
+        # copy so the cache never keeps the rest of a batch's output alive
+        logits = logits.detach().clone()
+        size = logits.numel() * logits.element_size()
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.numel() * previous.element_size()
+            self._entries[key] = logits
+            self._bytes += size
+            evicted = self._evict()
+
+        if self.persist_dir:
+            self._write(key, logits)
+            for evicted_key in evicted:
+                self._remove(evicted_key)
+
+    def load(self):
+        """Load entries persisted by an earlier process, most recently written last."""
+        if not (self.enabled and self.persist_dir):
+            return
+        os.makedirs(self.persist_dir, exist_ok=True)
+
+        paths = [
+            os.path.join(self.persist_dir, name)
+            for name in os.listdir(self.persist_dir)
+            if name.endswith(".npy")
+        ]
+        paths.sort(key=os.path.getmtime)
+
+        evicted = []
+        for path in paths[-self.max_entries:]:
+            key = os.path.basename(path)[:-len(".npy")]
+            try:
+                logits = torch.from_numpy(np.load(path))
+            except (OSError, ValueError):
+                continue
+            with self._lock:
+                self._entries[key] = logits
+                self._bytes += logits.numel() * logits.element_size()
+                evicted.extend(self._evict())
+        for key in evicted:
+            self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "enabled": self.enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+                "evictions": self._evictions,
+                "persistent": bool(self.persist_dir),
+            }
+
+    def _evict(self) -> list:
+        # called with the lock held
+        evicted = []
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            key, logits = self._entries.popitem(last=False)
+            self._bytes -= logits.numel() * logits.element_size()
+            self._evictions += 1
+            evicted.append(key)
+        return evicted
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.persist_dir, f"{key}.npy")
+
+    def _write(self, key: str, logits: torch.Tensor):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.persist_dir, exist_ok=True)
+            with open(tmp_path, "wb") as file:
+                np.save(file, logits.numpy())
+            os.replace(tmp_path, path)
+        except OSError:
+            # persistence is best effort, the in-memory entry is still valid
+            pass
+
+    def _remove(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
@@ -0,0 +1,139 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# Micro-batching of model forward passes.
+# Requests arriving within BATCH_MAX_WAIT_MS of each other are stacked into a single
+# forward pass of at most BATCH_MAX_SIZE images.
+BATCH_MAX_SIZE = int(os.getenv("AIHAB_BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("AIHAB_BATCH_MAX_WAIT_MS", "10"))
+
+# Tiled inference (/predict?tiled=true): each image is cut into at most TILE_MAX
+# overlapping model-sized tiles (TTA views included), overlapping by TILE_OVERLAP of
+# a tile. Up to BATCH_MAX_SIZE of an image's tiles share one forward pass, so by
+# default a tiled image costs one forward pass of BATCH_MAX_SIZE images.
+TILE_MAX = int(os.getenv("AIHAB_TILE_MAX", str(BATCH_MAX_SIZE)))
+TILE_OVERLAP = float(os.getenv("AIHAB_TILE_OVERLAP", "0.25"))
+
+# Inference executor.
+# Blocking work (image decoding, preprocessing and waiting on the model) runs on
+# INFERENCE_WORKERS threads; up to INFERENCE_QUEUE_SIZE more requests may wait for a
+# worker before the API answers 503 with a Retry-After of RETRY_AFTER_S seconds.
+INFERENCE_WORKERS = int(os.getenv("AIHAB_INFERENCE_WORKERS", str(BATCH_MAX_SIZE)))
+INFERENCE_QUEUE_SIZE = int(os.getenv("AIHAB_INFERENCE_QUEUE_SIZE", "32"))
+RETRY_AFTER_S = int(os.getenv("AIHAB_RETRY_AFTER_S", "1"))
+
+# Priority classes, as comma-separated `class=weight` pairs. Each class has its own
+# queue for the inference workers, and while several classes have requests waiting,
+# workers are shared between them in proportion to their weights. Requests pick a
+# class with the `priority` parameter or X-Priority header; single-image endpoints
+# default to DEFAULT_PRIORITY (the first class) and batch endpoints to BULK_PRIORITY
+# (the last). A request may also give a deadline, `deadline_ms` or X-Deadline-Ms
+# milliseconds after it arrives, after which it is dropped if it has not started.
+PRIORITY_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (pair.split("=", 1) for pair in os.getenv("AIHAB_PRIORITY_WEIGHTS", "interactive=8,bulk=1").split(",") if pair.strip())
+}
+DEFAULT_PRIORITY = os.getenv("AIHAB_DEFAULT_PRIORITY", next(iter(PRIORITY_WEIGHTS)))
+BULK_PRIORITY = os.getenv("AIHAB_BULK_PRIORITY", list(PRIORITY_WEIGHTS)[-1])
+
+# Maximum number of images accepted by /predict/batch, counting the images inside archives
+BATCH_MAX_IMAGES = int(os.getenv("AIHAB_BATCH_MAX_IMAGES", "1000"))
+
+# Uploaded images. Images larger than UPLOAD_MAX_BYTES are rejected while they are
+# read, and the format and dimensions are checked from the first bytes of the file
+# (reading at most UPLOAD_SNIFF_BYTES to find them), so images with more than
+# MAX_IMAGE_PIXELS pixels are rejected before any decoding (decompression bombs).
+UPLOAD_MAX_BYTES = int(os.getenv("AIHAB_UPLOAD_MAX_BYTES", str(25 * 1024 * 1024)))
+UPLOAD_SNIFF_BYTES = int(os.getenv("AIHAB_UPLOAD_SNIFF_BYTES", str(1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("AIHAB_MAX_IMAGE_PIXELS", "100000000"))
+
+# Cache of model logits keyed on the image bytes and model version.
+# Set CACHE_MAX_ENTRIES to 0 to disable. If CACHE_DIR is set, entries are also kept
+# on disk there and reloaded at startup.
+CACHE_MAX_ENTRIES = int(os.getenv("AIHAB_CACHE_MAX_ENTRIES", "10000"))
+CACHE_MAX_BYTES = int(os.getenv("AIHAB_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+CACHE_DIR = os.getenv("AIHAB_CACHE_DIR", None)
+
+# Run the model on channels-last (NHWC) input. Slightly faster for the Swin patch
+# embedding on some CPUs; compare with `python -m benchmarks.bench_preprocess`.
+CHANNELS_LAST = os.getenv("AIHAB_CHANNELS_LAST", "false").lower() in ("1", "true", "yes")
+
+# Inference backend, chosen at startup: eager (fp32), int8 (dynamic quantisation of
+# the Linear layers), bf16 (bfloat16 autocast, if the CPU supports it), compile
+# (torch.compile), torchscript or onnx (ONNX Runtime, needs onnxruntime installed).
+# Compare them with `python -m benchmarks.compare_backends`.
+INFERENCE_BACKEND = os.getenv("AIHAB_INFERENCE_BACKEND", "eager")
+
+# Model versions that can be requested with the `model_version` parameter, as
+# comma-separated `version=source` pairs, where the source is a timm model name
+# (downloaded from the Hub) or a local directory holding `config.json` and
+# `model.safetensors`, which is memory-mapped and needs no network access.
+# Versions are loaded on first use (or at startup if listed in AIHAB_MODEL_PREWARM)
+# and kept resident up to MAX_RESIDENT_MODELS models and MAX_MODEL_MEMORY_MB of
+# weights (0 for no limit), after which the least recently used is unloaded.
+MODEL_SOURCES = dict(
+    pair.strip().split("=", 1)
+    for pair in os.getenv("AIHAB_MODELS", "default=hf_hub:whitegivefive/aihab-supcon-swint-v0").split(",")
+    if pair.strip()
+)
+DEFAULT_MODEL_VERSION = os.getenv("AIHAB_DEFAULT_MODEL_VERSION", next(iter(MODEL_SOURCES)))
+MODEL_PREWARM = [version.strip() for version in os.getenv("AIHAB_MODEL_PREWARM", DEFAULT_MODEL_VERSION).split(",") if version.strip()]
+MAX_RESIDENT_MODELS = int(os.getenv("AIHAB_MAX_RESIDENT_MODELS", "2"))
+MAX_MODEL_MEMORY_MB = int(os.getenv("AIHAB_MAX_MODEL_MEMORY_MB", "0"))
+# After a version fails to load, requests for it get 503 for this long before the
+# load is tried again (on the next request), rather than every request retrying it.
+MODEL_RETRY_INTERVAL_S = float(os.getenv("AIHAB_MODEL_RETRY_INTERVAL_S", "30"))
+
+# Location prior: a grid of per-class log ratios built with `python -m app.build_location_prior`,
+# memory-mapped from LOCATION_PRIOR_DIR and added to the logits of requests that give a
+# latitude and longitude, scaled by LOCATION_PRIOR_WEIGHT. Unset to disable.
+LOCATION_PRIOR_DIR = os.getenv("AIHAB_LOCATION_PRIOR", None)
+LOCATION_PRIOR_WEIGHT = float(os.getenv("AIHAB_LOCATION_PRIOR_WEIGHT", "1.0"))
+
+# Species evidence: a species vocabulary and sparse species x class log-likelihood matrix
+# built with `python -m app.build_species_evidence`, loaded from SPECIES_EVIDENCE_DIR at
+# startup and added to the logits of requests that give a species_list, scaled by
+# SPECIES_EVIDENCE_WEIGHT. Unset to disable.
+SPECIES_EVIDENCE_DIR = os.getenv("AIHAB_SPECIES_EVIDENCE", None)
+SPECIES_EVIDENCE_WEIGHT = float(os.getenv("AIHAB_SPECIES_EVIDENCE_WEIGHT", "1.0"))
+
+# Embedding index: reference survey images' embeddings built with `python -m app.build_embedding_index`,
+# memory-mapped from EMBEDDING_INDEX_DIR to look up similar references. If the index is
+# partitioned, each query scores the EMBEDDING_INDEX_PROBES partitions nearest to it.
+# References at least NEAR_DUPLICATE_SIMILARITY (cosine) similar are flagged as near duplicates.
+EMBEDDING_INDEX_DIR = os.getenv("AIHAB_EMBEDDING_INDEX", None)
+EMBEDDING_INDEX_PROBES = int(os.getenv("AIHAB_EMBEDDING_INDEX_PROBES", "8"))
+NEAR_DUPLICATE_SIMILARITY = float(os.getenv("AIHAB_NEAR_DUPLICATE_SIMILARITY", "0.97"))
+
+# Threads used by torch for each forward pass. 0 leaves torch's default (one per
+# core), which is right for a single process; `python -m app.serve` divides the
+# cores between its worker processes so they don't oversubscribe them.
+TORCH_THREADS = int(os.getenv("AIHAB_TORCH_THREADS", "0"))
+
+# Multi-process serving with `python -m app.serve`: number of worker processes, and
+# where Hub models are saved as local safetensors so the workers can share them.
+SERVE_WORKERS = int(os.getenv("AIHAB_SERVE_WORKERS", "1"))
+LOCAL_MODEL_DIR = os.getenv("AIHAB_LOCAL_MODEL_DIR", "data/models/local")
+
+# Grad-CAM images returned with gradcam=true: width and height in pixels, format
+# (png or webp) and WebP quality. Smaller and lossy images are much faster to encode.
+GRADCAM_SIZE = int(os.getenv("AIHAB_GRADCAM_SIZE", "384"))
+GRADCAM_FORMAT = os.getenv("AIHAB_GRADCAM_FORMAT", "png").lower()
+GRADCAM_QUALITY = int(os.getenv("AIHAB_GRADCAM_QUALITY", "80"))
+# Grad-CAM images can also be fetched from /gradcam/{id} for GRADCAM_TTL_S seconds;
+# they are kept in GRADCAM_DIR (by default a directory under the system temp dir).
+GRADCAM_DIR = os.getenv("AIHAB_GRADCAM_DIR", None)
+GRADCAM_TTL_S = float(os.getenv("AIHAB_GRADCAM_TTL_S", "600"))
+
+# Bulk classification jobs (/jobs). Jobs are kept in a SQLite database at JOBS_DB and
+# their images spilled to JOBS_DIR until classified; JOB_WORKERS jobs run at once in
+# each process. A job whose runner stops heartbeating for JOB_STALE_S seconds (e.g.
+# after a crash) is resumed by another runner.
+JOBS_DB = os.getenv("AIHAB_JOBS_DB", "data/jobs/jobs.sqlite3")
+JOBS_DIR = os.getenv("AIHAB_JOBS_DIR", "data/jobs/images")
+JOB_WORKERS = int(os.getenv("AIHAB_JOB_WORKERS", "1"))
+JOB_MAX_IMAGES = int(os.getenv("AIHAB_JOB_MAX_IMAGES", "100000"))
+JOB_STALE_S = float(os.getenv("AIHAB_JOB_STALE_S", "30"))
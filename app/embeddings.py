@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+CENTROIDS_FILENAME = "centroids.npy"
+INDEX_CONFIG_FILENAME = "index.json"
+
+# references scored per matrix product by an exact search, bounding the scores held at once
+_CHUNK_ROWS = 65536
+
+
+def normalise(embeddings: np.ndarray) -> np.ndarray:
+    """Embeddings scaled to unit length, so their dot products are cosine similarities."""
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """The `k` highest scores in each row, sorted descending, and their columns."""
+    return torch.topk(scores, min(k, scores.shape[1]), dim=1)
+
+
+class EmbeddingIndex:
+    """
+    Nearest-neighbour search over the embeddings of reference survey images,
+    memory-mapped from a directory built by `python -m app.build_embedding_index`.
+
+    The references' embeddings are stored at unit length as a float16
+    [references, dim] array, so a batch of query embeddings is scored against them
+    with float16 matrix products of cosine similarities, straight from the mapped
+    pages. Without partitioning, every reference is scored, a chunk of rows at a time.
+    With IVF partitioning (`--lists` when building), the references are grouped by
+    their nearest centroid and stored contiguously per group, and each query only
+    scores the `probes` groups whose centroids are nearest to it, with one product
+    per group probed by a batch of queries.
+
+    Embeddings differ between model versions, so the index only answers queries from
+    the version it was built with.
+
+    Args:
+        directory: where `embeddings.npy` and `index.json` (and `centroids.npy`, if
+            partitioned) are, or None to disable the index.
+        probes: groups each query scores, if the index is partitioned.
+        near_duplicate_similarity: cosine similarity at or above which a reference is
+            reported as a near duplicate of the query.
+    """
+
+    def __init__(self, directory: Optional[str] = None, probes: int = 8, near_duplicate_similarity: float = 0.97):
+        self.directory = directory
+        self.probes = probes
+        self.near_duplicate_similarity = near_duplicate_similarity
+        self.model_version = None
+        self.embeddings = None
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self._centroids = None
+        self._offsets = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    @property
+    def loaded(self) -> bool:
+        return self.embeddings is not None
+
+    def load(self):
+        """
+        Memory-map the reference embeddings, at startup.
+
+        Raises:
+            ValueError: if the embeddings, centroids and description don't match.
+        """
+        if not self.enabled:
+            return
+        with open(os.path.join(self.directory, INDEX_CONFIG_FILENAME)) as file:
+            config = json.load(file)
+        # copy-on-write, so torch can wrap the mapping without copying it; it is never written
+        embeddings = np.load(os.path.join(self.directory, EMBEDDINGS_FILENAME), mmap_mode="c")
+        if embeddings.shape != (len(config["ids"]), config["dim"]):
+            raise ValueError(f"Embeddings in {self.directory} have shape {embeddings.shape}, expected ({len(config['ids'])}, {config['dim']}).")
+        if config["lists"]:
+            centroids = torch.from_numpy(np.load(os.path.join(self.directory, CENTROIDS_FILENAME)).astype(np.float32))
+            offsets = np.asarray(config["offsets"], dtype=np.int64)
+            if tuple(centroids.shape) != (config["lists"], config["dim"]) or len(offsets) != config["lists"] + 1 or offsets[-1] != len(embeddings):
+                raise ValueError(f"Embedding index partitions in {self.directory} don't match its embeddings.")
+            self._centroids = centroids
+            self._offsets = offsets
+        self.model_version = config["model_version"]
+        self.ids = config["ids"]
+        self.metadata = config.get("metadata") or [{} for _ in self.ids]
+        self.embeddings = torch.from_numpy(embeddings)
+        logger.info(
+            "Loaded embedding index of %d references (%s) for model version %s from %s.",
+            len(embeddings), f"{config['lists']} lists" if config["lists"] else "exact", self.model_version, self.directory
+        )
+
+    def check(self, model_version: str):
+        """
+        Raises:
+            ValueError: if there is no index, or it was built with a different model version.
+        """
+        if not self.loaded:
+            raise ValueError("No embedding index is configured, so similar references cannot be looked up.")
+        if model_version != self.model_version:
+            raise ValueError(f"The embedding index was built with model version '{self.model_version}', not '{model_version}'.")
+
+    def _search_exact(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        scores = torch.empty((len(queries), 0))
+        rows = torch.empty((len(queries), 0), dtype=torch.long)
+        queries = queries.half()
+        for start in range(0, len(self.embeddings), _CHUNK_ROWS):
+            chunk_scores, columns = top_k((queries @ self.embeddings[start:start + _CHUNK_ROWS].T).float(), k)
+            # keep the best k of those found so far and this chunk's
+            scores, best = top_k(torch.cat([scores, chunk_scores], dim=1), k)
+            rows = torch.cat([rows, columns + start], dim=1).gather(1, best)
+        return scores, rows
+
+    def _search_partitioned(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        _, probed = top_k(queries @ self._centroids.T, self.probes)
+        scores = torch.full((len(queries), k), -torch.inf)
+        rows = torch.zeros((len(queries), k), dtype=torch.long)
+        queries = queries.half()
+        for group in torch.unique(probed).tolist():
+            start, end = self._offsets[group], self._offsets[group + 1]
+            if start == end:
+                continue
+            # the queries that probed this group, scored against its contiguous slice of the mapping
+            probing = (probed == group).any(dim=1).nonzero().squeeze(1)
+            group_scores, columns = top_k((queries[probing] @ self.embeddings[start:end].T).float(), k)
+            merged, best = top_k(torch.cat([scores[probing], group_scores], dim=1), k)
+            rows[probing] = torch.cat([rows[probing], columns + start], dim=1).gather(1, best)
+            scores[probing] = merged
+        return scores, rows
+
+    def search(self, queries: torch.Tensor, k: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        The `k` most similar references to each of a batch of query embeddings.
+
+        Returns:
+            tuple: [queries, k] cosine similarities, highest first, and the references'
+                rows, with -inf similarities where fewer than `k` references were scored.
+        """
+        queries = torch.nn.functional.normalize(queries.float(), dim=1)
+        if self._centroids is not None:
+            return self._search_partitioned(queries, k)
+        return self._search_exact(queries, k)
+
+    def neighbours(self, embeddings: torch.Tensor, k: int) -> List[List[dict]]:
+        """
+        The `k` most similar references to each of a batch of embeddings, as response items.
+
+        Returns:
+            list: for each embedding, a list of references with their id, cosine
+                similarity, whether they are a near duplicate, and metadata.
+        """
+        scores, rows = self.search(embeddings, k)
+        return [
+            [
+                {
+                    "id": self.ids[row],
+                    "similarity": float(score),
+                    "near_duplicate": bool(score >= self.near_duplicate_similarity),
+                    "metadata": self.metadata[row],
+                }
+                for score, row in zip(query_scores, query_rows) if score > -np.inf
+            ]
+            for query_scores, query_rows in zip(scores.tolist(), rows.tolist())
+        ]
@@ -0,0 +1,78 @@
+import json
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Optional
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+# alternative names clients send for the same encodings
+ALIASES = {
+    "application/x-msgpack": MSGPACK,
+    "application/vnd.msgpack": MSGPACK,
+    "*/*": JSON,
+    "application/*": JSON,
+}
+
+
+def _plain(value: Any) -> Any:
+    # habitat hierarchies are immutable mappings, which the encoders don't know about
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def _encode_json(content: Any) -> bytes:
+    return json.dumps(content, default=_plain, separators=(",", ":")).encode()
+
+
+def _encoders() -> Dict[str, Callable[[Any], bytes]]:
+    encoders = {JSON: _encode_json}
+    try:
+        import msgpack
+        encoders[MSGPACK] = lambda content: msgpack.packb(content, default=_plain, use_bin_type=True)
+    except ImportError:
+        pass
+    try:
+        import cbor2
+        encoders[CBOR] = lambda content: cbor2.dumps(content, default=lambda encoder, value: encoder.encode(_plain(value)))
+    except ImportError:
+        pass
+    return encoders
+
+
+# encodings available with the packages installed (msgpack and cbor2 are in requirements.txt, but may be left out)
+ENCODERS = _encoders()
+
+
+def negotiate(accept: Optional[str]) -> Optional[str]:
+    """
+    The response media type to use for an Accept header, preferring the client's highest q-value.
+
+    Returns:
+        str: one of `ENCODERS`, JSON if no Accept header was sent, or None if none of
+            the types the client accepts is available.
+    """
+    if not accept:
+        return JSON
+    candidates = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = (item.strip() for item in part.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        media_type = ALIASES.get(media_type.lower(), media_type.lower())
+        if quality > 0 and media_type in ENCODERS:
+            # the earliest of equally preferred types wins
+            candidates.append((-quality, position, media_type))
+    return min(candidates)[2] if candidates else None
+
+
+def encode(content: Any, media_type: str) -> bytes:
+    """Encode plain response content (dicts, lists, tuples and scalars) as `media_type`."""
+    return ENCODERS[media_type](content)
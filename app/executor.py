@@ -0,0 +1,286 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Optional
+
+from app.metrics import DEADLINE_DROPS, QUEUE_WAIT_SECONDS
+
+
+class QueueFullError(Exception):
+    """Raised when the inference executor has no room to accept more work."""
+
+
+class DeadlineExceededError(Exception):
+    """Raised for work whose deadline passed before a worker started it."""
+
+
+class _Work:
+    __slots__ = ("future", "fn", "args", "kwargs", "priority", "deadline", "queued_at")
+
+    def __init__(self, fn: Callable[..., Any], args: tuple, kwargs: dict, priority: str, deadline: Optional[float]):
+        self.future = Future()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.deadline = deadline
+        self.queued_at = time.monotonic()
+
+
+class InferenceExecutor:
+    """
+    Worker threads with a bounded admission queue for blocking inference work,
+    shared between priority classes.
+
+    At most `max_workers` calls run at once and at most `max_queue` more wait for a
+    worker. Work submitted beyond that is rejected with `QueueFullError` instead of
+    being buffered, so the API can shed load rather than grow memory without bound.
+
+    Each priority class has its own queue. While several classes have work waiting,
+    free workers take work from them in proportion to their weights (stride
+    scheduling: each class's pass advances by 1 / weight per call started, and the
+    waiting class with the lowest pass goes next), so a class with weight 8 starts 8
+    calls for each one of a class with weight 1, and a class that was idle does not
+    build up credit. Within a class, work runs in the order it was submitted.
+
+    Work may be given a deadline (a `time.monotonic()` time). Work whose deadline has
+    passed when it reaches the front of its queue is dropped without being run, its
+    future failing with `DeadlineExceededError`.
+
+    Args:
+        weights: the priority classes and their weights; the first is the default class.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int, weights: Optional[Dict[str, float]] = None):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1.")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative.")
+        weights = dict(weights or {"default": 1.0})
+        if any(weight <= 0 for weight in weights.values()):
+            raise ValueError("Priority class weights must be positive.")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.weights = weights
+        self.default_priority = next(iter(weights))
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        self._queues: Dict[str, deque] = {priority: deque() for priority in weights}
+        self._passes: Dict[str, float] = {priority: 0.0 for priority in weights}
+        # pass of the class that last started work, which classes rejoin at after being idle
+        self._virtual_pass = 0.0
+        self._workers = []
+        self._stopped = False
+        self._pending = 0
+        self._rejected = 0
+        self._dropped: Dict[str, int] = {priority: 0 for priority in weights}
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    def check_priority(self, priority: Optional[str]) -> str:
+        """
+        The priority class to schedule work in, the default class if None.
+
+        Raises:
+            ValueError: if there is no such class.
+        """
+        if priority is None:
+            return self.default_priority
+        if priority not in self.weights:
+            raise ValueError(f"Unknown priority '{priority}'. Must be one of {', '.join(self.weights)}.")
+        return priority
+
+    def check_capacity(self):
+        """
+        Fail fast, before a request buffers its upload, if there is no room to run it.
+
+        Raises:
+            QueueFullError: if all workers are busy and the admission queue is full.
+        """
+        with self._lock:
+            if self._pending >= self.capacity:
+                self._rejected += 1
+                raise QueueFullError("Inference queue is full.")
+
+    def submit(
+        self,
+        fn: Callable[..., Any],
+        *args,
+        priority: Optional[str] = None,
+        deadline: Optional[float] = None,
+        **kwargs
+    ) -> Future:
+        """
+        Run `fn(*args, **kwargs)` on a worker thread.
+
+        Args:
+            priority: the priority class to queue the call in, the default class if None.
+            deadline: `time.monotonic()` time after which the call is dropped if it has not started.
+
+        Raises:
+            QueueFullError: if all workers are busy and the admission queue is full.
+            DeadlineExceededError: if the deadline has already passed.
+            ValueError: if there is no such priority class.
+        """
+        priority = self.check_priority(priority)
+        self._check_deadline(priority, deadline)
+        with self._lock:
+            if self._pending >= self.capacity:
+                self._rejected += 1
+                raise QueueFullError("Inference queue is full.")
+            self._pending += 1
+
+        try:
+            future = self._enqueue(_Work(fn, args, kwargs, priority, deadline))
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def reserve(self, priority: Optional[str] = None, deadline: Optional[float] = None) -> "Reservation":
+        """
+        Hold one admission slot for a sequence of calls, such as the steps of a streamed response.
+
+        Args:
+            priority: the priority class to queue the calls in, the default class if None.
+            deadline: `time.monotonic()` time by which the reservation must be made;
+                once made, its calls run whenever their turn comes.
+
+        Raises:
+            QueueFullError: if all workers are busy and the admission queue is full.
+            DeadlineExceededError: if the deadline has already passed.
+            ValueError: if there is no such priority class.
+        """
+        priority = self.check_priority(priority)
+        self._check_deadline(priority, deadline)
+        with self._lock:
+            if self._pending >= self.capacity:
+                self._rejected += 1
+                raise QueueFullError("Inference queue is full.")
+            self._pending += 1
+        return Reservation(self, priority)
+
+    def shutdown(self):
+        """Stop the workers once the work already queued has run."""
+        with self._lock:
+            self._stopped = True
+            self._work_available.notify_all()
+            workers = list(self._workers)
+        for worker in workers:
+            worker.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = self._pending
+            rejected = self._rejected
+            priorities = {
+                priority: {"weight": weight, "queued": len(self._queues[priority]), "dropped": self._dropped[priority]}
+                for priority, weight in self.weights.items()
+            }
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": min(pending, self.max_workers),
+            "queued": max(pending - self.max_workers, 0),
+            "rejected": rejected,
+            "dropped": sum(stats["dropped"] for stats in priorities.values()),
+            "priorities": priorities,
+        }
+
+    def _check_deadline(self, priority: str, deadline: Optional[float]):
+        if deadline is not None and time.monotonic() >= deadline:
+            with self._lock:
+                self._dropped[priority] += 1
+            DEADLINE_DROPS.inc(priority)
+            raise DeadlineExceededError("Deadline passed before the request could be run.")
+
+    def _enqueue(self, work: _Work) -> Future:
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("Inference executor has been shut down.")
+            queue = self._queues[work.priority]
+            if not queue:
+                # rejoin at the current pass rather than with credit for the time spent idle
+                self._passes[work.priority] = max(self._passes[work.priority], self._virtual_pass)
+            queue.append(work)
+            # a worker per call, up to max_workers, started as they are first needed
+            if len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._loop, name=f"inference_{len(self._workers)}", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._work_available.notify()
+        return work.future
+
+    def _next(self) -> Optional[_Work]:
+        """The next work to run, dropping any that is past its deadline; None once shut down and drained."""
+        dropped = []
+        with self._lock:
+            while True:
+                waiting = [priority for priority, queue in self._queues.items() if queue]
+                if not waiting:
+                    if self._stopped:
+                        work = None
+                        break
+                    self._work_available.wait()
+                    continue
+                priority = min(waiting, key=self._passes.__getitem__)
+                work = self._queues[priority].popleft()
+                if work.deadline is not None and time.monotonic() >= work.deadline:
+                    self._dropped[priority] += 1
+                    dropped.append(work)
+                    continue
+                self._virtual_pass = self._passes[priority]
+                self._passes[priority] += 1 / self.weights[priority]
+                break
+        # resolved outside the lock, as their callbacks release admission slots
+        for expired in dropped:
+            DEADLINE_DROPS.inc(expired.priority)
+            if expired.future.set_running_or_notify_cancel():
+                expired.future.set_exception(DeadlineExceededError("Deadline passed before the request could be run."))
+        return work
+
+    def _loop(self):
+        while True:
+            work = self._next()
+            if work is None:
+                return
+            QUEUE_WAIT_SECONDS.observe(work.priority, time.monotonic() - work.queued_at)
+            # skip work whose caller has already given up
+            if not work.future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = work.fn(*work.args, **work.kwargs)
+            except BaseException as e:
+                work.future.set_exception(e)
+            else:
+                work.future.set_result(result)
+            # drop references to the call's arguments (e.g. uploaded images) while idle
+            work = None
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+
+class Reservation:
+    """An admission slot held on an `InferenceExecutor` until `release` is called."""
+
+    def __init__(self, executor: InferenceExecutor, priority: str):
+        self._executor = executor
+        self.priority = priority
+        self._released = False
+
+    def submit(self, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Run `fn(*args, **kwargs)` on a worker thread under this reservation, in its priority class."""
+        if self._released:
+            raise RuntimeError("Reservation has been released.")
+        return self._executor._enqueue(_Work(fn, args, kwargs, self.priority, None))
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._executor._release()
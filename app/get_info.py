@@ -1,48 +1,136 @@
 import json
+import os
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Optional, Tuple
 
-def get_habitat_metadata(habitat_code):
+METADATA_PATH = "data/ukhab.json"
+
+# non-standard codes that sit at level 1 and have no parent in the hierarchy
+NON_STANDARD_CODES = ("sea", "montane")
+
+
+def build_hierarchies(metadata: dict) -> Dict[str, Tuple[MappingProxyType, ...]]:
     """
-    Load habitat metadata from a JSON file.
-    
+    Precompute the full habitat hierarchy for every code in the metadata.
+
     Returns:
-        dict: Parsed JSON data containing habitat metadata.
+        dict: habitat code -> tuple of read-only hierarchy levels, from the top level down to the code itself.
+    """
+    hierarchies = {}
+    for habitat_code, habitat in metadata.items():
+        # level override if habitat code is "sea" or "montane" (non-standard codes)
+        if habitat_code in NON_STANDARD_CODES:
+            hierarchies[habitat_code] = (
+                MappingProxyType({
+                    "uk_hab_level": 1,
+                    "code": habitat_code,
+                    "name": habitat["name"],
+                    "definition": ""
+                }),
+            )
+            continue
+
+        # get full habitat hierarchy, the ukhab level being the code length plus 1
+        primary_habitat_hierarchy = []
+        for i in range(1, len(habitat_code) + 1):
+            code_i = habitat_code[:i]
+            if code_i not in metadata:
+                raise ValueError(f"Habitat metadata has no entry for '{code_i}', the parent of '{habitat_code}'.")
+            habitat_i = metadata[code_i]
+            primary_habitat_hierarchy.append(
+                MappingProxyType({
+                    "uk_hab_level": i + 1,
+                    "code": code_i,
+                    "name": habitat_i["name"],
+                    "definition": habitat_i["definition"],
+                })
+            )
+        hierarchies[habitat_code] = tuple(primary_habitat_hierarchy)
+
+    return hierarchies
+
+
+class TaxonomyIndex:
+    """
+    Habitat metadata loaded once from a JSON file, with every hierarchy precomputed.
+
+    The file is reloaded if its modification time changes, checked at most once every
+    `check_interval_s` seconds so that lookups normally do no I/O.
+    """
+
+    def __init__(self, path: str = METADATA_PATH, check_interval_s: float = 5.0):
+        self.path = path
+        self.check_interval_s = check_interval_s
+        self._lock = threading.Lock()
+        self._mtime: Optional[float] = None
+        # incremented on every (re)load so callers can rebuild anything derived from the table
+        self.version = 0
+        self._checked_at = float("-inf")
+        self._metadata: Dict[str, MappingProxyType] = {}
+        self._hierarchies: Dict[str, Tuple[MappingProxyType, ...]] = {}
+
+    def load(self):
+        """Load (or reload) the metadata file and rebuild the hierarchy table."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path, "r") as file:
+                metadata = json.load(file)
+        except FileNotFoundError:
+            raise FileNotFoundError("Habitat metadata file not found.")
+        except json.JSONDecodeError:
+            raise ValueError("Error decoding habitat metadata JSON file.")
+
+        hierarchies = build_hierarchies(metadata)
+        with self._lock:
+            self._metadata = {code: MappingProxyType(dict(habitat)) for code, habitat in metadata.items()}
+            self._hierarchies = hierarchies
+            self._mtime = mtime
+            self._checked_at = time.monotonic()
+            self.version += 1
+
+    def hierarchy(self, habitat_code: str) -> Tuple[MappingProxyType, ...]:
+        """
+        Hierarchy for a habitat code, from the top level down to the code itself.
+
+        Raises:
+            KeyError: if the code is not in the metadata.
+        """
+        self._refresh()
+        return self._hierarchies[habitat_code]
+
+    def metadata(self) -> Dict[str, MappingProxyType]:
+        """Name and definition of every habitat code."""
+        self._refresh()
+        return self._metadata
+
+    def refresh(self):
+        """Reload the file if it has changed since it was last checked."""
+        self._refresh()
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._mtime is not None and now - self._checked_at < self.check_interval_s:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        self._checked_at = now
+        # keep serving the loaded table if the file is temporarily missing
+        if self._mtime is None or (mtime is not None and mtime != self._mtime):
+            self.load()
+
+
+taxonomy = TaxonomyIndex()
+
+
+def get_habitat_metadata(habitat_code):
     """
-    try:
-        with open("data/ukhab.json", "r") as file:
-            metadata = json.load(file)
-    except FileNotFoundError:
-        raise FileNotFoundError("Habitat metadata file not found.")
-    except json.JSONDecodeError:
-        raise ValueError("Error decoding habitat metadata JSON file.")
-
-    #ukhab level as the number of characters in the habitat code minus 1
-    ukhab_level= len(habitat_code)+1
-
-    # level override if habitat code is "sea" or "montane" (non-standard codes)
-    if habitat_code == "sea" or habitat_code == "montane":
-        primary_habitat_hierarchy = {
-                "uk_hab_level": 1,
-                "code": habitat_code,
-                "name": metadata[habitat_code]["name"],
-                "definition": ""
-        }
-        return primary_habitat_hierarchy
-
-    # get full habitat hierarchy
-    primary_habitat_hierarchy = []
-
-    for i in range(1, ukhab_level, 1):
-        code_i = habitat_code[:i]
-        habitat_i = metadata[code_i]
-        primary_habitat_hierarchy.append(
-            {
-                "uk_hab_level": i+1,
-                "code": code_i,
-                "name": habitat_i["name"],
-                "definition": habitat_i["definition"],
-            }
-        )
-
-    return primary_habitat_hierarchy
-    
+    Look up the habitat hierarchy for a UKHab code.
 
+    Returns:
+        tuple: read-only hierarchy levels (uk_hab_level, code, name, definition), from the top level down to the code itself.
+    """
+    return taxonomy.hierarchy(habitat_code)
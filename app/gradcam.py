@@ -0,0 +1,115 @@
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Sequence, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+
+class GradCAMEngine:
+    """
+    Grad-CAM for a timm Swin model, computed from the prediction forward pass itself.
+
+    A forward hook is registered once on the target layer (the final `norm`, whose
+    output is the channels-last feature map the classifier head pools). While
+    `capture` is active the hook keeps the batch's activations, and `maps` then
+    backpropagates only through the classifier head, from each requested image's
+    target, so no second forward pass through the backbone is needed. The same
+    activations are pooled into embeddings by `features`.
+
+    An image's target is its top class by default. A target can instead be given as
+    a function of the image's logits returning per-class offsets, -inf for classes
+    outside the target; the map then explains the logsumexp of the offset logits,
+    e.g. a habitat made up of several classes, each weighted by a request's evidence.
+
+    Args:
+        model: the eager model, used to run the classifier head with gradients.
+        prepared: the module the inference backend actually runs, if it is a copy of
+            the model (e.g. the int8 backend), so activations are captured from it.
+    """
+
+    def __init__(self, model: nn.Module, prepared: Optional[nn.Module] = None):
+        self.model = model
+        self._capturing = False
+        self._activations = None
+        source = prepared if isinstance(prepared, nn.Module) and hasattr(prepared, "norm") else model
+        # the inference backends don't expose a compiled/exported graph's layers, in
+        # which case nothing is captured and `maps` falls back to `forward_features`
+        self._handle = source.norm.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        if self._capturing:
+            self._activations = output.detach()
+
+    @contextmanager
+    def capture(self, enabled: bool = True):
+        """Keep the target layer's activations from forward passes run inside this block."""
+        self._capturing = enabled
+        self._activations = None
+        try:
+            yield
+        finally:
+            self._capturing = False
+
+    def features(self, batch: torch.Tensor, indices: Sequence[int]) -> torch.Tensor:
+        """
+        The target layer's activations (the backbone's output) for some of the images in
+        the last captured batch, e.g. to pool into embeddings.
+
+        Returns:
+            torch.Tensor: [len(indices), height, width, channels] activations.
+        """
+        index = torch.as_tensor(list(indices), dtype=torch.long)
+        if self._activations is None:
+            # not captured (compiled/exported backends), so run the backbone again for these images
+            self._capturing = False
+            with torch.no_grad():
+                return self.model.forward_features(batch[index])
+        return self._activations[index]
+
+    def maps(
+        self,
+        batch: torch.Tensor,
+        logits: torch.Tensor,
+        indices: Sequence[int],
+        targets: Optional[Sequence[Union[bool, Callable[[torch.Tensor], torch.Tensor]]]] = None
+    ) -> List[np.ndarray]:
+        """
+        Grad-CAM maps for some of the images in the last captured batch.
+
+        Args:
+            batch: the model input the activations were captured from.
+            logits: the logits of the whole batch.
+            indices: positions in the batch of the images to compute maps for.
+            targets: for each index, a function of the image's logits giving its target
+                as per-class offsets, or anything else for its top class.
+
+        Returns:
+            list: a (height, width) float32 map scaled to [0, 1] for each index, at the
+                resolution of the feature map.
+        """
+        index = torch.as_tensor(list(indices), dtype=torch.long)
+        activations = self.features(batch, indices)
+        self._activations = None
+
+        logits = logits[index].float()
+        # the top class has offset 0 and every other class -inf, so its score is its logit
+        offsets = torch.full_like(logits, -torch.inf).scatter_(1, logits.argmax(dim=1, keepdim=True), 0.0)
+        for row, target in enumerate(targets or ()):
+            if callable(target):
+                offsets[row] = target(logits[row])
+        activations = activations.float().requires_grad_()
+        with torch.enable_grad():
+            scores = torch.logsumexp(self.model.forward_head(activations) + offsets, dim=1)
+            (gradients,) = torch.autograd.grad(scores.sum(), activations)
+
+        with torch.no_grad():
+            # weight each channel by its mean gradient over the feature map (NHWC)
+            weights = gradients.mean(dim=(1, 2), keepdim=True)
+            cams = torch.relu((weights * activations).sum(dim=-1))
+            peak = cams.amax(dim=(1, 2), keepdim=True).clamp_min(1e-12)
+            cams = (cams / peak).numpy()
+        return list(cams)
+
+    def close(self):
+        self._handle.remove()
@@ -0,0 +1,87 @@
+import os
+import re
+import tempfile
+import time
+import uuid
+from typing import Optional, Tuple
+
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp"}
+_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class GradCAMStore:
+    """
+    Encoded Grad-CAM images kept on disk for a while, so they can be fetched separately
+    from the prediction instead of being inlined as base64.
+
+    Files live in a directory shared by all worker processes and are removed once they
+    are older than `ttl_s`.
+
+    Args:
+        directory: where to keep the images, by default a directory under the system temp dir.
+        ttl_s: how long an image can be fetched after it was stored.
+        image_format: format the images are encoded in, "png" or "webp".
+
+    Raises:
+        ValueError: if the image format cannot be served.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        ttl_s: float = 600.0,
+        cleanup_interval_s: float = 60.0,
+        image_format: str = "png"
+    ):
+        if image_format not in MEDIA_TYPES:
+            raise ValueError(f"Grad-CAM image format '{image_format}' is not supported. Must be one of {', '.join(MEDIA_TYPES)}.")
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "aihab-gradcam")
+        self.ttl_s = ttl_s
+        self.image_format = image_format
+        self.cleanup_interval_s = cleanup_interval_s
+        self._cleaned_at = 0.0
+
+    def put(self, image: bytes) -> str:
+        """
+        Store an image encoded in the store's format.
+
+        Returns:
+            str: the id to fetch it with.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self._cleanup()
+        image_id = uuid.uuid4().hex
+        path = os.path.join(self.directory, f"{image_id}.{self.image_format}")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as file:
+            file.write(image)
+        os.replace(tmp, path)
+        return image_id
+
+    def get(self, image_id: str) -> Optional[Tuple[bytes, str]]:
+        """The image's bytes and media type, or None if the id is unknown or has expired."""
+        if not _ID_PATTERN.match(image_id):
+            return None
+        for image_format, media_type in MEDIA_TYPES.items():
+            path = os.path.join(self.directory, f"{image_id}.{image_format}")
+            try:
+                if time.time() - os.stat(path).st_mtime > self.ttl_s:
+                    return None
+                with open(path, "rb") as file:
+                    return file.read(), media_type
+            except FileNotFoundError:
+                continue
+        return None
+
+    def _cleanup(self):
+        now = time.monotonic()
+        if now - self._cleaned_at < self.cleanup_interval_s:
+            return
+        self._cleaned_at = now
+        expired_before = time.time() - self.ttl_s
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < expired_before:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,396 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
+
+from app.encoding import JSON, encode
+from app.executor import InferenceExecutor, QueueFullError, Reservation
+from app.registry import ModelLoadError
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    completed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    runner TEXT,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    filename TEXT,
+    path TEXT,
+    result TEXT,
+    error TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, idx)
+);
+"""
+
+
+class JobStore:
+    """
+    Bulk classification jobs in SQLite, with each job's images spilled to files on disk.
+
+    The database and image files are shared by every worker process using the same
+    paths, and are durable, so jobs outlive a restart and resume from the first image
+    without a result.
+
+    Args:
+        path: SQLite database file.
+        spill_dir: directory holding a sub-directory of images for each job.
+    """
+
+    def __init__(self, path: str, spill_dir: str):
+        self.path = path
+        self.spill_dir = spill_dir
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(_SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    @contextmanager
+    def _transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        # one connection per process, used by one thread at a time; IMMEDIATE takes the
+        # write lock up front so concurrent claims from other processes queue behind it
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def create(self, params: list, images: Iterable[Tuple[Optional[str], Union[bytes, Exception]]]) -> str:
+        """
+        Spill a job's images to disk and queue it.
+
+        Args:
+            params: the prediction arguments after the images, as passed to `predict_habitat_batch`.
+            images: (filename, image bytes) pairs, or an exception in place of the bytes
+                for an upload that cannot be classified, which is recorded as failed.
+
+        Returns:
+            str: the job id.
+        """
+        job_id = uuid.uuid4().hex
+        directory = os.path.join(self.spill_dir, job_id)
+        os.makedirs(directory)
+        rows = []
+        try:
+            for index, (filename, image) in enumerate(images):
+                if isinstance(image, Exception):
+                    rows.append((job_id, index, filename, None, None, str(image), 1))
+                    continue
+                path = os.path.join(directory, str(index))
+                with open(path, "wb") as file:
+                    file.write(image)
+                rows.append((job_id, index, filename, path, None, None, 0))
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+
+        now = time.time()
+        failed = sum(1 for row in rows if row[6])
+        with self._transaction() as connection:
+            connection.executemany("INSERT INTO items (job_id, idx, filename, path, result, error, done) VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.execute(
+                "INSERT INTO jobs (id, status, params, total, failed, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, COMPLETED if failed == len(rows) else QUEUED, json.dumps(params), len(rows), failed, now, now)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """A job's status and progress, or None if there is no such job."""
+        with self._transaction() as connection:
+            row = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "total_images": row["total"],
+            "completed": row["completed"],
+            "failed": row["failed"],
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def results(self, job_id: str, offset: int, limit: int) -> List[dict]:
+        """
+        The finished items of a job from position `offset`, in upload order.
+
+        Stops before the first image still to be classified, so paging on from the last
+        index returned never skips an image that finishes later.
+        """
+        with self._transaction() as connection:
+            (first_pending,) = connection.execute(
+                "SELECT MIN(idx) FROM items WHERE job_id = ? AND done = 0 AND idx >= ?", (job_id, offset)
+            ).fetchone()
+            rows = connection.execute(
+                "SELECT idx, filename, result, error FROM items WHERE job_id = ? AND done = 1 AND idx >= ? AND idx < ? ORDER BY idx LIMIT ?",
+                (job_id, offset, first_pending if first_pending is not None else 2 ** 62, limit)
+            ).fetchall()
+        items = []
+        for row in rows:
+            item = {"index": row["idx"], "filename": row["filename"]}
+            if row["error"] is not None:
+                item["error"] = row["error"]
+            else:
+                item["result"] = json.loads(row["result"])
+            items.append(item)
+        return items
+
+    def delete(self, job_id: str) -> bool:
+        """
+        Delete a job, its results and its images. A runner working on it stops at its next commit.
+
+        Returns:
+            bool: whether the job existed.
+        """
+        with self._transaction() as connection:
+            deleted = connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount
+            connection.execute("DELETE FROM items WHERE job_id = ?", (job_id,))
+        shutil.rmtree(os.path.join(self.spill_dir, job_id), ignore_errors=True)
+        return bool(deleted)
+
+    def claim(self, runner: str, stale_s: float) -> Optional[Tuple[str, list]]:
+        """
+        Take the oldest queued job, or a running job whose runner has stopped heartbeating.
+
+        Returns:
+            tuple: the job id and its prediction arguments, or None if there is nothing to run.
+        """
+        now = time.time()
+        with self._transaction(immediate=True) as connection:
+            row = connection.execute(
+                "SELECT id, params, runner FROM jobs WHERE status = ? OR (status = ? AND heartbeat_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now - stale_s)
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                "UPDATE jobs SET status = ?, runner = ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                (RUNNING, runner, now, now, row["id"])
+            )
+        if row["runner"]:
+            logger.info("Resuming job %s.", row["id"])
+        return row["id"], json.loads(row["params"])
+
+    def pending(self, job_id: str) -> List[Tuple[int, str]]:
+        """(index, image path) of the images in a job still to be classified."""
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT idx, path FROM items WHERE job_id = ? AND done = 0 ORDER BY idx", (job_id,)).fetchall()
+        return [(row["idx"], row["path"]) for row in rows]
+
+    def record(self, job_id: str, runner: str, results: List[Tuple[int, Optional[str], Optional[str]]]) -> bool:
+        """
+        Save (index, result JSON, error) for some of a job's images and remove their files.
+
+        Returns:
+            bool: False if the job has been deleted or taken over by another runner, so work on it should stop.
+        """
+        now = time.time()
+        with self._transaction() as connection:
+            owned = connection.execute("SELECT 1 FROM jobs WHERE id = ? AND runner = ? AND status = ?", (job_id, runner, RUNNING)).fetchone()
+            if owned is None:
+                return False
+            connection.executemany(
+                "UPDATE items SET result = ?, error = ?, done = 1, path = NULL WHERE job_id = ? AND idx = ?",
+                [(result, error, job_id, index) for index, result, error in results]
+            )
+            failed = sum(1 for _, _, error in results if error is not None)
+            connection.execute(
+                "UPDATE jobs SET completed = completed + ?, failed = failed + ?, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                (len(results) - failed, failed, now, now, job_id)
+            )
+        for index, _, _ in results:
+            try:
+                os.remove(os.path.join(self.spill_dir, job_id, str(index)))
+            except FileNotFoundError:
+                pass
+        return True
+
+    def finish(self, job_id: str, runner: str, status: str, error: Optional[str] = None):
+        """Mark a job completed, failed, or back to queued (to be resumed later), if this runner still owns it."""
+        with self._transaction() as connection:
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, runner = NULL, updated_at = ? WHERE id = ? AND runner = ?",
+                (status, error, time.time(), job_id, runner)
+            )
+        if status != QUEUED:
+            shutil.rmtree(os.path.join(self.spill_dir, job_id), ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT status, COUNT(*) AS jobs, SUM(total - completed - failed) AS remaining FROM jobs GROUP BY status").fetchall()
+        return {
+            "jobs": {row["status"]: row["jobs"] for row in rows},
+            "images_remaining": sum(row["remaining"] or 0 for row in rows),
+        }
+
+
+class JobRunner:
+    """
+    Background threads that run queued jobs through `predict_batch` (`predict_habitat_batch`),
+    so job images share the model's batched forward passes with online requests. Each
+    result is stored as `serialise(result, *params)` gives it, JSON-encoded as is by default.
+
+    A job holds an admission slot of `executor` in the `priority` class while it runs,
+    and each step of `predict_batch` runs on one of its worker threads, as the steps
+    of a streamed `/predict/batch` do. While the executor is full no job is claimed.
+
+    Results are committed every `commit_every` images or `commit_interval_s` seconds,
+    which also serves as the job's heartbeat. A job left running by a process
+    that stopped is picked up again once its heartbeat is `stale_s` old; one stopped
+    cleanly is put back in the queue straight away.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        predict_batch: Callable[..., Iterator[Union[dict, Exception]]],
+        executor: InferenceExecutor,
+        priority: Optional[str] = None,
+        serialise: Optional[Callable[..., str]] = None,
+        workers: int = 1,
+        poll_interval_s: float = 1.0,
+        stale_s: float = 30.0,
+        commit_every: int = 16,
+        commit_interval_s: float = 5.0,
+    ):
+        self.store = store
+        self.predict_batch = predict_batch
+        self.executor = executor
+        self.priority = executor.check_priority(priority)
+        self.serialise = serialise or (lambda result, *params: encode(result, JSON).decode())
+        self.workers = workers
+        self.poll_interval_s = poll_interval_s
+        self.stale_s = stale_s
+        self.commit_every = commit_every
+        self.commit_interval_s = commit_interval_s
+        self.runner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-runner-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop after the images already queued for the model, leaving unfinished jobs queued."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                reservation = self.executor.reserve(self.priority)
+            except QueueFullError:
+                self._stop.wait(self.poll_interval_s)
+                continue
+            try:
+                try:
+                    claimed = self.store.claim(self.runner_id, self.stale_s)
+                except sqlite3.Error:
+                    logger.exception("Could not read the job queue.")
+                    claimed = None
+                if claimed is not None:
+                    self._run(reservation, *claimed)
+            finally:
+                reservation.release()
+            if claimed is None:
+                self._stop.wait(self.poll_interval_s)
+
+    def _run(self, reservation: Reservation, job_id: str, params: list):
+        pending = self.store.pending(job_id)
+
+        def images():
+            for _, path in pending:
+                try:
+                    with open(path, "rb") as file:
+                        yield file.read()
+                except OSError as e:
+                    yield ValueError(f"Image could not be read: {e}")
+
+        results = self.predict_batch(images(), *params)
+
+        def steps():
+            # each image's result comes from a step run on an inference worker
+            while True:
+                result = reservation.submit(next, results, None).result()
+                if result is None:
+                    return
+                yield result
+
+        batch = []
+        committed_at = time.monotonic()
+        try:
+            for (index, _), result in zip(pending, steps()):
+                if isinstance(result, Exception):
+                    batch.append((index, None, str(result)))
+                else:
+                    batch.append((index, self.serialise(result, *params), None))
+                if (
+                    len(batch) >= self.commit_every
+                    or time.monotonic() - committed_at >= self.commit_interval_s
+                    or self._stop.is_set()
+                ):
+                    if not self.store.record(job_id, self.runner_id, batch):
+                        return
+                    batch = []
+                    committed_at = time.monotonic()
+                    if self._stop.is_set():
+                        self.store.finish(job_id, self.runner_id, QUEUED)
+                        return
+            if batch and not self.store.record(job_id, self.runner_id, batch):
+                return
+            self.store.finish(job_id, self.runner_id, COMPLETED)
+        except ModelLoadError as e:
+            # not the job's fault; try again once the model may have loaded
+            logger.warning("Job %s waiting for the model: %s", job_id, e)
+            self.store.finish(job_id, self.runner_id, QUEUED)
+            self._stop.wait(e.retry_after_s)
+        except Exception as e:
+            logger.exception("Job %s failed.", job_id)
+            self.store.finish(job_id, self.runner_id, FAILED, str(e))
+        finally:
+            results.close()
@@ -0,0 +1,225 @@
+import threading
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from app.get_info import TaxonomyIndex, taxonomy
+
+# conversion from internal model label (numeric) to UKHab label (string), in model output order
+HABITAT_CODES = (
+    'u1', #'Urban'
+    'w1', # 'Broadleaved Mixed and Yew Woodland'
+    'w2', # 'Coniferous Woodland'
+    'sea', # Sea
+    'c1', #  Arable and Horticulture
+    'g4', # Improved Grassland
+    'g3', # Neutral Grassland
+    'g2', #  Calcareous Grassland
+    'g1', # Acid Grassland
+    'g1c', # Bracken
+    'h1', # Dwarf Shrub Heath
+    'f2', # Fen, Marsh, Swamp
+    'f1', # Bog
+    't1', # Littoral Rock
+    't2', # Littoral Sediment
+    'montane', #Montane
+    'r1', # Standing Open Waters and Canals
+    's1', # Inland Rock
+    's2', # Supra-littoral Rock
+    's3', # Supra-littoral Sediment
+)
+
+UKHAB_VERSION = "2.01"
+
+
+# UKHab levels a prediction can be requested at
+LEVELS = (1, 2, 3, 4, 5)
+
+
+class HabitatTree:
+    """
+    The habitats the model's classes belong to at every UKHab level, and the sparse
+    matrix that aggregates class probabilities up to them.
+
+    Nodes are the model's classes and all of their ancestors. For each level, each
+    class is assigned to its deepest ancestor at or above that level (the class itself
+    if it is there), or to the top of its hierarchy if even that is below the level,
+    e.g. bracken (`g1c`, level 4) is counted as acid grassland (`g1`) at level 3 and
+    as grassland (`g`) at level 2. A level's habitats partition the classes, so their
+    confidences sum to 1.
+
+    `aggregation` is a sparse 0/1 [rows, classes] matrix with one row per node (the
+    node and everything below it), then one block of rows per level, so a single
+    sparse matmul gives every confidence a response needs.
+    """
+
+    def __init__(self, codes: Sequence[str], taxonomy: TaxonomyIndex):
+        class_hierarchies = [taxonomy.hierarchy(code) for code in codes]
+        nodes: Dict[str, int] = {}
+        for hierarchy in class_hierarchies:
+            for entry in hierarchy:
+                nodes.setdefault(entry["code"], len(nodes))
+        self.codes = np.array(list(nodes), dtype=object)
+        hierarchies = [taxonomy.hierarchy(code) for code in self.codes]
+        self.levels = [hierarchy[-1]["uk_hab_level"] for hierarchy in hierarchies]
+        # node indices of each node's hierarchy, from the top level down to the node
+        self.hierarchy_nodes = [[nodes[entry["code"]] for entry in hierarchy] for hierarchy in hierarchies]
+
+        # rows for each node: the classes at or below it
+        rows, columns = [], []
+        for column, hierarchy in enumerate(class_hierarchies):
+            for entry in hierarchy:
+                rows.append(nodes[entry["code"]])
+                columns.append(column)
+
+        # then rows for each level: the classes assigned to each of its habitats
+        self.level_rows: Dict[int, slice] = {}
+        self.level_nodes: Dict[int, np.ndarray] = {}
+        for level in LEVELS:
+            assigned = {}
+            for column, hierarchy in enumerate(class_hierarchies):
+                above = [entry for entry in hierarchy if entry["uk_hab_level"] <= level]
+                node = nodes[(above[-1] if above else hierarchy[0])["code"]]
+                assigned.setdefault(node, []).append(column)
+            first = len(nodes) + sum(len(block) for block in self.level_nodes.values())
+            for row, level_columns in enumerate(assigned.values(), start=first):
+                rows += [row] * len(level_columns)
+                columns += level_columns
+            self.level_rows[level] = slice(first, first + len(assigned))
+            self.level_nodes[level] = np.array(list(assigned))
+
+        shape = (self.level_rows[LEVELS[-1]].stop, len(codes))
+        self.aggregation = torch.sparse_coo_tensor([rows, columns], torch.ones(len(rows)), shape, check_invariants=True).coalesce()
+
+        self.fragments = np.empty(len(self.codes), dtype=object)
+        for index, (code, hierarchy) in enumerate(zip(self.codes, hierarchies)):
+            self.fragments[index] = {
+                "code": code,
+                "name": hierarchy[-1]["name"],
+                "definition": hierarchy[-1]["definition"],
+                "primary_habitat_hierarchy": hierarchy,
+                "secondary_codes": (),
+                "ukhab_version": UKHAB_VERSION,
+            }
+
+
+class HabitatDecoder:
+    """
+    Map model outputs to UKHab habitat predictions at any level of the hierarchy.
+
+    The parts of each habitat prediction that depend only on the habitat (code, name,
+    definition and hierarchy) are built once and held in an array indexed by node of
+    the `HabitatTree`, so decoding a batch of top-k nodes is a single gather.
+    """
+
+    def __init__(self, codes: Sequence[str] = HABITAT_CODES, taxonomy: TaxonomyIndex = taxonomy):
+        self.class_codes = tuple(codes)
+        self.taxonomy = taxonomy
+        self._lock = threading.Lock()
+        self._tree = None
+        self._taxonomy_version = None
+
+    def tree(self) -> HabitatTree:
+        """The habitat tree, rebuilt if the habitat metadata has been reloaded."""
+        self.taxonomy.refresh()
+        with self._lock:
+            if self._tree is None or self._taxonomy_version != self.taxonomy.version:
+                self._tree = HabitatTree(self.class_codes, self.taxonomy)
+                self._taxonomy_version = self.taxonomy.version
+            return self._tree
+
+    def taxonomy_table(self) -> Dict[str, dict]:
+        """Name, definition and hierarchy of each habitat the model can predict at any level, by code."""
+        return {
+            fragment["code"]: {key: value for key, value in fragment.items() if key != "code"}
+            for fragment in self.tree().fragments
+        }
+
+    def top_k(self, probabilities: torch.Tensor, level: int, k: int) -> Tuple[torch.Tensor, np.ndarray, torch.Tensor]:
+        """
+        The k most likely habitats at a UKHab level, for a batch of class probabilities.
+
+        Confidences at every level come from one sparse matmul over the batch, so
+        coarser levels cost no extra inference.
+
+        Args:
+            probabilities: [batch, classes] softmax over the model's classes.
+            level: UKHab level (1-5) to rank habitats at.
+
+        Returns:
+            tuple: [batch, k] confidences sorted descending, [batch, k] node indices
+                matching them, and [batch, nodes] confidence of every node, for `decode`.
+        """
+        tree = self.tree()
+        level = min(max(level, LEVELS[0]), LEVELS[-1])
+        aggregated = torch.sparse.mm(tree.aggregation, probabilities.T).T
+        level_probs = aggregated[:, tree.level_rows[level]]
+        top_probs, positions = torch.topk(level_probs, k=min(k, level_probs.shape[1]), dim=1)
+        return top_probs, tree.level_nodes[level][positions.numpy()], aggregated[:, :len(tree.codes)]
+
+    def top_classes(self, probabilities: torch.Tensor, level: int) -> torch.Tensor:
+        """
+        Which of the model's classes are counted towards the most likely habitat at a
+        UKHab level (the first habitat `top_k` would give), for a batch of class probabilities.
+
+        Returns:
+            torch.Tensor: [batch, classes] boolean mask.
+        """
+        tree = self.tree()
+        level = min(max(level, LEVELS[0]), LEVELS[-1])
+        level_rows = tree.level_rows[level]
+        aggregated = torch.sparse.mm(tree.aggregation, probabilities.T).T
+        rows = aggregated[:, level_rows].argmax(dim=1) + level_rows.start
+        return tree.aggregation.index_select(0, rows).to_dense() > 0
+
+    def decode(self, top_probs: torch.Tensor, top_nodes: np.ndarray, node_probs: torch.Tensor, compact: bool = False) -> List[List[dict]]:
+        """
+        Build habitat predictions from the output of `top_k`.
+
+        Args:
+            top_probs: [batch, k] confidences, sorted descending along each row.
+            top_nodes: [batch, k] node indices matching `top_probs`.
+            node_probs: [batch, nodes] confidence of every node, reported on each level
+                of a prediction's hierarchy.
+            compact: only give each prediction's code, confidence, rank and level,
+                leaving names and hierarchies to `taxonomy_table`.
+
+        Returns:
+            list: for each image, its k habitat predictions ranked from 1.
+        """
+        tree = self.tree()
+        confidences = top_probs.tolist()
+        levels = [[tree.levels[node] for node in row] for row in top_nodes.tolist()]
+        if compact:
+            codes = tree.codes[top_nodes]
+            return [
+                [
+                    {"code": code, "confidence": confidence, "rank": rank, "predicted_level": level}
+                    for rank, (code, confidence, level) in enumerate(zip(row_codes, row_confidences, row_levels), start=1)
+                ]
+                for row_codes, row_confidences, row_levels in zip(codes, confidences, levels)
+            ]
+
+        fragments = tree.fragments[top_nodes]
+        return [
+            [
+                {
+                    **fragment,
+                    "primary_habitat_hierarchy": [
+                        {**entry, "confidence": row_node_probs[node]}
+                        for entry, node in zip(fragment["primary_habitat_hierarchy"], tree.hierarchy_nodes[index])
+                    ],
+                    "predicted_level": level,
+                    "confidence": confidence,
+                    "rank": rank,
+                }
+                for rank, (fragment, index, confidence, level) in enumerate(zip(row_fragments, row_nodes, row_confidences, row_levels), start=1)
+            ]
+            for row_fragments, row_nodes, row_confidences, row_levels, row_node_probs in zip(
+                fragments, top_nodes.tolist(), confidences, levels, node_probs.tolist()
+            )
+        ]
+
+
+decoder = HabitatDecoder()
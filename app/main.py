@@ -1,17 +1,199 @@
-from fastapi import FastAPI, File, UploadFile, Query, HTTPException
-from typing import Optional
-from app.models import PredictionResponse
-from app.predict import predict_habitat, load_model_hf, is_model_loaded
+import time
+# startup time spent importing the app and its dependencies, reported by /stats
+_imports_started = time.perf_counter()
+import asyncio
+import hashlib
+import json
+import logging
+from fastapi import FastAPI, File, UploadFile, Query, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple, Union
+from app.models import PredictionResponse, BatchPredictionItem, BatchPredictionResponse, PredictionStreamItem, EmbeddingResponse, BatchEmbeddingResponse
+from app.predict import predict_habitat, predict_habitat_batch, embed_image, embed_images, load_models, is_model_loaded, backend_name, registry, logits_cache, gradcam_store, location_prior, species_evidence, embedding_index
+from app.labels import decoder, UKHAB_VERSION
+from app.encoding import JSON, ENCODERS, encode, negotiate
+from app.metrics import CONTENT_TYPE, DEADLINE_DROPS, QUEUE_WAIT_SECONDS, REQUEST_SECONDS, STAGE_SECONDS, UPLOAD_REJECTIONS, StageTimings, render_metric
+from app.uploads import UploadRejected, check_image, read_image, reject, too_large
+from app.get_info import taxonomy
+from app.archives import is_archive, iter_archive_images
+from app.executor import DeadlineExceededError, InferenceExecutor, QueueFullError, Reservation
+from app.jobs import JobStore, JobRunner, COMPLETED, FAILED
+from app.config import INFERENCE_WORKERS, INFERENCE_QUEUE_SIZE, RETRY_AFTER_S, PRIORITY_WEIGHTS, DEFAULT_PRIORITY, BULK_PRIORITY, BATCH_MAX_IMAGES, UPLOAD_MAX_BYTES, JOBS_DB, JOBS_DIR, JOB_WORKERS, JOB_MAX_IMAGES, JOB_STALE_S
+from app.registry import ModelLoadError
 from contextlib import asynccontextmanager
 
+logger = logging.getLogger(__name__)
+
+# seconds spent in each phase of startup
+startup_timings = {"imports_s": time.perf_counter() - _imports_started}
+
+# Inference runs on a bounded pool of worker threads so the event loop stays free
+# for other requests (e.g. /status) while images are being classified, shared
+# between priority classes so bulk uploads don't hold up interactive requests
+inference_executor = InferenceExecutor(max_workers=INFERENCE_WORKERS, max_queue=INFERENCE_QUEUE_SIZE, weights=PRIORITY_WEIGHTS)
+
+def job_result(result: dict, *prediction_args) -> str:
+    """A job image's result as stored, in the shape `/predict/batch` gives its items' results."""
+    compact = prediction_args[-1]
+    if compact:
+        return encode(result, JSON).decode()
+    return PredictionResponse.model_validate(result).model_dump_json()
+
+# Bulk classification jobs, durable across restarts, run through the same batched model
+job_store = JobStore(JOBS_DB, JOBS_DIR)
+job_runner = JobRunner(
+    job_store,
+    predict_habitat_batch,
+    inference_executor,
+    priority=BULK_PRIORITY,
+    serialise=job_result,
+    workers=JOB_WORKERS,
+    stale_s=JOB_STALE_S
+)
+
+def check_model_version(model_version: Optional[str]):
+    """
+    Reject requests for unknown model versions before reading their uploads.
+
+    Raises:
+        HTTPException: 400 if the model version is not one of the configured versions.
+    """
+    try:
+        registry.resolve(model_version)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def check_neighbours(neighbours: int, model_version: Optional[str]):
+    """
+    Reject requests for similar references that the embedding index cannot answer.
+
+    Raises:
+        HTTPException: 400 if there is no index, or it was built with a different model version.
+    """
+    if neighbours:
+        try:
+            embedding_index.check(registry.resolve(model_version))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+def check_tiling(tiled: bool, tta: Optional[str], tile_map: bool, gradcam: bool, neighbours: int):
+    """
+    Reject tiling options without tiled inference, or combined with what it cannot provide.
+
+    Raises:
+        HTTPException: 400 if `tta` or `tile_map` is given without `tiled`, or `tiled` with Grad-CAM or similar references.
+    """
+    if not tiled:
+        if tta or tile_map:
+            raise HTTPException(status_code=400, detail="Parameters 'tta' and 'tile_map' need 'tiled' to be true.")
+    elif gradcam or neighbours:
+        raise HTTPException(status_code=400, detail="Tiled inference cannot be combined with 'gradcam' or 'neighbours'.")
+
+def request_schedule(request: Request, priority: Optional[str], deadline_ms: Optional[float], default_priority: str) -> Tuple[str, Optional[float]]:
+    """
+    The priority class and deadline (a `time.monotonic()` time) to schedule a request
+    with, from its `priority` and `deadline_ms` parameters or else its X-Priority and
+    X-Deadline-Ms headers. The deadline counts from when the request arrived, before
+    its body was read.
+
+    Raises:
+        HTTPException: 400 if the priority class is unknown or the deadline is not a positive number.
+    """
+    try:
+        priority = inference_executor.check_priority(priority or request.headers.get("x-priority") or default_priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if deadline_ms is None and "x-deadline-ms" in request.headers:
+        try:
+            deadline_ms = float(request.headers["x-deadline-ms"])
+        except ValueError:
+            deadline_ms = 0
+        if not deadline_ms > 0:
+            raise HTTPException(status_code=400, detail="Header 'X-Deadline-Ms' must be a positive number of milliseconds.")
+    if deadline_ms is None:
+        return priority, None
+    return priority, getattr(request.state, "received_at", time.monotonic()) + deadline_ms / 1000
+
+def response_media_type(request: Request) -> str:
+    """
+    The encoding the client asked for in its Accept header.
+
+    Raises:
+        HTTPException: 406 if none of the accepted media types is available.
+    """
+    media_type = negotiate(request.headers.get("accept"))
+    if media_type is None:
+        raise HTTPException(status_code=406, detail=f"Responses can be encoded as {', '.join(ENCODERS)}.")
+    return media_type
+
+def encoded_response(content, media_type: str, compact: bool, response_model, timings: Optional[StageTimings] = None) -> Response:
+    """
+    Encode a response, recording the time taken as its serialise stage.
+
+    Full JSON responses are validated against `response_model`, as FastAPI would;
+    compact and binary ones are encoded directly, skipping that validation.
+    """
+    timings = timings or StageTimings()
+    with timings.stage("serialise"):
+        if media_type == JSON and not compact:
+            body = response_model.model_validate(content).model_dump_json().encode()
+        else:
+            body = encode(content, media_type)
+    return Response(body, media_type=media_type)
+
+def model_unavailable_error(e: ModelLoadError) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail=str(e),
+        headers={"Retry-After": str(max(int(e.retry_after_s), 1))}
+    )
+
+def upload_rejected_error(e: UploadRejected) -> HTTPException:
+    return HTTPException(status_code=e.status_code, detail=str(e))
+
+def invalid_request_error(e: ValueError) -> HTTPException:
+    # e.g. an image that passed the upload checks but could not be decoded
+    if isinstance(e, UploadRejected):
+        return upload_rejected_error(e)
+    return HTTPException(status_code=400, detail=str(e))
+
+def deadline_exceeded_error() -> HTTPException:
+    return HTTPException(status_code=504, detail="Deadline passed before the request could be run.")
+
+def queue_full_error() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry later.",
+        headers={"Retry-After": str(RETRY_AFTER_S)}
+    )
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Load the model when the app starts
-    load_model_hf()
+    # Load the model and habitat metadata when the app starts
+    start = time.perf_counter()
+    try:
+        load_models()
+    except ModelLoadError:
+        # already logged; /status reports 503 until a later request loads the model
+        pass
+    startup_timings["models_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    taxonomy.load()
+    logits_cache.load()
+    location_prior.load()
+    species_evidence.load()
+    embedding_index.load()
+    startup_timings["metadata_s"] = time.perf_counter() - start
+    logger.info("Startup phases: %s", ", ".join(f"{phase} {seconds:.2f}" for phase, seconds in startup_timings.items()))
+    # run queued jobs, and resume any interrupted by a restart
+    job_runner.start()
     yield
-    # Cleanup if needed when the app stops (e.g., unload model, close connections)
-    # Currently, no cleanup is required for this simple example.
-    pass
+    # Leave unfinished jobs queued, then let queued requests and forward passes finish
+    job_runner.stop()
+    inference_executor.shutdown()
+    registry.close()
 
 # AI-HAB Habitat Classification API
 # This API provides endpoints for habitat classification using AI models.
@@ -21,6 +203,31 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    start = time.perf_counter()
+    # request deadlines count from here, before the body is read
+    request.state.received_at = time.monotonic()
+    response = await call_next(request)
+    # labelled by route template, so /jobs/{job_id} is one series
+    route = request.scope.get("route")
+    if route is not None:
+        REQUEST_SECONDS.observe(route.path, time.perf_counter() - start)
+    return response
+
+# room for the multipart boundaries and headers around an image of UPLOAD_MAX_BYTES
+_MULTIPART_OVERHEAD = 64 * 1024
+
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    # a single-image upload that is too large is refused from its Content-Length,
+    # before any of the body is read
+    if request.url.path in ("/predict", "/embed"):
+        length = request.headers.get("content-length", "")
+        if length.isdigit() and int(length) > UPLOAD_MAX_BYTES + _MULTIPART_OVERHEAD:
+            return JSONResponse({"detail": str(too_large())}, status_code=413)
+    return await call_next(request)
+
 # Base url endpoint
 @app.get("/")
 async def info():
@@ -34,14 +241,111 @@ async def info():
 @app.get("/status")
 async def status():
     if is_model_loaded():
-        return {"status": "ok", "model": "loaded"}
+        return {
+            "status": "ok",
+            "model": "loaded",
+            "backend": backend_name(),
+            "default_model_version": registry.default_version,
+            "loaded_model_versions": list(registry.stats()["resident"])
+        }
     else:
         raise HTTPException(status_code=503, detail="Model not loaded")
 
+#stats endpoint
+@app.get("/stats")
+async def stats():
+    # resident models and their realised batch sizes, for tuning AIHAB_BATCH_MAX_SIZE
+    # and AIHAB_BATCH_MAX_WAIT_MS, plus queue and cache hit/miss counters
+    return {
+        "startup": startup_timings,
+        "models": registry.stats(),
+        "executor": inference_executor.stats(),
+        "cache": logits_cache.stats(),
+        "jobs": job_store.stats()
+    }
+
+
+def metric_lines() -> List[str]:
+    """Stage and request latency histograms, and the current queue, model and cache state."""
+    executor = inference_executor.stats()
+    models = registry.stats()
+    cache = logits_cache.stats()
+    jobs = job_store.stats()
+
+    def state(version: str) -> str:
+        if version in models["resident"]:
+            return "loaded"
+        if version in models["loading"]:
+            return "loading"
+        if version in models["failed"]:
+            return "failed"
+        return "unloaded"
+
+    batching = {version: entry["batching"] for version, entry in models["resident"].items()}
+    lines = STAGE_SECONDS.render() + REQUEST_SECONDS.render() + UPLOAD_REJECTIONS.render()
+    lines += QUEUE_WAIT_SECONDS.render() + DEADLINE_DROPS.render()
+    lines += render_metric("aihab_inference_in_flight", "Requests running on inference workers.", "gauge", [({}, executor["in_flight"])])
+    lines += render_metric("aihab_inference_queued", "Requests waiting for an inference worker.", "gauge", [({}, executor["queued"])])
+    lines += render_metric(
+        "aihab_inference_queued_by_priority", "Requests waiting for an inference worker, by priority class.", "gauge",
+        [({"priority": priority}, stats["queued"]) for priority, stats in executor["priorities"].items()]
+    )
+    lines += render_metric("aihab_inference_rejected_total", "Requests rejected because the inference queue was full.", "counter", [({}, executor["rejected"])])
+    lines += render_metric("aihab_batcher_queued", "Images waiting for a batched forward pass.", "gauge", [({"model_version": version}, stats["queued"]) for version, stats in batching.items()])
+    lines += render_metric("aihab_batches_total", "Batched forward passes run.", "counter", [({"model_version": version}, stats["batches"]) for version, stats in batching.items()])
+    lines += render_metric("aihab_batch_images_total", "Images classified in batched forward passes.", "counter", [({"model_version": version}, stats["items"]) for version, stats in batching.items()])
+    lines += render_metric(
+        "aihab_model_state", "Load state of each configured model version (1 for its current state).", "gauge",
+        [({"model_version": version, "state": name}, float(state(version) == name)) for version in models["versions"] for name in ("loaded", "loading", "failed", "unloaded")]
+    )
+    lines += render_metric("aihab_model_resident_bytes", "Memory held by the weights of resident model versions.", "gauge", [({}, models["resident_bytes"])])
+    lines += render_metric("aihab_model_loads_total", "Model versions loaded.", "counter", [({}, models["loads"])])
+    lines += render_metric("aihab_model_evictions_total", "Model versions unloaded to stay within the memory budget.", "counter", [({}, models["evictions"])])
+    lines += render_metric("aihab_cache_entries", "Images in the logits cache.", "gauge", [({}, cache["entries"])])
+    lines += render_metric("aihab_cache_bytes", "Memory held by the logits cache.", "gauge", [({}, cache["bytes"])])
+    lines += render_metric("aihab_cache_hits_total", "Logits cache hits.", "counter", [({}, cache["hits"])])
+    lines += render_metric("aihab_cache_misses_total", "Logits cache misses.", "counter", [({}, cache["misses"])])
+    lines += render_metric("aihab_cache_evictions_total", "Images evicted from the logits cache.", "counter", [({}, cache["evictions"])])
+    lines += render_metric("aihab_jobs", "Bulk classification jobs by status.", "gauge", [({"status": status}, count) for status, count in jobs["jobs"].items()])
+    lines += render_metric("aihab_job_images_remaining", "Images still to be classified in bulk jobs.", "gauge", [({}, jobs["images_remaining"])])
+    return lines
+
+
+# metrics endpoint, in the Prometheus text format
+@app.get("/metrics")
+async def metrics():
+    # the job counts come from the database, so read them off the event loop
+    lines = await run_in_threadpool(metric_lines)
+    return Response("\n".join(lines) + "\n", media_type=CONTENT_TYPE)
+
+
+# habitat names, definitions and hierarchies, for clients of compact responses
+@app.get("/taxonomy")
+async def habitat_taxonomy(request: Request):
+    media_type = response_media_type(request)
+    body = encode({"ukhab_version": UKHAB_VERSION, "habitats": decoder.taxonomy_table()}, media_type)
+    # lets clients revalidate their copy cheaply
+    etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(body, media_type=media_type, headers={"ETag": etag, "Cache-Control": "public, max-age=3600"})
+
+
+# Grad-CAM images returned by /predict
+@app.get("/gradcam/{image_id}")
+async def gradcam_image(image_id: str):
+    image = gradcam_store.get(image_id)
+    if image is None:
+        raise HTTPException(status_code=404, detail="Grad-CAM image not found or expired.")
+    content, media_type = image
+    return Response(content, media_type=media_type)
+
 
 # Prediction endpoint
 @app.post("/predict", response_model=PredictionResponse)
 async def predict(
+    request: Request,
+
     # image file to classify
     file: UploadFile = File(..., description="Image of habitat for classification"),  # Image file to classify
 
@@ -59,24 +363,289 @@ async def predict(
     species_list: Optional[str] = Query(None, description="Comma-separated list of species names to aid classification (scientific names, underscore, species level, lower case e.g. 'quercus_robur,salix_alba')"), 
 
     # Other parameters for classification
-    model_version: Optional[str] = Query(None,description="Version of the computer vision model to use, if not supplied, defaults to the latest version"), 
+    model_version: Optional[str] = Query(None,description="Version of the computer vision model to use (one of those configured with AIHAB_MODELS), if not supplied, defaults to the latest version"), 
 
     # UK Habitat Classification parameters
     ukhab_predicted_level: int = Query(3, ge = 1, le =5, description="Level of the UK-Hab hierarchy to predict (1-5)"),
     ukhab_secondary_codes: Optional[bool] = Query(False, description="Whether to identify and return secondary codes for UK-Hab habitat classification"),  
 
     # gradcam
-    gradcam: Optional[bool] = Query(False, description="Whether to return a Grad-CAM visualization of the model's attention on the image")   
-    
+    gradcam: Optional[bool] = Query(False, description="Whether to return a Grad-CAM visualization of the model's attention on the image"),
+
+    # response
+    compact: Optional[bool] = Query(False, description="Whether to return only habitat codes and confidences (names and hierarchies are available from /taxonomy)"),
+    timings: Optional[bool] = Query(False, description="Whether to return the time spent in each stage of handling the request, in milliseconds"),
+
+    # similar reference survey images
+    neighbours: int = Query(0, ge=0, le=50, description="Number of the most similar reference survey images to return, from the embedding index (0 for none)"),
+
+    # tiled high-resolution inference
+    tiled: Optional[bool] = Query(False, description="Whether to classify overlapping model-sized tiles of the image at its own aspect ratio and average them, rather than the whole image squashed to the model input size"),
+    tta: Optional[str] = Query(None, regex="^(centre|flip)$", description="Test-time augmentation views to add to the tiles: 'centre' (the centre square of the image) or 'flip' (each tile's mirror image)"),
+    tile_map: Optional[bool] = Query(False, description="Whether to return the most likely habitat in each tile, as a coarse map of the image"),
+
+    # scheduling
+    priority: Optional[str] = Query(None, description="Priority class to schedule the request in (one of those configured with AIHAB_PRIORITY_WEIGHTS, default: AIHAB_DEFAULT_PRIORITY); also taken from the X-Priority header"),
+    deadline_ms: Optional[float] = Query(None, gt=0, description="Milliseconds after the request arrives by which it must have started, or it is dropped with 504; also taken from the X-Deadline-Ms header")
+
     ):
 
     # raise an error if the file is not an image
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Uploaded file must be an image.")
-    
-    image_bytes = await file.read()
-    result = predict_habitat(
-        image_bytes,
+    if not (file.content_type or "").startswith("image/"):
+        raise upload_rejected_error(reject("Uploaded file must be an image.", "content_type"))
+    check_model_version(model_version)
+    check_neighbours(neighbours, model_version)
+    check_tiling(tiled, tta, tile_map, gradcam, neighbours)
+    priority, deadline = request_schedule(request, priority, deadline_ms, DEFAULT_PRIORITY)
+    media_type = response_media_type(request)
+    stage_timings = StageTimings()
+
+    try:
+        # reject before buffering the upload if there is no room to run it
+        inference_executor.check_capacity()
+        with stage_timings.stage("upload_read"):
+            # stops reading as soon as the header or size shows the image will be rejected
+            image_bytes = await run_in_threadpool(read_image, file.file, file.size)
+        future = inference_executor.submit(
+            predict_habitat,
+            image_bytes,
+            date_time,
+            sensor_type,
+            habitat_classifications,
+            top_n,
+            latitude,
+            longitude,
+            species_list,
+            model_version,
+            ukhab_predicted_level,
+            ukhab_secondary_codes,
+            gradcam,
+            compact,
+            stage_timings,
+            neighbours,
+            tiled,
+            tta,
+            tile_map,
+            priority=priority,
+            deadline=deadline)
+    except QueueFullError:
+        raise queue_full_error()
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    except UploadRejected as e:
+        raise upload_rejected_error(e)
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except ModelLoadError as e:
+        raise model_unavailable_error(e)
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    except ValueError as e:
+        raise invalid_request_error(e)
+    if timings:
+        # serialisation is still to come, so is only reported in /metrics
+        result["timings_ms"] = stage_timings.as_ms()
+    return encoded_response(result, media_type, compact, PredictionResponse, stage_timings)
+
+
+def iter_uploaded_images(files: List[UploadFile], max_images: int = BATCH_MAX_IMAGES) -> Iterator[Tuple[Optional[str], Union[bytes, Exception]]]:
+    """
+    Read uploaded images, and the images inside uploaded archives, one at a time.
+
+    Files that are not images, images rejected by `read_image` or `check_image`
+    (too large, unidentifiable or with too many pixels), and archives that cannot be
+    read, are yielded with an exception in place of their bytes so they can be
+    reported per item.
+
+    Raises:
+        HTTPException: 413 once more than `max_images` images have been read.
+    """
+    count = 0
+    for upload in files:
+        if is_archive(upload.filename, upload.content_type):
+            try:
+                entries = iter_archive_images(upload.file, UPLOAD_MAX_BYTES)
+                for name, image_bytes in entries:
+                    count += 1
+                    if count > max_images:
+                        break
+                    if not isinstance(image_bytes, Exception):
+                        try:
+                            check_image(image_bytes)
+                        except UploadRejected as e:
+                            image_bytes = e
+                    yield name, image_bytes
+            except ValueError as e:
+                count += 1
+                yield upload.filename, e
+        elif not (upload.content_type or "").startswith("image/"):
+            count += 1
+            yield upload.filename, reject("Uploaded file must be an image or an archive of images.", "content_type")
+        else:
+            count += 1
+            start = time.perf_counter()
+            try:
+                image_bytes = read_image(upload.file, upload.size)
+            except UploadRejected as e:
+                image_bytes = e
+            STAGE_SECONDS.observe("upload_read", time.perf_counter() - start)
+            yield upload.filename, image_bytes
+
+        if count > max_images:
+            raise HTTPException(status_code=413, detail=f"A batch may contain at most {max_images} images.")
+
+
+def iter_upload_results(files: List[UploadFile], run: Callable[..., Iterator], *args) -> Iterator[dict]:
+    """
+    Run uploaded images and archives of images through `run` (`predict_habitat_batch`
+    or `embed_images`), yielding one item per image in upload order.
+
+    Each item has the image's index and filename, and either its `result` or an `error`.
+    """
+    filenames = []
+
+    def images():
+        for filename, image in iter_uploaded_images(files):
+            filenames.append(filename)
+            yield image
+
+    results = run(images(), *args)
+    try:
+        for index, result in enumerate(results):
+            item = {"index": index, "filename": filenames[index]}
+            if isinstance(result, Exception):
+                item["error"] = str(result)
+            else:
+                item["result"] = result
+            yield item
+    finally:
+        results.close()
+
+
+def iter_upload_predictions(files: List[UploadFile], *prediction_args) -> Iterator[dict]:
+    """Classify uploaded images and archives of images, yielding one item per image in upload order."""
+    return iter_upload_results(files, predict_habitat_batch, *prediction_args)
+
+
+def predict_uploads(files: List[UploadFile], *prediction_args) -> dict:
+    """
+    Classify a batch of uploaded images and archives of images.
+
+    Runs on an inference worker thread. Files that are not images, or archives that
+    cannot be read, are reported as per-item errors rather than failing the batch.
+    """
+    start_time = time.time()
+    items = list(iter_upload_predictions(files, *prediction_args))
+    return batch_summary(items, start_time)
+
+
+def embed_uploads(files: List[UploadFile], *embedding_args) -> dict:
+    """Embed a batch of uploaded images and archives of images, as `predict_uploads` classifies them."""
+    start_time = time.time()
+    items = list(iter_upload_results(files, embed_images, *embedding_args))
+    return batch_summary(items, start_time)
+
+
+def batch_summary(items: List[dict], start_time: float) -> dict:
+    elapsed = time.time() - start_time
+    failed = sum(1 for item in items if "error" in item)
+    return {
+        "items": items,
+        "total_images": len(items),
+        "succeeded": len(items) - failed,
+        "failed": failed,
+        "total_time_ms": int(elapsed * 1000),
+        "images_per_second": len(items) / elapsed if elapsed > 0 else 0.0
+    }
+
+
+async def stream_upload_predictions(reservation: Reservation, files: List[UploadFile], compact: bool, *prediction_args) -> AsyncIterator[str]:
+    """
+    Stream predictions for uploaded images as NDJSON, one line per image.
+
+    Each step of the prediction generator runs on an inference worker thread under
+    `reservation`, and the next step only starts once the previous line has been
+    sent, so memory stays flat however many images are uploaded. If the client
+    disconnects the response is cancelled, and the images still queued for the
+    model are dropped.
+    """
+    items = iter_upload_predictions(files, *prediction_args)
+    step = None
+    try:
+        while True:
+            step = reservation.submit(next, items, None)
+            try:
+                item = await asyncio.wrap_future(step)
+            except HTTPException as e:
+                # the status line has already been sent, so report the failure in the stream
+                yield json.dumps({"error": e.detail}) + "\n"
+                break
+            except Exception as e:
+                yield json.dumps({"error": str(e)}) + "\n"
+                break
+            if item is None:
+                break
+            if "result" in item and compact:
+                yield encode({**item["result"], "index": item["index"], "filename": item["filename"]}, JSON).decode() + "\n"
+                continue
+            if "result" in item:
+                line = PredictionStreamItem.model_validate({**item["result"], "index": item["index"], "filename": item["filename"]})
+            else:
+                line = BatchPredictionItem.model_validate(item)
+            yield line.model_dump_json(exclude_none=True) + "\n"
+    finally:
+        # close the generator once any step still running has finished, then free the slot
+        def close(_=None):
+            items.close()
+            reservation.release()
+        if step is None:
+            close()
+        else:
+            step.add_done_callback(close)
+
+
+# Batch prediction endpoint
+@app.post("/predict/batch", response_model=BatchPredictionResponse)
+async def predict_batch(
+    request: Request,
+
+    # image files, or zip/tar archives of images, to classify
+    files: List[UploadFile] = File(..., description="Images of habitats for classification, or zip/tar archives of images"),
+
+    # date and time of the image capture
+    date_time: Optional[str] = Query(None, description="Date and time of the image capture in ISO 8601 format (e.g., '2023-10-01T12:00:00Z')"),
+    sensor_type: Optional[str] = Query("app", description="Type of sensor used to capture the image (e.g., 'app', 'camera_trap')"),
+
+    # parameters for the prediction
+    habitat_classifications: str = Query("ukhab", regex="^(ukhab|eunis)$",description="Type of habitat classification to perform"), 
+    top_n: int = Query(3, ge=1,le=3, description="Number of top predictions (1-3)"), 
+
+    # supplementary parameters
+    latitude: Optional[float] = Query(None, ge=-90, le=90, description="Latitude between -90 and 90"),
+    longitude: Optional[float] = Query(None, ge=-180, le=180, description="Longitude between -180 and 180"),
+    species_list: Optional[str] = Query(None, description="Comma-separated list of species names to aid classification (scientific names, underscore, species level, lower case e.g. 'quercus_robur,salix_alba')"), 
+
+    # Other parameters for classification
+    model_version: Optional[str] = Query(None,description="Version of the computer vision model to use (one of those configured with AIHAB_MODELS), if not supplied, defaults to the latest version"), 
+
+    # UK Habitat Classification parameters
+    ukhab_predicted_level: int = Query(3, ge = 1, le =5, description="Level of the UK-Hab hierarchy to predict (1-5)"),
+    ukhab_secondary_codes: Optional[bool] = Query(False, description="Whether to identify and return secondary codes for UK-Hab habitat classification"),
+
+    # streaming
+    stream: Optional[bool] = Query(False, description="Whether to stream results as newline-delimited JSON, one line per image, as soon as each is classified"),
+
+    # response
+    compact: Optional[bool] = Query(False, description="Whether to return only habitat codes and confidences (names and hierarchies are available from /taxonomy)"),
+
+    # scheduling
+    priority: Optional[str] = Query(None, description="Priority class to schedule the request in (one of those configured with AIHAB_PRIORITY_WEIGHTS, default: AIHAB_BULK_PRIORITY); also taken from the X-Priority header"),
+    deadline_ms: Optional[float] = Query(None, gt=0, description="Milliseconds after the request arrives by which it must have started, or it is dropped with 504; also taken from the X-Deadline-Ms header")
+
+    ):
+
+    prediction_args = (
         date_time,
         sensor_type,
         habitat_classifications,
@@ -87,6 +656,246 @@ async def predict(
         model_version,
         ukhab_predicted_level,
         ukhab_secondary_codes,
-        gradcam)
-    
-    return result
\ No newline at end of file
+        compact
+    )
+    check_model_version(model_version)
+    priority, deadline = request_schedule(request, priority, deadline_ms, BULK_PRIORITY)
+
+    try:
+        if stream:
+            # hold a worker slot for the whole stream
+            reservation = inference_executor.reserve(priority, deadline)
+            return StreamingResponse(
+                stream_upload_predictions(reservation, files, compact, *prediction_args),
+                media_type="application/x-ndjson"
+            )
+
+        inference_executor.check_capacity()
+        media_type = response_media_type(request)
+        future = inference_executor.submit(predict_uploads, files, *prediction_args, priority=priority, deadline=deadline)
+    except QueueFullError:
+        raise queue_full_error()
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except ModelLoadError as e:
+        raise model_unavailable_error(e)
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    return encoded_response(result, media_type, compact, BatchPredictionResponse)
+
+
+# Embedding endpoint
+@app.post("/embed", response_model=EmbeddingResponse)
+async def embed(
+    request: Request,
+
+    # image file to embed
+    file: UploadFile = File(..., description="Image of habitat to embed"),
+
+    # Other parameters
+    model_version: Optional[str] = Query(None, description="Version of the computer vision model to use (one of those configured with AIHAB_MODELS), if not supplied, defaults to the latest version"),
+
+    # similar reference survey images
+    neighbours: int = Query(0, ge=0, le=50, description="Number of the most similar reference survey images to return, from the embedding index (0 for none)"),
+
+    # response
+    embedding: Optional[bool] = Query(True, description="Whether to return the embedding itself (e.g. leave it out when only similar references are wanted)"),
+    timings: Optional[bool] = Query(False, description="Whether to return the time spent in each stage of handling the request, in milliseconds"),
+
+    # scheduling
+    priority: Optional[str] = Query(None, description="Priority class to schedule the request in (one of those configured with AIHAB_PRIORITY_WEIGHTS, default: AIHAB_DEFAULT_PRIORITY); also taken from the X-Priority header"),
+    deadline_ms: Optional[float] = Query(None, gt=0, description="Milliseconds after the request arrives by which it must have started, or it is dropped with 504; also taken from the X-Deadline-Ms header")
+
+    ):
+
+    if not (file.content_type or "").startswith("image/"):
+        raise upload_rejected_error(reject("Uploaded file must be an image.", "content_type"))
+    check_model_version(model_version)
+    check_neighbours(neighbours, model_version)
+    priority, deadline = request_schedule(request, priority, deadline_ms, DEFAULT_PRIORITY)
+    media_type = response_media_type(request)
+    stage_timings = StageTimings()
+
+    try:
+        inference_executor.check_capacity()
+        with stage_timings.stage("upload_read"):
+            image_bytes = await run_in_threadpool(read_image, file.file, file.size)
+        future = inference_executor.submit(
+            embed_image, image_bytes, model_version, neighbours, embedding, stage_timings, priority=priority, deadline=deadline
+        )
+    except QueueFullError:
+        raise queue_full_error()
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    except UploadRejected as e:
+        raise upload_rejected_error(e)
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except ModelLoadError as e:
+        raise model_unavailable_error(e)
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    except ValueError as e:
+        raise invalid_request_error(e)
+    if timings:
+        result["timings_ms"] = stage_timings.as_ms()
+    return encoded_response(result, media_type, False, EmbeddingResponse, stage_timings)
+
+
+# Batch embedding endpoint
+@app.post("/embed/batch", response_model=BatchEmbeddingResponse)
+async def embed_batch(
+    request: Request,
+
+    # image files, or zip/tar archives of images, to embed
+    files: List[UploadFile] = File(..., description="Images of habitats to embed, or zip/tar archives of images"),
+
+    # Other parameters
+    model_version: Optional[str] = Query(None, description="Version of the computer vision model to use (one of those configured with AIHAB_MODELS), if not supplied, defaults to the latest version"),
+
+    # similar reference survey images
+    neighbours: int = Query(0, ge=0, le=50, description="Number of the most similar reference survey images to return for each image, from the embedding index (0 for none)"),
+
+    # response
+    embedding: Optional[bool] = Query(True, description="Whether to return the embeddings themselves (e.g. leave them out when only similar references are wanted)"),
+
+    # scheduling
+    priority: Optional[str] = Query(None, description="Priority class to schedule the request in (one of those configured with AIHAB_PRIORITY_WEIGHTS, default: AIHAB_BULK_PRIORITY); also taken from the X-Priority header"),
+    deadline_ms: Optional[float] = Query(None, gt=0, description="Milliseconds after the request arrives by which it must have started, or it is dropped with 504; also taken from the X-Deadline-Ms header")
+
+    ):
+
+    check_model_version(model_version)
+    check_neighbours(neighbours, model_version)
+    priority, deadline = request_schedule(request, priority, deadline_ms, BULK_PRIORITY)
+    media_type = response_media_type(request)
+
+    try:
+        inference_executor.check_capacity()
+        future = inference_executor.submit(embed_uploads, files, model_version, neighbours, embedding, priority=priority, deadline=deadline)
+    except QueueFullError:
+        raise queue_full_error()
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+
+    try:
+        result = await asyncio.wrap_future(future)
+    except ModelLoadError as e:
+        raise model_unavailable_error(e)
+    except DeadlineExceededError:
+        raise deadline_exceeded_error()
+    return encoded_response(result, media_type, False, BatchEmbeddingResponse)
+
+
+def job_status(job: dict) -> dict:
+    return {
+        **job,
+        "status_url": f"/jobs/{job['job_id']}",
+        "results_url": f"/jobs/{job['job_id']}/results"
+    }
+
+
+# Bulk classification job endpoints
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    # image files, or zip/tar archives of images, to classify
+    files: List[UploadFile] = File(..., description="Images of habitats for classification, or zip/tar archives of images"),
+
+    # date and time of the image capture
+    date_time: Optional[str] = Query(None, description="Date and time of the image capture in ISO 8601 format (e.g., '2023-10-01T12:00:00Z')"),
+    sensor_type: Optional[str] = Query("app", description="Type of sensor used to capture the image (e.g., 'app', 'camera_trap')"),
+
+    # parameters for the prediction
+    habitat_classifications: str = Query("ukhab", regex="^(ukhab|eunis)$",description="Type of habitat classification to perform"), 
+    top_n: int = Query(3, ge=1,le=3, description="Number of top predictions (1-3)"), 
+
+    # supplementary parameters
+    latitude: Optional[float] = Query(None, ge=-90, le=90, description="Latitude between -90 and 90"),
+    longitude: Optional[float] = Query(None, ge=-180, le=180, description="Longitude between -180 and 180"),
+    species_list: Optional[str] = Query(None, description="Comma-separated list of species names to aid classification (scientific names, underscore, species level, lower case e.g. 'quercus_robur,salix_alba')"), 
+
+    # Other parameters for classification
+    model_version: Optional[str] = Query(None,description="Version of the computer vision model to use (one of those configured with AIHAB_MODELS), if not supplied, defaults to the latest version"), 
+
+    # UK Habitat Classification parameters
+    ukhab_predicted_level: int = Query(3, ge = 1, le =5, description="Level of the UK-Hab hierarchy to predict (1-5)"),
+    ukhab_secondary_codes: Optional[bool] = Query(False, description="Whether to identify and return secondary codes for UK-Hab habitat classification"),
+
+    # response
+    compact: Optional[bool] = Query(False, description="Whether to return only habitat codes and confidences (names and hierarchies are available from /taxonomy)")
+
+    ):
+
+    prediction_args = [
+        date_time,
+        sensor_type,
+        habitat_classifications,
+        top_n,
+        latitude,
+        longitude,
+        species_list,
+        model_version,
+        ukhab_predicted_level,
+        ukhab_secondary_codes,
+        compact
+    ]
+    check_model_version(model_version)
+
+    # spill the images to disk off the event loop; nothing is held in memory
+    job_id = await run_in_threadpool(job_store.create, prediction_args, iter_uploaded_images(files, JOB_MAX_IMAGES))
+    return job_status(await run_in_threadpool(job_store.get, job_id))
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=60, description="Seconds to wait for the job to make progress or finish before answering (long polling)")
+    ):
+    job = await run_in_threadpool(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    # the job may be run by another worker process, so watch the database rather than the runner
+    deadline = time.monotonic() + wait
+    progress = (job["status"], job["completed"], job["failed"])
+    while job["status"] not in (COMPLETED, FAILED) and time.monotonic() < deadline:
+        await asyncio.sleep(min(0.5, deadline - time.monotonic()))
+        job = await run_in_threadpool(job_store.get, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Job not found.")
+        if (job["status"], job["completed"], job["failed"]) != progress:
+            break
+    return job_status(job)
+
+
+@app.get("/jobs/{job_id}/results")
+async def get_job_results(
+    request: Request,
+    job_id: str,
+    offset: int = Query(0, ge=0, description="Index of the first image to return"),
+    limit: int = Query(100, ge=1, le=1000, description="Maximum number of images to return")
+    ):
+    media_type = response_media_type(request)
+    job = await run_in_threadpool(job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    items = await run_in_threadpool(job_store.results, job_id, offset, limit)
+    content = {
+        **job_status(job),
+        "offset": offset,
+        "items": items,
+        # results are returned in upload order as they finish; the next page starts after the last one returned
+        "next_offset": items[-1]["index"] + 1 if items else offset
+    }
+    return Response(encode(content, media_type), media_type=media_type)
+
+
+@app.delete("/jobs/{job_id}", status_code=204)
+async def delete_job(job_id: str):
+    if not await run_in_threadpool(job_store.delete, job_id):
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return Response(status_code=204)
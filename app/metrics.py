@@ -0,0 +1,144 @@
+import math
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Tuple
+
+# seconds; from sub-millisecond stages (top-k, metadata lookup) up to slow forward passes
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Sample = Tuple[Dict[str, str], float]
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def _value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+def render_metric(name: str, help: str, kind: str, samples: Iterable[Sample]) -> List[str]:
+    """
+    Lines of the Prometheus text format for one gauge or counter.
+
+    Args:
+        kind: "gauge" or "counter".
+        samples: (labels, value) for each series of the metric.
+    """
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines += [f"{name}{_labels(labels)} {_value(value)}" for labels, value in samples]
+    return lines
+
+
+class Histogram:
+    """
+    A Prometheus histogram with a single label, e.g. the latency of each request stage.
+
+    Observations are counted per process; with several serving workers, each one
+    reports its own counts and Prometheus sums them.
+    """
+
+    def __init__(self, name: str, help: str, label: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label value -> (per-bucket counts, with +Inf last, and the sum of observations)
+        self._series: Dict[str, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, label_value: str, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._series.setdefault(label_value, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            series = {value: (list(counts), total[0]) for value, (counts, total) in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = {self.label: label_value, "le": _value(bound)}
+                lines.append(f"{self.name}_bucket{_labels(labels)} {cumulative}")
+            labels = _labels({self.label: label_value})
+            lines.append(f"{self.name}_sum{labels} {_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    """A Prometheus counter with a single label, e.g. rejected uploads by reason. Counted per process."""
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self._lock = threading.Lock()
+        self._values: Dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1.0):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0.0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return render_metric(self.name, self.help, "counter", [({self.label: label_value}, value) for label_value, value in values])
+
+
+# time spent in each stage of handling a request, per image
+STAGE_SECONDS = Histogram("aihab_stage_seconds", "Time spent in each stage of handling a request, per image.", "stage")
+# end-to-end time of each request, by endpoint
+REQUEST_SECONDS = Histogram("aihab_request_seconds", "Time taken to handle a request, until its response starts.", "endpoint")
+# uploads refused before being decoded, by reason
+UPLOAD_REJECTIONS = Counter("aihab_upload_rejections_total", "Uploaded images rejected before decoding, by reason.", "reason")
+# time each request waited for an inference worker, by priority class
+QUEUE_WAIT_SECONDS = Histogram("aihab_queue_wait_seconds", "Time requests waited for an inference worker, by priority class.", "priority")
+# requests dropped without being run because their deadline had passed, by priority class
+DEADLINE_DROPS = Counter("aihab_deadline_dropped_total", "Requests dropped unrun because their deadline had passed, by priority class.", "priority")
+
+
+class StageTimings:
+    """
+    Seconds spent in each stage of handling one image, recorded to `STAGE_SECONDS`
+    as each stage finishes.
+
+    Stages: upload_read, decode, queue_wait (for a batched forward pass), transform
+    (normalising into the batch), forward, embedding (pooling the backbone's output),
+    gradcam (the map's backward pass), gradcam_encode, neighbours (embedding index
+    search), prior (location prior lookup), species (species list evidence), topk
+    (softmax and top-k), metadata (habitat lookup) and serialise. Time from a forward
+    pass shared by several images is counted against each of them.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        STAGE_SECONDS.observe(name, seconds)
+
+    def as_ms(self) -> Dict[str, float]:
+        return {name: round(seconds * 1000, 3) for name, seconds in self.seconds.items()}
+
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 class UKHabSecondaryCode(BaseModel):
     name: str = Field(..., description="The name of the secondary habitat code")
@@ -26,11 +26,65 @@ class UKHab(BaseModel):
 class HabitatPrediction(BaseModel):
     ukhab: List[UKHab] = Field(..., description="List of top-ranked UKHab habitat predictions")
 
+class SimilarReference(BaseModel):
+    id: str = Field(..., description="Identifier of the reference survey image, e.g. its path when the index was built")
+    similarity: float = Field(..., description="Cosine similarity between the reference's embedding and the image's (-1 to 1)")
+    near_duplicate: bool = Field(..., description="Whether the similarity is high enough for the reference to be a near duplicate of the image")
+    metadata: dict = Field(default_factory=dict, description="Metadata recorded with the reference when the index was built, e.g. its habitat or quadrat")
+
+class TileMap(BaseModel):
+    rows: int = Field(..., description="Number of rows of tiles the image was cut into")
+    columns: int = Field(..., description="Number of columns of tiles the image was cut into")
+    codes: List[List[str]] = Field(..., description="Most likely habitat code in each tile at the requested UKHab level, row by row from the top left")
+    confidences: List[List[float]] = Field(..., description="Confidence (0-1) of each tile's habitat code, matching `codes`")
+
 class PredictionResponse(BaseModel):
     results: HabitatPrediction = Field(..., description="Container for the habitat prediction results")
     timestamp: str = Field(..., description="Timestamp of when the prediction was generated")
     inference_time_ms: int = Field(..., description="Time taken (in milliseconds) to generate the prediction")
     model_version: str = Field(..., description="Version of the machine learning model used for prediction")
     user_message: Optional[str] = Field(None, description="Optional message to the user, e.g., warnings or notes")
-    gradcam_image: Optional[str] = Field(None, description="Base64-encoded image of the Grad-CAM visualization, if generated")
-    request_metadata: dict = Field(..., description="Metadata about the prediction request, including parameters used")
\ No newline at end of file
+    gradcam_image: Optional[str] = Field(None, description="Base64-encoded image of the Grad-CAM visualization, if generated (full responses)")
+    gradcam_url: Optional[str] = Field(None, description="Path to fetch the Grad-CAM visualization from as a binary image, if generated (compact responses; expires after a while)")
+    request_metadata: dict = Field(..., description="Metadata about the prediction request, including parameters used")
+    timings_ms: Optional[Dict[str, float]] = Field(None, description="Time (in milliseconds) spent in each stage of handling the request, if requested")
+    similar: Optional[List[SimilarReference]] = Field(None, description="Most similar reference survey images, if requested with `neighbours`")
+    tile_map: Optional[TileMap] = Field(None, description="Coarse map of the most likely habitat in each tile, if requested with `tiled` and `tile_map`")
+class BatchPredictionItem(BaseModel):
+    index: int = Field(..., description="Position of the image in the batch (0-based)")
+    filename: Optional[str] = Field(None, description="Name of the uploaded file, or of the member within an uploaded archive")
+    result: Optional[PredictionResponse] = Field(None, description="Prediction for this image, if it could be classified")
+    error: Optional[str] = Field(None, description="Why this image could not be classified, if it failed")
+
+class BatchPredictionResponse(BaseModel):
+    items: List[BatchPredictionItem] = Field(..., description="One entry per image, in upload order")
+    total_images: int = Field(..., description="Number of images in the batch")
+    succeeded: int = Field(..., description="Number of images classified successfully")
+    failed: int = Field(..., description="Number of images that could not be classified")
+    total_time_ms: int = Field(..., description="Time taken (in milliseconds) to classify the whole batch")
+    images_per_second: float = Field(..., description="Throughput achieved for the batch")
+
+class PredictionStreamItem(PredictionResponse):
+    index: int = Field(..., description="Position of the image in the upload (0-based)")
+    filename: Optional[str] = Field(None, description="Name of the uploaded file, or of the member within an uploaded archive")
+
+class EmbeddingResponse(BaseModel):
+    embedding: Optional[List[float]] = Field(None, description="The image's pooled embedding (the input to the classifier head), unless left out")
+    inference_time_ms: int = Field(..., description="Time taken (in milliseconds) to embed the image")
+    model_version: str = Field(..., description="Version of the machine learning model that embedded the image")
+    similar: Optional[List[SimilarReference]] = Field(None, description="Most similar reference survey images, if requested with `neighbours`")
+    timings_ms: Optional[Dict[str, float]] = Field(None, description="Time (in milliseconds) spent in each stage of handling the request, if requested")
+
+class BatchEmbeddingItem(BaseModel):
+    index: int = Field(..., description="Position of the image in the batch (0-based)")
+    filename: Optional[str] = Field(None, description="Name of the uploaded file, or of the member within an uploaded archive")
+    result: Optional[EmbeddingResponse] = Field(None, description="Embedding of this image, if it could be embedded")
+    error: Optional[str] = Field(None, description="Why this image could not be embedded, if it failed")
+
+class BatchEmbeddingResponse(BaseModel):
+    items: List[BatchEmbeddingItem] = Field(..., description="One entry per image, in upload order")
+    total_images: int = Field(..., description="Number of images in the batch")
+    succeeded: int = Field(..., description="Number of images embedded successfully")
+    failed: int = Field(..., description="Number of images that could not be embedded")
+    total_time_ms: int = Field(..., description="Time taken (in milliseconds) to embed the whole batch")
+    images_per_second: float = Field(..., description="Throughput achieved for the batch")
@@ -1,165 +1,346 @@
+import base64
 import time
 from datetime import datetime
-from typing import List, Optional
-from torchvision.transforms import v2
+from collections import deque
+from concurrent.futures import Future, wait
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple, Union
 import torch
 import torch.nn.functional as F  # Add this import for F.softmax
 import os
-from huggingface_hub import login
-import timm
-from PIL import Image
-import io
-from app.get_info import get_habitat_metadata
+import numpy as np
 from dotenv import load_dotenv
-from app.produce_gradcam_image import produce_gradcam
+from app.cache import LogitsCache
+from app.embeddings import EmbeddingIndex
+from app.produce_gradcam_image import encode_gradcam
+from app.gradcam_store import GradCAMStore
+from app.labels import HabitatDecoder
+from app.metrics import StageTimings
+from app.priors import LocationPrior
+from app.species import SpeciesEvidence
+from app.registry import LoadedModel, ModelRegistry
+from app.preprocess import decode_image, decode_tiles
+from app.weights import create_model_local, is_local_model
+from app.config import (
+    BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS, CACHE_MAX_ENTRIES, CACHE_MAX_BYTES, CACHE_DIR, CHANNELS_LAST, INFERENCE_BACKEND,
+    MODEL_SOURCES, DEFAULT_MODEL_VERSION, MODEL_PREWARM, MAX_RESIDENT_MODELS, MAX_MODEL_MEMORY_MB, MODEL_RETRY_INTERVAL_S,
+    TORCH_THREADS, GRADCAM_FORMAT, GRADCAM_DIR, GRADCAM_TTL_S, LOCATION_PRIOR_DIR, LOCATION_PRIOR_WEIGHT,
+    SPECIES_EVIDENCE_DIR, SPECIES_EVIDENCE_WEIGHT, EMBEDDING_INDEX_DIR, EMBEDDING_INDEX_PROBES, NEAR_DUPLICATE_SIMILARITY,
+    TILE_MAX, TILE_OVERLAP
+)
 
 
 # Load environment variables from .env file
 load_dotenv()
 
-model = None
 device = torch.device("cpu")
+if TORCH_THREADS:
+    torch.set_num_threads(TORCH_THREADS)
 
-def load_model_hf():    
+# Encoded Grad-CAM images, served separately from /gradcam/{id}
+gradcam_store = GradCAMStore(GRADCAM_DIR, ttl_s=GRADCAM_TTL_S, image_format=GRADCAM_FORMAT)
+
+def login_hf():
+    """Log in to the Hugging Face Hub, if any model version is loaded from it and a token is set."""
     token = os.getenv("HF_AUTH_TOKEN", None)
-    model_name = "hf_hub:whitegivefive/aihab-supcon-swint-v0"     
-    global model
-    if model is None:
-        try:
-            login(token)
-            # Now create the model without explicitly passing the token.
-            model = timm.create_model(model_name, pretrained=True,cache_dir = "data/models")
-            model.to(device)
-            model.eval()
-            return "Logged in successfully and model loaded."
-        except Exception as e:
-            return f"Error loading model: {str(e)}"
-        
+    if token and not all(is_local_model(source) for source in MODEL_SOURCES.values()):
+        from huggingface_hub import login
+        login(token)
+
+def create_model(source: str) -> torch.nn.Module:
+    """
+    Load an eager fp32 model, ready for inference.
+
+    Args:
+        source: a local directory with `config.json` and `model.safetensors`, loaded
+            memory-mapped without network access, or a timm model name such as
+            `hf_hub:<repo>` (downloaded to data/models on first use).
+    """
+    if is_local_model(source):
+        model = create_model_local(source)
+    else:
+        import timm
+        # uses the token from login_hf(), if one was given
+        model = timm.create_model(source, pretrained=True,cache_dir = "data/models")
+    model.to(device)
+    memory_format = torch.channels_last if CHANNELS_LAST else torch.contiguous_format
+    model.to(memory_format=memory_format)
+    model.eval()
+    return model
+
+# Model versions, each with its own backend, batcher and input buffer once loaded.
+# Images from concurrent requests for the same version share batched forward passes.
+registry = ModelRegistry(
+    MODEL_SOURCES,
+    DEFAULT_MODEL_VERSION,
+    create_model,
+    backend=INFERENCE_BACKEND,
+    batch_size=BATCH_MAX_SIZE,
+    max_wait_ms=BATCH_MAX_WAIT_MS,
+    channels_last=CHANNELS_LAST,
+    max_resident=MAX_RESIDENT_MODELS,
+    max_bytes=MAX_MODEL_MEMORY_MB * 1024 * 1024,
+    retry_interval_s=MODEL_RETRY_INTERVAL_S,
+)
+
+def load_models():
+    """
+    Log in to the Hub if needed and load the AIHAB_MODEL_PREWARM versions, at startup.
+
+    Raises:
+        ModelLoadError: if a version could not be loaded.
+    """
+    login_hf()
+    registry.prewarm(MODEL_PREWARM)
+
 def is_model_loaded() -> bool:
-    return model is not None
+    return registry.is_loaded()
 
-# Define preprocessing pipeline for images
-transform = v2.Compose([
-    v2.Resize((384, 384)),
-    v2.ToTensor(),
-    v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
+def backend_name() -> Optional[str]:
+    """Name of the inference backend of the default model version, once it is loaded."""
+    entry = registry.peek()
+    return entry.backend.name if entry is not None else None
 
-#predict habitat
-def predict_habitat(
-    image_bytes: bytes,
-    date_time: Optional[str],
-    sensor_type: Optional[str],
-    habitat_classifications: str,
-    top_n: int,
+# Logits of recently seen images, so retried uploads skip the model
+logits_cache = LogitsCache(max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES, persist_dir=CACHE_DIR)
+
+# How likely each class is at a latitude and longitude, loaded at startup if configured
+location_prior = LocationPrior(LOCATION_PRIOR_DIR, LOCATION_PRIOR_WEIGHT)
+# How likely each class is given the species recorded with an image, loaded at startup if configured
+species_evidence = SpeciesEvidence(SPECIES_EVIDENCE_DIR, SPECIES_EVIDENCE_WEIGHT)
+# Embeddings of reference survey images, to look up those similar to an uploaded image
+embedding_index = EmbeddingIndex(EMBEDDING_INDEX_DIR, EMBEDDING_INDEX_PROBES, NEAR_DUPLICATE_SIMILARITY)
+
+def class_evidence(
     latitude: Optional[float],
     longitude: Optional[float],
     species_list: Optional[str],
-    model_version: Optional[str],
+    timings: Optional[StageTimings] = None
+) -> Optional[torch.Tensor]:
+    """The per-class log evidence of a request's location and species list, or None if it has none."""
+    timings = timings or StageTimings()
+    with timings.stage("prior"):
+        log_prior = location_prior.log_prior(latitude, longitude)
+    with timings.stage("species"):
+        log_likelihood = species_evidence.log_likelihood(species_list)
+    if log_likelihood is None:
+        return log_prior
+    return log_likelihood if log_prior is None else log_prior + log_likelihood
+
+def request_logits(
+    image_bytes: bytes,
+    entry: LoadedModel,
+    image: Optional[np.ndarray] = None,
+    gradcam: Union[bool, Callable[[torch.Tensor], torch.Tensor]] = False,
+    timings: Optional[StageTimings] = None,
+    embedding: bool = False
+) -> Future:
+    """
+    Get a model's logits for an image, from the cache or from the model's next batched forward pass.
+
+    Args:
+        entry: the loaded model version to run.
+        image: the already decoded image, if the caller has it.
+        gradcam: also compute a Grad-CAM map, for the image's top class or the target
+            given by a function of its logits (see `gradcam_target`). This needs the
+            forward pass's activations, so the cache is not consulted.
+        timings: where to record the time spent decoding and in the batched forward pass.
+        embedding: also pool the forward pass's features into the image's embedding,
+            so the cache is not consulted either.
+
+    Returns:
+        Future: resolved with the image's logits, or with `(logits, Grad-CAM map or None,
+            embedding or None)` if `gradcam` or `embedding` is set.
+    """
+    extras = bool(gradcam) or embedding
+    key = logits_cache.key(image_bytes, entry.cache_namespace)
+    logits = None if extras else logits_cache.get(key)
+    if logits is not None:
+        future = Future()
+        future.set_result(logits)
+        return future
+
+    timings = timings or StageTimings()
+    if image is None:
+        with timings.stage("decode"):
+            image = preprocess_image(image_bytes)
+    future = entry.submit(image, gradcam, timings, embedding)
+
+    def store(done: Future):
+        if not done.cancelled() and done.exception() is None:
+            result = done.result()
+            logits_cache.put(key, result[0] if extras else result)
+    future.add_done_callback(store)
+    return future
+
+def request_tiled_logits(
+    image_bytes: bytes,
+    entry: LoadedModel,
+    tta: Optional[str] = None,
+    tile_logits: bool = False,
+    timings: Optional[StageTimings] = None
+) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[int, int]]]:
+    """
+    Get a model's logits for an image from overlapping tiles of it (see `decode_tiles`),
+    run together in the model's batched forward passes and averaged. Blocks until done.
+
+    Args:
+        entry: the loaded model version to run.
+        tta: test-time augmentation views to add to the tiles, None, "centre" or "flip".
+        tile_logits: also return each tile's own logits (averaged with its mirror
+            image with "flip"), so the cache is not consulted.
+        timings: where to record the time spent decoding and in the batched forward passes.
+
+    Returns:
+        tuple: the image's logits, and the [rows * columns, classes] logits of its
+            tiles in row-major order and the grid's (rows, columns), or None for both
+            unless `tile_logits` is set.
+
+    Raises:
+        ValueError: if the bytes cannot be decoded as an image.
+    """
+    # the tiles depend on the tiling settings as well as the image
+    key = logits_cache.key(image_bytes, f"{entry.cache_namespace}/tiles-{TILE_MAX}-{TILE_OVERLAP}-{tta}")
+    logits = None if tile_logits else logits_cache.get(key)
+    if logits is not None:
+        return logits, None, None
+
+    timings = timings or StageTimings()
+    with timings.stage("decode"):
+        views, grid = decode_tiles(image_bytes, TILE_MAX, TILE_OVERLAP, tta)
+    futures = entry.submit_views(views, timings)
+    view_logits = torch.stack([future.result() for future in futures])
+    logits = view_logits.mean(dim=0)
+    logits_cache.put(key, logits)
+    if not tile_logits:
+        return logits, None, None
+
+    rows, columns = grid
+    if tta == "flip":
+        # each tile is followed by its mirror image
+        return logits, view_logits.view(rows * columns, 2, -1).mean(dim=1), grid
+    return logits, view_logits[:rows * columns], grid
+
+def tile_class_map(
+    tile_logits: torch.Tensor,
+    grid: Tuple[int, int],
     ukhab_predicted_level: int,
-    ukhab_secondary_codes: Optional[bool],
-    gradcam: Optional[bool] = False
+    decoder: HabitatDecoder,
+    log_prior: Optional[torch.Tensor] = None
 ) -> dict:
-    
-    start_time = time.time()
-
-    #validate inputs
-    if habitat_classifications not in ["ukhab", "eunis"]:
-        raise ValueError("Invalid habitat classification type. Must be 'ukhab' or 'eunis'.")
-    
-    if habitat_classifications not in ["ukhab"]:
-        raise ValueError("UK-Hab is the only habitat classification supported by AI-Hab currently. Parameter 'habitat_classifications' must be 'ukhab'.")
-    
-    load_model_hf()
-
-    global model
-    if model is None:
-        raise  RuntimeError("Model is not loaded")
-    model_version = "default"
-
-    # conversion from internal model label (numeric) to UKHab label (string)    
-    labels = {
-        'u1': 0, #'Urban'
-        'w1': 1, # 'Broadleaved Mixed and Yew Woodland'
-        'w2': 2, # 'Coniferous Woodland'
-        'sea': 3, # Sea
-        'c1': 4,#  Arable and Horticulture
-        'g4': 5,# Improved Grassland
-        'g3': 6, # Neutral Grassland
-        'g2': 7, #  Calcareous Grassland
-        'g1': 8, # Acid Grassland
-        'g1c': 9, # Bracken
-        'h1': 10, # Dwarf Shrub Heath
-        'f2': 11, # Fen, Marsh, Swamp
-        'f1': 12, # Bog
-        't1': 13, # Littoral Rock
-        't2': 14, # Littoral Sediment
-        'montane': 15, #Montane
-        'r1': 16, # Standing Open Waters and Canals
-        's1': 17, # Inland Rock
-        's2': 18, # Supra-littoral Rock
-        's3': 19 # Supra-littoral Sediment
+    """The most likely habitat at a UKHab level in each tile of an image, as rows of codes and confidences."""
+    if log_prior is not None:
+        tile_logits = tile_logits + log_prior
+    top_probs, top_nodes, _ = decoder.top_k(F.softmax(tile_logits, dim=1), ukhab_predicted_level, 1)
+    rows, columns = grid
+    return {
+        "rows": rows,
+        "columns": columns,
+        "codes": decoder.tree().codes[top_nodes[:, 0]].reshape(rows, columns).tolist(),
+        "confidences": top_probs[:, 0].view(rows, columns).tolist(),
     }
 
-    # make model prediction
-    # Preprocess the image
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    image = transform(image).unsqueeze(0)  # Add batch dimension
+def gradcam_target(
+    ukhab_predicted_level: int,
+    decoder: HabitatDecoder,
+    log_prior: Optional[torch.Tensor] = None
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    The Grad-CAM target of an image, as a function of its logits: the top habitat as
+    reported by `top_habitats`, after the request's evidence and at its UKHab level.
+
+    The target's classes are offset by their evidence and the rest by -inf, so the map
+    explains the logsumexp of the offset logits over the habitat's classes, which for
+    a habitat of one class with no evidence is that class's logit.
+    """
+    def target(logits: torch.Tensor) -> torch.Tensor:
+        offsets = torch.zeros_like(logits) if log_prior is None else log_prior.to(logits.dtype)
+        probabilities = F.softmax((logits + offsets).unsqueeze(0), dim=1)
+        classes = decoder.top_classes(probabilities, ukhab_predicted_level)[0]
+        return offsets.masked_fill(~classes, -torch.inf)
+    return target
 
-    with torch.no_grad():
-        output = model(image)
+def top_habitats(
+    logits: torch.Tensor,
+    top_n: int,
+    ukhab_predicted_level: int,
+    decoder: HabitatDecoder,
+    compact: bool = False,
+    timings: Optional[StageTimings] = None,
+    log_prior: Optional[torch.Tensor] = None
+) -> List[dict]:
+    """
+    Ranked top-n habitat predictions at a UKHab level from an image's logits.
 
-    # Compute probabilities using softmax
-    probabilities = F.softmax(output, dim=1)
-    # Get the top 3 predictions
-    top_probs, top_indices = torch.topk(probabilities, k=top_n, dim=1)
+    Args:
+        log_prior: per-class evidence (from `class_evidence`) added to the logits
+            before the softmax, so the probabilities are reweighted by it.
+    """
+    timings = timings or StageTimings()
+    return top_habitats_batch(logits.unsqueeze(0), top_n, ukhab_predicted_level, decoder, compact, [timings], log_prior)[0]
 
-    # Squeeze the batch dimension and convert to Python lists
-    top_probs = top_probs.squeeze(0).tolist()
-    top_indices = top_indices.squeeze(0).tolist()
-    # Convert indices to UKHab labels
-    top_labels = [list(labels.keys())[index] for index in top_indices]
+def top_habitats_batch(
+    logits: torch.Tensor,
+    top_n: int,
+    ukhab_predicted_level: int,
+    decoder: HabitatDecoder,
+    compact: bool = False,
+    timings: Optional[List[StageTimings]] = None,
+    log_prior: Optional[torch.Tensor] = None
+) -> List[List[dict]]:
+    """
+    Ranked top-n habitat predictions at a UKHab level for a batch of images' [batch, classes]
+    logits, with one softmax, top-k and decode for the whole batch.
 
+    Args:
+        timings: each image's stage timings; time spent on the batch is counted against each.
+        log_prior: per-class evidence (from `class_evidence`) added to every image's logits.
+    """
+    start = time.perf_counter()
+    if log_prior is not None:
+        logits = logits + log_prior
+    probabilities = F.softmax(logits, dim=1)
+    # Aggregate them up the habitat hierarchy and get the top n at the requested level,
+    # already sorted by confidence (descending)
+    top_probs, top_nodes, node_probs = decoder.top_k(probabilities, ukhab_predicted_level, top_n)
+    ranked = time.perf_counter()
 
+    # Convert nodes to ranked UKHab habitat predictions
+    habitats = decoder.decode(top_probs, top_nodes, node_probs, compact)
+    decoded = time.perf_counter()
+    for image_timings in timings or ():
+        image_timings.add("topk", ranked - start)
+        image_timings.add("metadata", decoded - ranked)
+    return habitats
 
-    if gradcam:
-        cam_base64 = produce_gradcam(
-            model=model,
-            image=image,
-        )
-
-    # Create a list of habitat predictions
-    habitats = []
-
-    for i in range(top_n):
-        overall_code = top_labels[i]
-
-        # Get habitat metadata
-        hierarchy = get_habitat_metadata(overall_code)
-        overall_name = hierarchy[-1]["name"]
-        prob = top_probs[i]
-
-        habitat = {
-            "predicted_level": ukhab_predicted_level,
-            "confidence":  prob, # Confidence score for the prediction 
-            "code": overall_code,
-            "name": overall_name,
-            "definition": hierarchy[-1]["definition"],
-            "primary_habitat_hierarchy": hierarchy,
-            "secondary_codes": [],
-            "ukhab_version": "2.01"
-        }
+def validate_request(habitat_classifications: str):
+    if habitat_classifications not in ["ukhab", "eunis"]:
+        raise ValueError("Invalid habitat classification type. Must be 'ukhab' or 'eunis'.")
+    
+    if habitat_classifications not in ["ukhab"]:
+        raise ValueError("UK-Hab is the only habitat classification supported by AI-Hab currently. Parameter 'habitat_classifications' must be 'ukhab'.")
 
-        habitats.append(habitat)
+def preprocess_image(image_bytes: bytes) -> np.ndarray:
+    """
+    Decode an image at the model input size, ready to be normalised into a batch.
 
-    # Sort by confidence (descending)
-    habitats.sort(key=lambda x: x["confidence"], reverse=True)
-    # Add rank field (1-based index)
-    for idx, h in enumerate(habitats, start=1):
-        h["rank"] = idx
+    Raises:
+        ValueError: if the bytes cannot be decoded as an image.
+    """
+    return decode_image(image_bytes)
 
-    #--------------------
-    request_metadata = {
+def build_request_metadata(
+    habitat_classifications: str,
+    date_time: Optional[str],
+    sensor_type: Optional[str],
+    top_n: int,
+    latitude: Optional[float],
+    longitude: Optional[float],
+    species_list: Optional[str],
+    model_version: str,
+    ukhab_predicted_level: int,
+    ukhab_secondary_codes: Optional[bool]
+) -> dict:
+    return {
         "habitat_classifications": habitat_classifications,
         "date_time": date_time,
         "sensor_type": sensor_type,
@@ -172,8 +353,33 @@ def predict_habitat(
         "ukhab_secondary_codes": ukhab_secondary_codes
     }
 
-    #generate response
-    response = {
+def build_response(
+    habitats: List[dict],
+    start_time: float,
+    model_version: str,
+    request_metadata: dict,
+    gradcam_image: Optional[str] = None,
+    gradcam_url: Optional[str] = None,
+    compact: bool = False,
+    similar: Optional[List[dict]] = None,
+    tile_map: Optional[dict] = None
+) -> dict:
+    if compact:
+        # codes and confidences only; names and hierarchies come from /taxonomy
+        response = {
+            "results": {
+                "ukhab": habitats
+            },
+            "inference_time_ms": int((time.time() - start_time) * 1000),
+            "model_version": model_version,
+            "gradcam_url": gradcam_url
+        }
+        if similar is not None:
+            response["similar"] = similar
+        if tile_map is not None:
+            response["tile_map"] = tile_map
+        return response
+    return {
         "results": {
             "ukhab": habitats
         },
@@ -181,8 +387,314 @@ def predict_habitat(
         "inference_time_ms": int((time.time() - start_time) * 1000),
         "model_version": model_version,
         "user_message": "In development, use with caution.",
-        "gradcam_image": cam_base64 if gradcam else None,
-        "request_metadata": request_metadata
+        "gradcam_image": gradcam_image,
+        "gradcam_url": gradcam_url,
+        "request_metadata": request_metadata,
+        "similar": similar,
+        "tile_map": tile_map
     }
 
-    return response
\ No newline at end of file
+#predict habitat
+def predict_habitat(
+    image_bytes: bytes,
+    date_time: Optional[str],
+    sensor_type: Optional[str],
+    habitat_classifications: str,
+    top_n: int,
+    latitude: Optional[float],
+    longitude: Optional[float],
+    species_list: Optional[str],
+    model_version: Optional[str],
+    ukhab_predicted_level: int,
+    ukhab_secondary_codes: Optional[bool],
+    gradcam: Optional[bool] = False,
+    compact: Optional[bool] = False,
+    timings: Optional[StageTimings] = None,
+    neighbours: int = 0,
+    tiled: bool = False,
+    tta: Optional[str] = None,
+    tile_map: bool = False
+) -> dict:
+    
+    start_time = time.time()
+    # time spent in each stage, for /metrics and optionally the response
+    timings = timings or StageTimings()
+
+    #validate inputs
+    validate_request(habitat_classifications)
+    
+    # evidence from the request's location and species list, reweighting the logits
+    log_prior = class_evidence(latitude, longitude, species_list, timings)
+
+    # load the requested model version if it is not already resident, and keep it
+    # running (even if evicted) until the image's logits are back
+    with registry.use(model_version) as entry:
+        model_version = entry.version
+
+        # make model prediction
+        # Decode the image (only needed up front for Grad-CAM, otherwise the cache may answer)
+        image = None
+        if gradcam:
+            with timings.stage("decode"):
+                image = preprocess_image(image_bytes)
+            # the map explains the habitat the response reports, not the model's raw top class
+            gradcam = gradcam_target(ukhab_predicted_level, entry.decoder, log_prior)
+
+        # similar references are looked up from the embedding of the same forward pass
+        if neighbours:
+            embedding_index.check(model_version)
+
+        cam = embedding = tile_logits = None
+        if tiled:
+            # the image's tiles share the batched forward passes, and their logits are averaged
+            logits, tile_logits, grid = request_tiled_logits(image_bytes, entry, tta, tile_map, timings)
+        else:
+            # Wait for the image's logits, from the cache or the next batched forward pass
+            result = request_logits(image_bytes, entry, image, gradcam, timings, embedding=bool(neighbours)).result()
+            logits, cam, embedding = result if gradcam or neighbours else (result, None, None)
+    habitats = top_habitats(logits, top_n, ukhab_predicted_level, entry.decoder, compact, timings, log_prior)
+    class_map = None
+    if tile_logits is not None:
+        with timings.stage("topk"):
+            class_map = tile_class_map(tile_logits, grid, ukhab_predicted_level, entry.decoder, log_prior)
+
+    cam_base64 = None
+    cam_url = None
+    if gradcam:
+        # the map comes from the prediction's own forward pass; only encoding it is left
+        with timings.stage("gradcam_encode"):
+            cam_image = encode_gradcam(cam, image)
+            # full responses carry the image inline; compact ones link to it
+            if compact:
+                cam_url = f"/gradcam/{gradcam_store.put(cam_image)}"
+            else:
+                cam_base64 = base64.b64encode(cam_image).decode('utf-8')
+
+    similar = None
+    if neighbours:
+        with timings.stage("neighbours"):
+            similar = embedding_index.neighbours(embedding.unsqueeze(0), neighbours)[0]
+
+    #--------------------
+    request_metadata = build_request_metadata(
+        habitat_classifications,
+        date_time,
+        sensor_type,
+        top_n,
+        latitude,
+        longitude,
+        species_list,
+        model_version,
+        ukhab_predicted_level,
+        ukhab_secondary_codes)
+
+    #generate response
+    return build_response(habitats, start_time, model_version, request_metadata, cam_base64, cam_url, compact, similar, class_map)
+
+#predict habitat for many images
+def predict_habitat_batch(
+    images: Iterable[Union[bytes, Exception]],
+    date_time: Optional[str],
+    sensor_type: Optional[str],
+    habitat_classifications: str,
+    top_n: int,
+    latitude: Optional[float],
+    longitude: Optional[float],
+    species_list: Optional[str],
+    model_version: Optional[str],
+    ukhab_predicted_level: int,
+    ukhab_secondary_codes: Optional[bool],
+    compact: Optional[bool] = False,
+    max_in_flight: int = BATCH_MAX_SIZE * 2
+) -> Iterator[Union[dict, Exception]]:
+    """
+    Predict habitats for many images, sharing batched forward passes.
+
+    Images are decoded and queued for the model while earlier ones are still being
+    classified, with at most `max_in_flight` preprocessed images held at once, so
+    memory use does not grow with the number of images. An exception in place of
+    an image's bytes is passed straight through as that image's result. Closing the
+    generator early cancels the images still waiting for the model.
+
+    Yields:
+        for each image, in order, its prediction response or the exception that stopped it being classified.
+    """
+    validate_request(habitat_classifications)
+
+    with registry.use(model_version) as entry:
+        model_version = entry.version
+
+        request_metadata = build_request_metadata(
+            habitat_classifications,
+            date_time,
+            sensor_type,
+            top_n,
+            latitude,
+            longitude,
+            species_list,
+            model_version,
+            ukhab_predicted_level,
+            ukhab_secondary_codes)
+
+        # every image in the batch was taken at the same location, with the same species recorded
+        log_prior = class_evidence(latitude, longitude, species_list)
+
+        def finish(group: List[tuple]) -> List[Union[dict, Exception]]:
+            results = []
+            for _, _, future in group:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+            # the images that finished together are ranked and decoded together
+            classified = [index for index, result in enumerate(results) if not isinstance(result, Exception)]
+            if classified:
+                habitats = top_habitats_batch(
+                    torch.stack([results[index] for index in classified]),
+                    top_n,
+                    ukhab_predicted_level,
+                    entry.decoder,
+                    compact,
+                    [group[index][1] for index in classified],
+                    log_prior)
+                for index, image_habitats in zip(classified, habitats):
+                    results[index] = build_response(image_habitats, group[index][0], model_version, request_metadata, compact=compact)
+            return results
+
+        def finished() -> List[tuple]:
+            """The oldest pending image, once it has been classified, and those after it that already have been."""
+            wait([pending[0][2]])
+            group = [pending.popleft()]
+            while pending and pending[0][2].done():
+                group.append(pending.popleft())
+            return group
+
+        pending = deque()
+        try:
+            for image_bytes in images:
+                start_time = time.time()
+                timings = StageTimings()
+                try:
+                    if isinstance(image_bytes, Exception):
+                        raise image_bytes
+                    future = request_logits(image_bytes, entry, timings=timings)
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                pending.append((start_time, timings, future))
+
+                if len(pending) >= max_in_flight:
+                    yield from finish(finished())
+
+            while pending:
+                yield from finish(finished())
+        finally:
+            # stop any work still queued if the caller has gone away
+            for _, _, future in pending:
+                future.cancel()
+
+def build_embedding_response(
+    embedding: Optional[torch.Tensor],
+    start_time: float,
+    model_version: str,
+    similar: Optional[List[dict]] = None
+) -> dict:
+    return {
+        "embedding": embedding.tolist() if embedding is not None else None,
+        "inference_time_ms": int((time.time() - start_time) * 1000),
+        "model_version": model_version,
+        "similar": similar
+    }
+
+#embed an image
+def embed_image(
+    image_bytes: bytes,
+    model_version: Optional[str],
+    neighbours: int = 0,
+    include_embedding: bool = True,
+    timings: Optional[StageTimings] = None
+) -> dict:
+    """
+    The pooled embedding of an image (the classifier head's input), and optionally the
+    `neighbours` most similar references in the embedding index.
+
+    Raises:
+        ValueError: if neighbours are asked for without an index built with the model version.
+    """
+    start_time = time.time()
+    timings = timings or StageTimings()
+
+    with registry.use(model_version) as entry:
+        model_version = entry.version
+        if neighbours:
+            embedding_index.check(model_version)
+
+        _, _, embedding = request_logits(image_bytes, entry, timings=timings, embedding=True).result()
+    similar = None
+    if neighbours:
+        with timings.stage("neighbours"):
+            similar = embedding_index.neighbours(embedding.unsqueeze(0), neighbours)[0]
+    return build_embedding_response(embedding if include_embedding else None, start_time, model_version, similar)
+
+#embed many images
+def embed_images(
+    images: Iterable[Union[bytes, Exception]],
+    model_version: Optional[str],
+    neighbours: int = 0,
+    include_embedding: bool = True,
+    max_in_flight: int = BATCH_MAX_SIZE * 2
+) -> Iterator[Union[dict, Exception]]:
+    """
+    Embed many images, sharing batched forward passes, as `predict_habitat_batch` does.
+
+    Similar references are looked up for up to `BATCH_MAX_SIZE` images at a time, with
+    one search of the index.
+
+    Yields:
+        for each image, in order, its embedding response or the exception that stopped it being embedded.
+    """
+    with registry.use(model_version) as entry:
+        model_version = entry.version
+        if neighbours:
+            embedding_index.check(model_version)
+
+        def finish(group: List[tuple]) -> List[Union[dict, Exception]]:
+            results = []
+            for start_time, future in group:
+                try:
+                    results.append((start_time, future.result()[2]))
+                except Exception as e:
+                    results.append(e)
+            embedded = [result for result in results if not isinstance(result, Exception)]
+            similar = [None] * len(embedded)
+            if neighbours and embedded:
+                similar = embedding_index.neighbours(torch.stack([embedding for _, embedding in embedded]), neighbours)
+            similar = iter(similar)
+            return [
+                result if isinstance(result, Exception)
+                else build_embedding_response(result[1] if include_embedding else None, result[0], model_version, next(similar))
+                for result in results
+            ]
+
+        pending = deque()
+        try:
+            for image_bytes in images:
+                start_time = time.time()
+                try:
+                    if isinstance(image_bytes, Exception):
+                        raise image_bytes
+                    future = request_logits(image_bytes, entry, timings=StageTimings(), embedding=True)
+                except Exception as e:
+                    future = Future()
+                    future.set_exception(e)
+                pending.append((start_time, future))
+
+                if len(pending) >= max_in_flight:
+                    yield from finish([pending.popleft() for _ in range(min(BATCH_MAX_SIZE, len(pending)))])
+
+            while pending:
+                yield from finish([pending.popleft() for _ in range(min(BATCH_MAX_SIZE, len(pending)))])
+        finally:
+            # stop any work still queued if the caller has gone away
+            for _, future in pending:
+                future.cancel()
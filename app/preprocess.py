@@ -0,0 +1,222 @@
+import io
+import math
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image, UnidentifiedImageError
+
+from app.config import MAX_IMAGE_PIXELS
+
+# PIL refuses to open images with more than twice this many pixels (decompression bombs)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# model input size (height, width)
+IMAGE_SIZE = (384, 384)
+
+# test-time augmentation views that can be added to the tiles of `decode_tiles`
+TTA_MODES = (None, "centre", "flip")
+
+# ImageNet normalisation used when the model was trained
+MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# normalise uint8 pixels as pixels * SCALE - SHIFT, i.e. (pixels / 255 - MEAN) / STD
+_SCALE = (1 / (255 * STD)).reshape(3, 1, 1)
+_SHIFT = (MEAN / STD).reshape(3, 1, 1)
+_SCALE_HWC = torch.from_numpy(_SCALE.reshape(3).copy())
+_SHIFT_HWC = torch.from_numpy(_SHIFT.reshape(3).copy())
+
+
+def _decode(image_bytes: bytes, size: Tuple[int, int]) -> Image.Image:
+    """Decode an image in RGB at `size` (height, width), decoding JPEGs at a reduced scale where possible."""
+    height, width = size
+    try:
+        image = Image.open(io.BytesIO(image_bytes))
+        # checked from the header, before anything is decoded
+        if image.width * image.height > MAX_IMAGE_PIXELS:
+            raise ValueError(f"Image has more than the limit of {MAX_IMAGE_PIXELS} pixels.")
+        if image.format == "JPEG":
+            image.draft("RGB", (width, height))
+        image = image.convert("RGB")
+        return image.resize((width, height), Image.BILINEAR, reducing_gap=3.0)
+    except Image.DecompressionBombError:
+        raise ValueError(f"Image has more than the limit of {MAX_IMAGE_PIXELS} pixels.")
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("Could not decode image.")
+
+
+def decode_image(image_bytes: bytes, size: Tuple[int, int] = IMAGE_SIZE) -> np.ndarray:
+    """
+    Decode an image straight to the model input size.
+
+    JPEGs are decoded by libjpeg at a reduced scale (1/2, 1/4 or 1/8) that is still at
+    least as large as `size`, so a 12-48 MP photo never has its full resolution
+    decoded. Other formats are decoded in full and reduced by an integer factor
+    before the final resize.
+
+    Returns:
+        np.ndarray: uint8 pixels of shape (height, width, 3).
+
+    Raises:
+        ValueError: if the bytes cannot be decoded as an image, or it has more than
+            `MAX_IMAGE_PIXELS` pixels.
+    """
+    return np.asarray(_decode(image_bytes, size))
+
+
+def tile_layout(width: int, height: int, max_tiles: int, overlap: float = 0.25, tile: int = IMAGE_SIZE[0]) -> Tuple[int, int, int, int]:
+    """
+    The finest grid of overlapping square tiles, at most `max_tiles` of them, that covers
+    an image at its own aspect ratio.
+
+    The image is scaled so that its short side is covered by as many tiles as fit
+    within `max_tiles`, without being enlarged beyond its own resolution, and the
+    long side by as many as it needs. An image too elongated for even one row of
+    tiles within the cap is squashed along its long side to fit.
+
+    Returns:
+        tuple: (width, height) to scale the image to, and the (rows, columns) of tiles.
+    """
+    stride = tile * (1 - overlap)
+    short, long = min(width, height), max(width, height)
+
+    def span(count: int) -> float:
+        return tile + (count - 1) * stride
+
+    def count(length: float) -> int:
+        return max(1, math.ceil((length - tile) / stride - 1e-6) + 1)
+
+    # (short side, long side, tiles across the short side, tiles along the long side)
+    layout = None
+    across = 1
+    while across == 1 or span(across) <= short:
+        along = count(span(across) * long / short)
+        if across * along > max_tiles:
+            break
+        layout = (span(across), span(across) * long / short, across, along)
+        across += 1
+    if layout is None:
+        layout = (tile, span(max_tiles), 1, max_tiles)
+
+    short_side, long_side, across, along = layout
+    if width >= height:
+        return round(long_side), round(short_side), across, along
+    return round(short_side), round(long_side), along, across
+
+
+def decode_tiles(
+    image_bytes: bytes,
+    max_tiles: int,
+    overlap: float = 0.25,
+    tta: Optional[str] = None,
+    size: Tuple[int, int] = IMAGE_SIZE,
+) -> Tuple[List[np.ndarray], Tuple[int, int]]:
+    """
+    Decode an image as overlapping model-sized tiles, instead of squashing it to the
+    model input size, plus optional test-time augmentation views.
+
+    The image is decoded once at the scale chosen by `tile_layout`, and the tiles are
+    views into it, spread evenly so that the first and last of each row and column
+    touch the image's edges. With `tta="centre"` the centre square of the image, at
+    the model input size, is added after the tiles. With `tta="flip"` each tile is
+    followed by its mirror image, and the grid is chosen for half of `max_tiles`, so
+    the total stays within `max_tiles`.
+
+    Returns:
+        tuple: the uint8 (height, width, 3) views, tiles in row-major order (each
+            followed by its mirror image with "flip"), and the grid's (rows, columns).
+
+    Raises:
+        ValueError: as `decode_image`, or if `tta` is not None, "centre" or "flip".
+    """
+    if tta not in TTA_MODES:
+        raise ValueError(f"Unknown test-time augmentation '{tta}'. Must be one of {', '.join(mode for mode in TTA_MODES if mode)}.")
+    budget = max_tiles // 2 if tta == "flip" else max_tiles - (tta == "centre")
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as header:
+            width, height = header.size
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("Could not decode image.")
+    width, height, rows, columns = tile_layout(width, height, max(budget, 1), overlap, size[0])
+    image = _decode(image_bytes, (height, width))
+    pixels = np.asarray(image)
+
+    tile_height, tile_width = size
+    tops = np.linspace(0, height - tile_height, rows).round().astype(int) if rows > 1 else [max((height - tile_height) // 2, 0)]
+    lefts = np.linspace(0, width - tile_width, columns).round().astype(int) if columns > 1 else [max((width - tile_width) // 2, 0)]
+    views = []
+    for top in tops:
+        for left in lefts:
+            view = pixels[top:top + tile_height, left:left + tile_width]
+            views.append(view)
+            if tta == "flip":
+                views.append(np.ascontiguousarray(view[:, ::-1]))
+    if tta == "centre":
+        side = min(width, height)
+        box = ((width - side) // 2, (height - side) // 2, (width + side) // 2, (height + side) // 2)
+        views.append(np.asarray(image.resize((tile_width, tile_height), Image.BILINEAR, box=box)))
+    return views, (rows, columns)
+
+
+def normalize_into(pixels: np.ndarray, out: np.ndarray):
+    """
+    Normalise uint8 (height, width, 3) pixels into a float32 (3, height, width) array in place.
+
+    The uint8 -> float32 conversion is fused into the scaling, so no intermediate
+    arrays are allocated.
+    """
+    np.multiply(pixels.transpose(2, 0, 1), _SCALE, out=out)
+    np.subtract(out, _SHIFT, out=out)
+
+
+def normalize_into_channels_last(pixels: np.ndarray, out: torch.Tensor):
+    """
+    Normalise uint8 (height, width, 3) pixels into a float32 (height, width, 3) tensor in place.
+
+    Used for channels-last batches, where each image's slot is laid out as
+    (height, width, channel) in memory and the pixels can be copied without a transpose.
+    """
+    out.copy_(torch.from_numpy(pixels))
+    out.mul_(_SCALE_HWC).sub_(_SHIFT_HWC)
+
+
+def to_tensor(pixels: np.ndarray) -> torch.Tensor:
+    """Normalised float32 (3, height, width) tensor for a single decoded image."""
+    out = np.empty((3,) + pixels.shape[:2], dtype=np.float32)
+    normalize_into(pixels, out)
+    return torch.from_numpy(out)
+
+
+class BatchBuffer:
+    """
+    Preallocated model input tensor that decoded images are normalised into.
+
+    Each image is normalised straight into its slot of the buffer, so a forward pass
+    needs no per-image tensors, no `torch.stack` and no new batch allocation. The
+    returned tensor is a view into the buffer, so it is only valid until the next call
+    to `fill`; use one buffer per thread running the model.
+
+    Args:
+        channels_last: lay the batch out in channels-last memory format, to match a
+            model converted with `model.to(memory_format=torch.channels_last)`.
+    """
+
+    def __init__(self, max_batch_size: int, size: Tuple[int, int] = IMAGE_SIZE, channels_last: bool = False):
+        self.max_batch_size = max_batch_size
+        self.size = size
+        self.channels_last = channels_last
+        memory_format = torch.channels_last if channels_last else torch.contiguous_format
+        self._buffer = torch.empty((max_batch_size, 3) + tuple(size), dtype=torch.float32, memory_format=memory_format)
+
+    def fill(self, images: Sequence[np.ndarray]) -> torch.Tensor:
+        if len(images) > self.max_batch_size:
+            raise ValueError(f"Batch of {len(images)} images is larger than the buffer ({self.max_batch_size}).")
+        if self.channels_last:
+            for index, pixels in enumerate(images):
+                normalize_into_channels_last(pixels, self._buffer[index].permute(1, 2, 0))
+        else:
+            out = self._buffer.numpy()
+            for index, pixels in enumerate(images):
+                normalize_into(pixels, out[index])
+        return self._buffer[:len(images)]
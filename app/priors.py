@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+import torch
+
+from app.labels import HABITAT_CODES
+
+logger = logging.getLogger(__name__)
+
+GRID_FILENAME = "grid.npy"
+GRID_CONFIG_FILENAME = "grid.json"
+
+
+class LocationPrior:
+    """
+    How much more or less likely each model class is in each cell of a latitude/longitude
+    grid over Great Britain than overall, memory-mapped from a directory built by
+    `python -m app.build_location_prior`.
+
+    The grid holds float16 log ratios log(p(class | cell) / p(class)) as a
+    [rows, columns, classes] array, with zeros (no information) for cells without
+    observations. Adding `weight` times a cell's row to an image's logits before the
+    softmax reweights the model's probabilities by the location, and looking a cell
+    up is arithmetic and an array index, with no file I/O once its page is resident.
+
+    Args:
+        directory: where `grid.npy` and `grid.json` are, or None to disable the prior.
+        weight: how strongly the prior is applied, 0 to disable it.
+    """
+
+    def __init__(self, directory: Optional[str] = None, weight: float = 1.0, codes: Sequence[str] = HABITAT_CODES):
+        self.directory = directory
+        self.weight = weight
+        self.codes = tuple(codes)
+        self.grid = None
+        self._origin = None
+        self._cell = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.weight != 0
+
+    def load(self):
+        """
+        Memory-map the grid, at startup.
+
+        Raises:
+            ValueError: if the grid was built for different model classes.
+        """
+        if not self.enabled:
+            return
+        with open(os.path.join(self.directory, GRID_CONFIG_FILENAME)) as file:
+            config = json.load(file)
+        if tuple(config["classes"]) != self.codes:
+            raise ValueError(f"Location prior in {self.directory} was built for different model classes.")
+        grid = np.load(os.path.join(self.directory, GRID_FILENAME), mmap_mode="r")
+        if grid.ndim != 3 or grid.shape[2] != len(self.codes):
+            raise ValueError(f"Location prior grid in {self.directory} has shape {grid.shape}, expected (rows, columns, {len(self.codes)}).")
+        self._origin = (config["lat_min"], config["lon_min"])
+        self._cell = (config["cell_lat"], config["cell_lon"])
+        self.grid = grid
+        logger.info("Loaded location prior with %d x %d cells from %s.", grid.shape[0], grid.shape[1], self.directory)
+
+    def log_prior(self, latitude: Optional[float], longitude: Optional[float]) -> Optional[torch.Tensor]:
+        """
+        The weighted log prior over the model's classes at a location.
+
+        Returns:
+            torch.Tensor: [classes] values to add to the logits, or None if there is no
+                prior, no location was given, or it is outside the grid.
+        """
+        if self.grid is None or latitude is None or longitude is None:
+            return None
+        row = int((latitude - self._origin[0]) // self._cell[0])
+        column = int((longitude - self._origin[1]) // self._cell[1])
+        if not (0 <= row < self.grid.shape[0] and 0 <= column < self.grid.shape[1]):
+            return None
+        return torch.from_numpy(self.grid[row, column].astype(np.float32)).mul_(self.weight)
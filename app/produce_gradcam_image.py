@@ -1,46 +1,41 @@
-import base64
 from PIL import Image
 import io
-from pytorch_grad_cam import GradCAM  
-from pytorch_grad_cam.utils.image import show_cam_on_image
+import numpy as np
+from app.config import GRADCAM_SIZE, GRADCAM_FORMAT, GRADCAM_QUALITY
 
-def reshape_transform(tensor, height=7, width=7):
-    # tensor shape: [batch, 49, channels] -> [batch, 7, 7, channels]
-    result = tensor.reshape(tensor.size(0), height, width, tensor.size(2))
-    # [batch, 7, 7, channels] -> [batch, channels, 7, 7]
-    result = result.permute(0, 3, 1, 2)
-    return result
+def jet(values: np.ndarray) -> np.ndarray:
+    """Map values in [0, 1] to RGB uint8 with the jet colormap."""
+    channels = [np.clip(1.5 - np.abs(4 * values - offset), 0, 1) for offset in (3, 2, 1)]
+    return (np.stack(channels, axis=-1) * 255).astype(np.uint8)
 
-def produce_gradcam(
-    model,
-    image,
-):
-    if(False): #placeholder
-        # After model prediction, before response:
-        # Select the target layer for Swin Transformer (usually the last norm layer)
-        target_layer = model.norm if hasattr(model, "norm") else list(model.children())[-1]
-        cam = GradCAM(model=model, target_layers=[target_layer], use_cuda=False)
-        grayscale_cam = cam(input_tensor=image, targets=None)[0]
+def encode_gradcam(
+    cam: np.ndarray,
+    image: np.ndarray,
+    size: int = GRADCAM_SIZE,
+    image_format: str = GRADCAM_FORMAT,
+    quality: int = GRADCAM_QUALITY,
+) -> bytes:
+    """
+    Overlay a Grad-CAM map on its image and encode it.
 
-        # Unnormalize image for visualization
-        rgb_image = image.squeeze(0).permute(1, 2, 0).numpy()
-        rgb_image = (rgb_image * [0.229, 0.224, 0.225]) + [0.485, 0.456, 0.406]
-        rgb_image = rgb_image.clip(0, 1)
+    Args:
+        cam: (height, width) map in [0, 1], at feature map resolution.
+        image: the decoded (height, width, 3) uint8 image the map was computed for.
+        size: width and height of the encoded image.
+        image_format: "png" or "webp".
+        quality: WebP quality (0-100); PNG is always lossless and uses fast compression.
+    """
+    # upsample the map smoothly to the output size and blend it with the image
+    heatmap = Image.fromarray((cam * 255).astype(np.uint8)).resize((size, size), Image.BILINEAR)
+    heatmap = Image.fromarray(jet(np.asarray(heatmap, dtype=np.float32) / 255))
+    background = Image.fromarray(image).resize((size, size), Image.BILINEAR)
+    overlay = Image.blend(background, heatmap, alpha=0.5)
 
-        cam_image = show_cam_on_image(rgb_image, grayscale_cam, use_rgb=True)
-
-        # Convert to PNG bytes
-        cam_pil = Image.fromarray(cam_image)
-        buf = io.BytesIO()
-        cam_pil.save(buf, format='PNG')
-        cam_bytes = buf.getvalue()
-        cam_base64 = base64.b64encode(cam_bytes).decode('utf-8')
-
-
-    # Create a simple placeholder image (e.g., gray square)
-    img = Image.new("RGB", (384, 384), color=(200, 200, 200))
     buf = io.BytesIO()
-    img.save(buf, format='PNG')
-    img_bytes = buf.getvalue()
-    cam_base64 = base64.b64encode(img_bytes).decode('utf-8')
-    return cam_base64
\ No newline at end of file
+    if image_format == "webp":
+        overlay.save(buf, format="WEBP", quality=quality, method=0)
+    elif image_format == "png":
+        overlay.save(buf, format="PNG", compress_level=1)
+    else:
+        raise ValueError(f"Grad-CAM image format '{image_format}' is not supported. Must be png or webp.")
+    return buf.getvalue()
@@ -0,0 +1,430 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+from torch import nn
+
+from app.backends import InferenceBackend, build_backend
+from app.batching import MicroBatcher
+from app.gradcam import GradCAMEngine
+from app.labels import HabitatDecoder, decoder as default_decoder
+from app.metrics import StageTimings
+from app.preprocess import BatchBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class ModelLoadError(RuntimeError):
+    """A model version could not be loaded, and will not be retried until `retry_after_s` has passed."""
+
+    def __init__(self, version: str, cause: BaseException, retry_after_s: float):
+        super().__init__(f"Model version '{version}' could not be loaded: {cause}")
+        self.version = version
+        self.retry_after_s = retry_after_s
+
+
+def module_bytes(*modules) -> int:
+    """Memory held by the weights of one or more modules, counting shared tensors once."""
+    seen = set()
+    total = 0
+
+    def add(value):
+        nonlocal total
+        if isinstance(value, torch.Tensor):
+            nbytes = value.numel() * value.element_size()
+            # keyed on the tensor's own span of memory rather than its storage, as memory-mapped
+            # weights are all views into one storage; quantised tensors have no plain data pointer
+            key = id(value) if value.is_quantized else (value.data_ptr(), nbytes)
+            if key not in seen:
+                seen.add(key)
+                total += nbytes
+        elif isinstance(value, (tuple, list)):
+            for item in value:
+                add(item)
+
+    for module in modules:
+        if isinstance(module, nn.Module):
+            for value in module.state_dict().values():
+                add(value)
+    return total
+
+
+class LoadedModel:
+    """
+    One resident model version, with its own inference backend, batcher and input buffer.
+    """
+
+    def __init__(
+        self,
+        version: str,
+        model: nn.Module,
+        backend: InferenceBackend,
+        batch_size: int,
+        max_wait_ms: float,
+        channels_last: bool = False,
+        decoder: HabitatDecoder = default_decoder,
+    ):
+        self.version = version
+        self.model = model
+        self.backend = backend
+        self.decoder = decoder
+        # hooked once here, and only used from the batcher's thread
+        self.gradcam = GradCAMEngine(model, backend.prepared)
+        # input buffer, only used from the batcher's thread
+        self.buffer = BatchBuffer(batch_size, channels_last=channels_last)
+        self.batcher = MicroBatcher(self.forward_batch, max_batch_size=batch_size, max_wait_ms=max_wait_ms, name=f"batcher-{version}")
+        # the int8 backend holds a quantised copy of the weights alongside the eager model
+        self.size_bytes = module_bytes(model, backend.prepared)
+        # seconds spent in each phase of loading this version
+        self.load_timings: Dict[str, float] = {}
+        # requests using this version (see `ModelRegistry.use`), and whether it has been
+        # evicted, so it is closed once the last of them finishes; guarded by the registry's lock
+        self.users = 0
+        self.retired = False
+
+    @property
+    def cache_namespace(self) -> str:
+        # logits differ slightly between backends, so cache them separately
+        return f"{self.version}/{self.backend.name}"
+
+    def submit(
+        self,
+        image: np.ndarray,
+        gradcam: Union[bool, Callable[[torch.Tensor], torch.Tensor]] = False,
+        timings: Optional[StageTimings] = None,
+        embedding: bool = False
+    ):
+        """
+        Queue a decoded image for the next batched forward pass.
+
+        Args:
+            gradcam: also compute a Grad-CAM map, for the image's top class, or for the
+                target a function of its logits gives (see `GradCAMEngine`).
+            timings: where to record the image's queue wait, transform, forward and Grad-CAM times.
+            embedding: also pool the forward pass's features into the image's embedding.
+
+        Returns:
+            Future: resolved with the image's logits, or with `(logits, Grad-CAM map or None,
+                embedding or None)` if `gradcam` or `embedding` is set.
+        """
+        return self.batcher.submit((image, gradcam, embedding, timings, time.perf_counter()))
+
+    def submit_views(self, images: Sequence[np.ndarray], timings: Optional[StageTimings] = None) -> List[Future]:
+        """
+        Queue several views of one image (e.g. its tiles) to share a batched forward pass,
+        up to the batch size at a time.
+
+        Args:
+            timings: where to record the image's queue wait, transform and forward
+                times, once for each forward pass its views are in.
+
+        Returns:
+            list: a future for each view, resolved with its logits.
+        """
+        queued_at = time.perf_counter()
+        batch_size = self.batcher.max_batch_size
+        return self.batcher.submit_many([
+            (image, False, False, timings if index % batch_size == 0 else None, queued_at)
+            for index, image in enumerate(images)
+        ])
+
+    def forward_batch(self, items: List[Tuple[np.ndarray, bool, bool, Optional[StageTimings], float]]) -> List[Union[torch.Tensor, tuple]]:
+        """
+        Run a single forward pass over a list of decoded images, each with whether it needs
+        a Grad-CAM map (or the map's target, as for `submit`), whether it needs its embedding, where to record its stage timings
+        (or None) and when it was queued.
+
+        Returns:
+            list: logits for each image, in the order given, or `(logits, Grad-CAM map,
+                embedding)` for images that asked for either, with None for the one not asked for.
+        """
+        start = time.perf_counter()
+        for *_, timings, queued_at in items:
+            if timings is not None:
+                timings.add("queue_wait", start - queued_at)
+
+        batch = self.buffer.fill([item[0] for item in items])
+        transformed = time.perf_counter()
+        wanted = [index for index, item in enumerate(items) if item[1]]
+        embedded = [index for index, item in enumerate(items) if item[2]]
+        extras = {index: [None, None] for index in wanted + embedded}
+        with self.gradcam.capture(enabled=bool(extras)):
+            output = self.backend(batch)
+            forwarded = time.perf_counter()
+            if embedded:
+                # pooled from the captured backbone output, as the classifier head would
+                with torch.no_grad():
+                    features = self.gradcam.features(batch, embedded).float()
+                    for index, embedding in zip(embedded, self.model.forward_head(features, pre_logits=True).unbind(0)):
+                        extras[index][1] = embedding
+            pooled = time.perf_counter()
+            if wanted:
+                # the maps for every image that asked for one come from a single backward pass
+                targets = [items[index][1] for index in wanted]
+                for index, cam in zip(wanted, self.gradcam.maps(batch, output, wanted, targets)):
+                    extras[index][0] = cam
+        finished = time.perf_counter()
+        results = list(output.unbind(0))
+        for index, (cam, embedding) in extras.items():
+            results[index] = (results[index], cam, embedding)
+
+        for _, gradcam, embedding, timings, _ in items:
+            if timings is not None:
+                timings.add("transform", transformed - start)
+                timings.add("forward", forwarded - transformed)
+                if embedding:
+                    timings.add("embedding", pooled - forwarded)
+                if gradcam:
+                    timings.add("gradcam", finished - pooled)
+        return results
+
+    def warm_up(self):
+        """Run one forward pass on a blank image, so the first request doesn't pay for lazy initialisation."""
+        self.forward_batch([(np.zeros(tuple(self.buffer.size) + (3,), dtype=np.uint8), False, False, None, time.perf_counter())])
+
+    def close(self):
+        self.batcher.stop()
+        self.gradcam.close()
+
+
+class ModelRegistry:
+    """
+    Model versions loaded on demand and kept resident up to a memory budget.
+
+    Each version is loaded the first time it is requested (or by `prewarm`), and
+    concurrent first requests for the same version wait on a single load. A failed
+    load is not retried until `retry_interval_s` has passed. Once more
+    than `max_resident` versions, or more than `max_bytes` of weights, are resident,
+    the least recently used versions are unloaded. A version evicted while requests
+    are using it (see `use`) keeps running until the last of them finishes.
+
+    Args:
+        sources: model version -> model name passed to `create_model`.
+        default_version: version used when a request does not ask for one.
+        create_model: loads the eager model for a model name.
+        backend: inference backend each model is prepared with.
+        max_bytes: memory budget for resident models, 0 for no limit.
+        retry_interval_s: how long requests for a version that failed to load are
+            rejected before the load is tried again.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, str],
+        default_version: str,
+        create_model: Callable[[str], nn.Module],
+        backend: str = "eager",
+        batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        channels_last: bool = False,
+        max_resident: int = 1,
+        max_bytes: int = 0,
+        retry_interval_s: float = 30.0,
+    ):
+        if default_version not in sources:
+            raise ValueError(f"Default model version '{default_version}' is not one of the configured versions.")
+        self.sources = dict(sources)
+        self.default_version = default_version
+        self.create_model = create_model
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_wait_ms = max_wait_ms
+        self.channels_last = channels_last
+        self.max_resident = max(max_resident, 1)
+        self.max_bytes = max_bytes
+        self.retry_interval_s = retry_interval_s
+        self._lock = threading.Lock()
+        self._resident = OrderedDict()
+        self._loading: Dict[str, Future] = {}
+        # version -> (exception, monotonic time) of its last failed load
+        self._failed: Dict[str, tuple] = {}
+        self._loads = 0
+        self._evictions = 0
+
+    @property
+    def versions(self) -> List[str]:
+        return list(self.sources)
+
+    def resolve(self, version: Optional[str]) -> str:
+        """
+        The configured version for a request, defaulting to `default_version`.
+
+        Raises:
+            ValueError: if the version is not configured.
+        """
+        if version is None:
+            return self.default_version
+        if version not in self.sources:
+            raise ValueError(f"Unknown model version '{version}'. Available versions: {', '.join(self.sources)}.")
+        return version
+
+    def get(self, version: Optional[str] = None) -> LoadedModel:
+        """
+        The resident model for a version, loading it first if needed.
+
+        Raises:
+            ValueError: if the version is not configured.
+            ModelLoadError: if the version could not be loaded.
+        """
+        version = self.resolve(version)
+        with self._lock:
+            entry = self._resident.get(version)
+            if entry is not None:
+                self._resident.move_to_end(version)
+                return entry
+            if version in self._failed:
+                error, failed_at = self._failed[version]
+                remaining = self.retry_interval_s - (time.monotonic() - failed_at)
+                if remaining > 0:
+                    raise ModelLoadError(version, error, remaining)
+            future = self._loading.get(version)
+            owner = future is None
+            if owner:
+                future = self._loading[version] = Future()
+
+        if owner:
+            self._load(version, future)
+        return future.result()
+
+    @contextmanager
+    def use(self, version: Optional[str] = None) -> Iterator[LoadedModel]:
+        """
+        The resident model for a version, as from `get`, kept running until the block
+        exits even if it is evicted in the meantime, so requests already using it are
+        not cut off.
+
+        Raises:
+            ValueError: if the version is not configured.
+            ModelLoadError: if the version could not be loaded.
+        """
+        while True:
+            entry = self.get(version)
+            with self._lock:
+                # it may have been evicted between being loaded and being counted
+                if self._resident.get(entry.version) is entry:
+                    entry.users += 1
+                    break
+        try:
+            yield entry
+        finally:
+            with self._lock:
+                entry.users -= 1
+                idle = entry.retired and not entry.users
+            if idle:
+                logger.info("Unloading model version '%s' now its last request has finished.", entry.version)
+                entry.close()
+
+    def peek(self, version: Optional[str] = None) -> Optional[LoadedModel]:
+        """The resident model for a version, without loading it or marking it as used."""
+        with self._lock:
+            return self._resident.get(self.resolve(version))
+
+    def prewarm(self, versions: Iterable[str]):
+        """Load the named versions now, rather than on their first request."""
+        for version in versions:
+            self.get(version)
+
+    def is_loaded(self, version: Optional[str] = None) -> bool:
+        return self.peek(version) is not None
+
+    def close(self):
+        with self._lock:
+            entries = list(self._resident.values())
+            self._resident.clear()
+        for entry in entries:
+            entry.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            resident = list(self._resident.values())
+            loading = list(self._loading)
+            failed = {version: str(error) for version, (error, _) in self._failed.items()}
+            loads, evictions = self._loads, self._evictions
+        return {
+            "default_version": self.default_version,
+            "versions": self.versions,
+            "max_resident": self.max_resident,
+            "max_bytes": self.max_bytes,
+            "resident_bytes": sum(entry.size_bytes for entry in resident),
+            "torch_threads": torch.get_num_threads(),
+            "loads": loads,
+            "evictions": evictions,
+            "loading": loading,
+            "failed": failed,
+            "resident": {
+                entry.version: {
+                    "source": self.sources[entry.version],
+                    "backend": entry.backend.name,
+                    "size_bytes": entry.size_bytes,
+                    "load_timings": entry.load_timings,
+                    "batching": entry.batcher.stats(),
+                }
+                for entry in resident
+            },
+        }
+
+    def _load(self, version: str, future: Future):
+        timings = {}
+        try:
+            start = time.perf_counter()
+            model = self.create_model(self.sources[version])
+            timings["weights_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
+            backend = build_backend(model, self.backend, memory_format)
+            entry = LoadedModel(version, model, backend, self.batch_size, self.max_wait_ms, self.channels_last)
+            timings["backend_s"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            entry.warm_up()
+            timings["warmup_s"] = time.perf_counter() - start
+        except Exception as e:
+            logger.exception("Failed to load model version '%s'.", version)
+            with self._lock:
+                del self._loading[version]
+                self._failed[version] = (e, time.monotonic())
+            future.set_exception(ModelLoadError(version, e, self.retry_interval_s))
+            return
+
+        entry.load_timings = timings
+        logger.info(
+            "Loaded model version '%s' (%s backend): weights %.2f s, backend %.2f s, warm-up forward %.2f s.",
+            version, entry.backend.name, timings["weights_s"], timings["backend_s"], timings["warmup_s"]
+        )
+        with self._lock:
+            del self._loading[version]
+            self._failed.pop(version, None)
+            self._resident[version] = entry
+            self._loads += 1
+            evicted = self._evict(keep=version)
+            # versions still in use are closed by the last request using them
+            idle = [old for old in evicted if not old.users]
+        for old in evicted:
+            if old in idle:
+                logger.info("Unloading model version '%s'.", old.version)
+                old.close()
+            else:
+                logger.info("Unloading model version '%s' once its %d requests have finished.", old.version, old.users)
+        future.set_result(entry)
+
+    def _evict(self, keep: str) -> List[LoadedModel]:
+        # called with the lock held; never evicts the version just loaded
+        evicted = []
+        while len(self._resident) > 1:
+            over_count = len(self._resident) > self.max_resident
+            over_bytes = self.max_bytes and sum(entry.size_bytes for entry in self._resident.values()) > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            version = next(v for v in self._resident if v != keep)
+            entry = self._resident.pop(version)
+            entry.retired = True
+            evicted.append(entry)
+            self._evictions += 1
+        return evicted
@@ -0,0 +1,99 @@
+"""
+Serve the API from several worker processes that share one copy of the model weights.
+
+Every model version is first made available as a local directory of safetensors
+weights (Hub models are downloaded and saved under AIHAB_LOCAL_MODEL_DIR once), and
+the workers load it memory-mapped, so the weights are held in memory once however
+many workers there are. The machine's cores are divided between the workers with
+AIHAB_TORCH_THREADS, unless it is set explicitly.
+
+Weights are only shared by backends that run the eager model's own tensors
+(eager, bf16 and compile); int8, torchscript and onnx make a private copy per worker.
+
+Usage (from the repository root):
+    python -m app.serve [--workers 4] [--host 0.0.0.0] [--port 8000]
+"""
+import argparse
+import logging
+import os
+import re
+import sys
+from typing import Dict
+
+from app.config import LOCAL_MODEL_DIR, MODEL_SOURCES, SERVE_WORKERS, TORCH_THREADS
+from app.weights import CONFIG_FILENAME, is_local_model, save_model_local
+
+logger = logging.getLogger(__name__)
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def threads_per_worker(workers: int) -> int:
+    """Torch threads for each of `workers` processes, so together they use each core once."""
+    return max(available_cores() // workers, 1)
+
+
+def local_model_dir(source: str) -> str:
+    """
+    A local directory holding the model for `source`, saving it there first if it is a Hub model.
+
+    Raises:
+        ValueError: if the source is neither a local directory nor a Hub model.
+    """
+    if is_local_model(source):
+        return source
+    prefix, _, repo = source.partition(":")
+    if prefix not in ("hf_hub", "hf-hub"):
+        raise ValueError(f"Model source '{source}' must be a local directory or an hf_hub: model to be shared between workers.")
+
+    directory = os.path.join(LOCAL_MODEL_DIR, re.sub(r"[^\w.-]+", "--", repo))
+    if os.path.exists(os.path.join(directory, CONFIG_FILENAME)):
+        return directory
+
+    import json
+    from huggingface_hub import hf_hub_download
+    from app import predict
+
+    logger.info("Saving %s to %s.", source, directory)
+    predict.login_hf()
+    model = predict.create_model(source)
+    repo_id, _, revision = repo.partition("@")
+    config_path = hf_hub_download(repo_id, CONFIG_FILENAME, revision=revision or None, cache_dir="data/models")
+    with open(config_path) as file:
+        config = json.load(file)
+    save_model_local(model, directory, config)
+    return directory
+
+
+def local_model_sources(sources: Dict[str, str]) -> Dict[str, str]:
+    return {version: local_model_dir(source) for version, source in sources.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=SERVE_WORKERS, help="number of worker processes")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # the workers read their configuration from the environment when they start
+    sources = local_model_sources(MODEL_SOURCES)
+    os.environ["AIHAB_MODELS"] = ",".join(f"{version}={directory}" for version, directory in sources.items())
+    threads = TORCH_THREADS or threads_per_worker(args.workers)
+    os.environ["AIHAB_TORCH_THREADS"] = str(threads)
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+    logger.info("Starting %d workers with %d torch threads each.", args.workers, threads)
+
+    # exec a fresh uvicorn rather than calling uvicorn.run, which would serve a single
+    # worker in this process, whose configuration was read before it was changed
+    command = ["-m", "uvicorn", "app.main:app", "--host", args.host, "--port", str(args.port), "--workers", str(args.workers)]
+    os.execv(sys.executable, [sys.executable] + command)
+
+
+if __name__ == "__main__":
+    main()
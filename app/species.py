@@ -0,0 +1,122 @@
+import json
+import logging
+import os
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import torch
+
+from app.labels import HABITAT_CODES
+
+logger = logging.getLogger(__name__)
+
+MATRIX_FILENAME = "species.npz"
+VOCABULARY_FILENAME = "species.json"
+
+
+def normalise_species(name: str) -> str:
+    """A species name as it appears in the vocabulary, e.g. `quercus_robur` for `Quercus robur`."""
+    return name.strip().lower().replace(" ", "_")
+
+
+class SpeciesEvidence:
+    """
+    How much more or less likely each model class is given the species recorded with
+    an image, loaded from a directory built by `python -m app.build_species_evidence`.
+
+    The directory holds a species vocabulary (`species.json`) and a sparse
+    [species, classes] matrix of log-likelihood ratios log(p(species | class) / p(species))
+    as CSR arrays (`species.npz`). Species with no evidence for any class have empty
+    rows. Names in a list are interned to vocabulary rows with a dict lookup each, and
+    the list's evidence is then a single product of a sparse multi-hot vector with the
+    matrix, so its cost grows with the length of the list, not the vocabulary. Unknown
+    names are ignored, and a species listed twice counts once.
+
+    The matrix is held in memory with its rows expanded (species x classes of
+    float32), so each product is a sparse-dense one that does not convert the matrix.
+
+    Args:
+        directory: where `species.json` and `species.npz` are, or None to disable the evidence.
+        weight: how strongly the evidence is applied, 0 to disable it.
+    """
+
+    def __init__(self, directory: Optional[str] = None, weight: float = 1.0, codes: Sequence[str] = HABITAT_CODES):
+        self.directory = directory
+        self.weight = weight
+        self.codes = tuple(codes)
+        self.vocabulary: Dict[str, int] = {}
+        self.matrix = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.weight != 0
+
+    def load(self):
+        """
+        Load the vocabulary and matrix, at startup.
+
+        Raises:
+            ValueError: if they were built for different model classes, or do not match each other.
+        """
+        if not self.enabled:
+            return
+        with open(os.path.join(self.directory, VOCABULARY_FILENAME)) as file:
+            config = json.load(file)
+        if tuple(config["classes"]) != self.codes:
+            raise ValueError(f"Species evidence in {self.directory} was built for different model classes.")
+        species = config["species"]
+        with np.load(os.path.join(self.directory, MATRIX_FILENAME)) as arrays:
+            indptr, indices, data = arrays["indptr"], arrays["indices"], arrays["data"]
+        if len(indptr) != len(species) + 1 or (len(indices) and indices.max() >= len(self.codes)):
+            raise ValueError(f"Species evidence matrix in {self.directory} does not match its vocabulary and classes.")
+
+        rows = np.repeat(np.arange(len(species)), np.diff(indptr))
+        matrix = np.zeros((len(species), len(self.codes)), dtype=np.float32)
+        matrix[rows, indices] = data
+        # the weight is applied once here rather than to every request's evidence
+        self.matrix = torch.from_numpy(matrix).mul_(self.weight)
+        self.vocabulary = {name: row for row, name in enumerate(species)}
+        logger.info("Loaded species evidence for %d species (%d non-zero entries) from %s.", len(species), len(data), self.directory)
+
+    def rows(self, species_list: Optional[str]) -> set:
+        """The vocabulary rows of the known species in a comma-separated list."""
+        if not species_list:
+            return set()
+        # `normalise_species` inlined, as lists can be hundreds of names long
+        rows = {self.vocabulary.get(name.strip().replace(" ", "_")) for name in species_list.lower().split(",")}
+        rows.discard(None)
+        return rows
+
+    def log_likelihoods(self, species_lists: Sequence[Optional[str]]) -> Optional[torch.Tensor]:
+        """
+        The weighted evidence of several species lists, from one sparse matrix product.
+
+        Returns:
+            torch.Tensor: [lists, classes] values to add to the logits, with zeros for
+                empty lists or lists of unknown species, or None if there is no evidence loaded.
+        """
+        if self.matrix is None:
+            return None
+        list_rows = [self.rows(species_list) for species_list in species_lists]
+        counts = torch.tensor([len(rows) for rows in list_rows], dtype=torch.long)
+        columns = torch.tensor([row for rows in list_rows for row in sorted(rows)], dtype=torch.long)
+        indices = torch.stack([torch.repeat_interleave(torch.arange(len(list_rows)), counts), columns])
+        # distinct (list, species) pairs in sorted order, so the vector needs no coalescing
+        lists = torch.sparse_coo_tensor(
+            indices, torch.ones(len(columns)), (len(list_rows), self.matrix.shape[0]),
+            is_coalesced=True, check_invariants=False,
+        )
+        return torch.sparse.mm(lists, self.matrix)
+
+    def log_likelihood(self, species_list: Optional[str]) -> Optional[torch.Tensor]:
+        """
+        The weighted evidence over the model's classes of one comma-separated species list.
+
+        Returns:
+            torch.Tensor: [classes] values to add to the logits, or None if there is no
+                evidence loaded or none of the species are known.
+        """
+        if self.matrix is None or not species_list:
+            return None
+        evidence = self.log_likelihoods([species_list])[0]
+        return evidence if evidence.any() else None
@@ -0,0 +1,118 @@
+import io
+from typing import BinaryIO, Optional
+
+from PIL import Image, UnidentifiedImageError
+
+from app.config import UPLOAD_MAX_BYTES, UPLOAD_SNIFF_BYTES, MAX_IMAGE_PIXELS
+from app.metrics import UPLOAD_REJECTIONS
+
+# image formats accepted, as identified by PIL from the file header (MPO is how PIL
+# identifies the JPEGs written by many phone cameras)
+IMAGE_FORMATS = {"JPEG", "MPO", "PNG", "WEBP", "TIFF", "BMP", "GIF"}
+
+# size of the first read when looking for an image's header, growing 4x up to UPLOAD_SNIFF_BYTES
+_FIRST_READ_BYTES = 16 * 1024
+
+
+class UploadRejected(ValueError):
+    """
+    An uploaded image refused before it was decoded.
+
+    Args:
+        reason: short label the rejection is counted under in /metrics.
+        status_code: HTTP status to answer with.
+    """
+
+    def __init__(self, message: str, reason: str, status_code: int = 400):
+        super().__init__(message)
+        self.reason = reason
+        self.status_code = status_code
+
+
+def reject(message: str, reason: str, status_code: int = 400) -> UploadRejected:
+    """An `UploadRejected` to raise, counted in `UPLOAD_REJECTIONS`."""
+    UPLOAD_REJECTIONS.inc(reason)
+    return UploadRejected(message, reason, status_code)
+
+
+def too_large(max_bytes: int = UPLOAD_MAX_BYTES) -> UploadRejected:
+    return reject(f"Image is larger than the limit of {max_bytes} bytes.", "too_large", 413)
+
+
+def check_image(data: bytes, complete: bool = True, max_pixels: int = MAX_IMAGE_PIXELS) -> bool:
+    """
+    Check an image's format and dimensions from its header, without decoding it.
+
+    Args:
+        data: the image's bytes, or only the first of them.
+        complete: whether `data` is the whole file. If it is not and the header has
+            not been read yet, more bytes are needed rather than the image being rejected.
+
+    Returns:
+        bool: True if the image is acceptable, False if more bytes are needed to tell.
+
+    Raises:
+        UploadRejected: if the image cannot be identified, is in an unsupported format,
+            or has more than `max_pixels` pixels.
+    """
+    try:
+        # only the header is parsed; pixel data is never read here
+        with Image.open(io.BytesIO(data)) as image:
+            image_format = image.format
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise reject(f"Image has more than the limit of {max_pixels} pixels.", "too_many_pixels", 413)
+    except (UnidentifiedImageError, OSError):
+        if not complete:
+            return False
+        raise reject("Could not decode image.", "undecodable")
+    if image_format not in IMAGE_FORMATS:
+        raise reject(f"Unsupported image format {image_format}.", "unsupported_format", 415)
+    if width * height > max_pixels:
+        raise reject(f"Image has more than the limit of {max_pixels} pixels.", "too_many_pixels", 413)
+    return True
+
+
+def read_image(
+    fileobj: BinaryIO,
+    size: Optional[int] = None,
+    max_bytes: int = UPLOAD_MAX_BYTES,
+    sniff_bytes: int = UPLOAD_SNIFF_BYTES,
+) -> bytes:
+    """
+    Read an uploaded image, rejecting it as early as possible.
+
+    The header is read first and the image's format and dimensions checked from it,
+    so unidentifiable, unsupported or oversized images are refused before the rest
+    of the file is read, let alone decoded. Reading stops as soon as `max_bytes` is
+    exceeded.
+
+    Args:
+        size: the file's size if already known (e.g. `UploadFile.size`), so oversized
+            files are rejected without reading them.
+
+    Raises:
+        UploadRejected: if the image is too large, cannot be identified from its
+            first `sniff_bytes`, or fails `check_image`.
+    """
+    if size is not None and size > max_bytes:
+        raise too_large(max_bytes)
+
+    data = b""
+    target = min(_FIRST_READ_BYTES, sniff_bytes)
+    while True:
+        wanted = min(target, max_bytes + 1) - len(data)
+        chunk = fileobj.read(wanted)
+        data += chunk
+        complete = len(chunk) < wanted
+        if len(data) > max_bytes:
+            raise too_large(max_bytes)
+        if check_image(data, complete=complete or target >= sniff_bytes):
+            break
+        target *= 4
+
+    if not complete:
+        data += fileobj.read(max_bytes + 1 - len(data))
+        if len(data) > max_bytes:
+            raise too_large(max_bytes)
+    return data
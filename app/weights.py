@@ -0,0 +1,113 @@
+import json
+import os
+import struct
+from typing import Dict
+
+import torch
+from torch import nn
+
+WEIGHTS_FILENAME = "model.safetensors"
+CONFIG_FILENAME = "config.json"
+
+# safetensors dtype names
+DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def is_local_model(source: str) -> bool:
+    """Whether a model source is a local directory rather than a timm/Hub model name."""
+    return os.path.isdir(source)
+
+
+def load_safetensors_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Read a safetensors file as tensors backed by a private memory map of the file.
+
+    Nothing is copied: pages are read from the page cache as the weights are used, and
+    processes mapping the same file share those pages for as long as the weights are
+    only read.
+
+    Raises:
+        ValueError: if the file is not a valid safetensors file.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as file:
+        try:
+            (header_size,) = struct.unpack("<Q", file.read(8))
+            header = json.loads(file.read(header_size))
+        except (struct.error, ValueError):
+            raise ValueError(f"{path} is not a safetensors file.")
+
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=size)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = DTYPES.get(info["dtype"])
+        if dtype is None:
+            raise ValueError(f"Unsupported dtype {info['dtype']} for tensor '{name}' in {path}.")
+        start, _ = info["data_offsets"]
+        offset, remainder = divmod(data_start + start, dtype.itemsize)
+        if remainder:
+            raise ValueError(f"Tensor '{name}' in {path} is not aligned to its dtype.")
+        tensor = torch.empty(0, dtype=dtype)
+        tensor.set_(storage, offset, info["shape"])
+        tensors[name] = tensor
+    return tensors
+
+
+def create_model_local(directory: str) -> nn.Module:
+    """
+    Create a timm model from a local directory holding `config.json` and `model.safetensors`,
+    laid out as on the Hugging Face Hub, without any network access.
+
+    The model's weights are the memory-mapped tensors from `load_safetensors_mmap`.
+
+    Raises:
+        FileNotFoundError: if either file is missing.
+        RuntimeError: if the weights do not match the architecture in the config.
+    """
+    import timm
+
+    with open(os.path.join(directory, CONFIG_FILENAME)) as file:
+        config = json.load(file)
+
+    model_args = dict(config.get("model_args", {}))
+    if "num_classes" in config:
+        model_args["num_classes"] = config["num_classes"]
+    model = timm.create_model(config["architecture"], pretrained=False, **model_args)
+
+    state_dict = load_safetensors_mmap(os.path.join(directory, WEIGHTS_FILENAME))
+    # assign rather than copy, so the parameters stay backed by the mapped file
+    model.load_state_dict(state_dict, assign=True)
+    return model
+
+
+
+def save_model_local(model: nn.Module, directory: str, config: dict):
+    """
+    Save a model in the layout read by `create_model_local`.
+
+    Args:
+        config: the timm model config, with at least `architecture`, and the
+            `num_classes` and `model_args` the model was created with.
+    """
+    from safetensors.torch import save_file
+
+    os.makedirs(directory, exist_ok=True)
+    state_dict = {name: tensor.contiguous() for name, tensor in model.state_dict().items()}
+    # write the weights first, so a directory with a config always has complete weights
+    save_file(state_dict, os.path.join(directory, WEIGHTS_FILENAME))
+    with open(os.path.join(directory, CONFIG_FILENAME), "w") as file:
+        json.dump(config, file, indent=2)
@@ -0,0 +1,229 @@
+"""
+Offline benchmark of the whole API: single-image latency, throughput at several
+concurrency levels, memory use and cold-start time.
+
+Runs against a randomly initialised Swin-T with the production architecture, saved
+as local safetensors (or against `--model-dir`), so neither the Hub nor a network
+connection is needed. The logits cache is disabled so every request runs the model.
+
+- cold start: a fresh `uvicorn app.main:app` process is timed until `/status` is
+  ready and until its first `/predict` has answered, `--cold-starts` times.
+- latency: `--requests` sequential /predict requests to a server process started
+  the same way, once `/stats` shows it is serving the stand-in, with per-stage medians from the `timings` echo (decode, transform,
+  forward, top-k, ...).
+- throughput: `--duration` seconds of load at each of `--concurrency` concurrent clients.
+- memory: RSS of the server process once the model is loaded and after each load
+  level, and its peak RSS. Linux only, as memory is read from /proc.
+
+Compare a run against an earlier one with `--baseline`, e.g. before and after a
+change to `predict_habitat` or preprocessing.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_api [--requests 50] [--concurrency 1,2,4,8] [--output api.json] [--baseline old.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_workers import check_serving, get_json, make_images, multipart, run_load, save_stand_in_model, wait_until_ready
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def app_env(model_dir: str, data_dir: str, backend: str) -> dict:
+    return {
+        "AIHAB_MODELS": f"default={model_dir}",
+        "AIHAB_INFERENCE_BACKEND": backend,
+        # every request should reach the model
+        "AIHAB_CACHE_MAX_ENTRIES": "0",
+        "AIHAB_INFERENCE_QUEUE_SIZE": "1000",
+        # keep jobs and Grad-CAM images out of the repository's data directory
+        "AIHAB_JOBS_DB": os.path.join(data_dir, "jobs.sqlite3"),
+        "AIHAB_JOBS_DIR": os.path.join(data_dir, "jobs"),
+        "AIHAB_GRADCAM_DIR": os.path.join(data_dir, "gradcam"),
+    }
+
+
+def post_image(port: int, image: bytes, query: str = "") -> tuple:
+    body, content_type = multipart(image)
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        connection.request("POST", "/predict" + query, body=body, headers={"Content-Type": content_type})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def percentiles(values: list) -> dict:
+    cuts = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return {
+        "median": statistics.median(values),
+        "p90": cuts[89],
+        "p99": cuts[98],
+        "mean": statistics.fmean(values),
+    }
+
+
+def memory(pid: int) -> dict:
+    """Current and peak RSS of a process, in bytes."""
+    with open(f"/proc/{pid}/status") as file:
+        fields = dict(line.split(":", 1) for line in file if ":" in line)
+    return {
+        "rss_bytes": int(fields["VmRSS"].split()[0]) * 1024,
+        "peak_rss_bytes": int(fields["VmHWM"].split()[0]) * 1024,
+    }
+
+
+def start_server(env: dict) -> tuple:
+    """Start `uvicorn app.main:app` in a fresh process with `env` added to its environment."""
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"]
+    process = subprocess.Popen(command, env=dict(os.environ, **env), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, port
+
+
+def stop_server(process: subprocess.Popen):
+    process.terminate()
+    process.wait()
+
+
+def measure_latency(port: int, images: list, requests: int) -> dict:
+    latencies = []
+    stages = {}
+    for index in range(requests):
+        start = time.perf_counter()
+        status, body = post_image(port, images[index % len(images)], "?timings=true")
+        if status != 200:
+            raise SystemExit(f"Prediction failed with status {status}.")
+        latencies.append((time.perf_counter() - start) * 1000)
+        for stage, ms in json.loads(body)["timings_ms"].items():
+            stages.setdefault(stage, []).append(ms)
+    return {
+        "requests": requests,
+        "latency_ms": percentiles(latencies),
+        "stage_ms_median": {stage: statistics.median(values) for stage, values in stages.items()},
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Print the relative change of the headline numbers against an earlier run."""
+    def change(name: str, new, old, higher_is_better: bool = False):
+        if not new or not old:
+            return
+        delta = (new - old) / old * 100
+        worse = delta < 0 if higher_is_better else delta > 0
+        print(f"{name:>32}  {old:10.2f} -> {new:10.2f}  {delta:+6.1f}%{'  (worse)' if worse and abs(delta) >= 5 else ''}")
+
+    print("\nChange from baseline:")
+    change("latency median (ms)", results["latency"]["latency_ms"]["median"], baseline["latency"]["latency_ms"]["median"])
+    change("latency p99 (ms)", results["latency"]["latency_ms"]["p99"], baseline["latency"]["latency_ms"]["p99"])
+    for stage, ms in results["latency"]["stage_ms_median"].items():
+        change(f"{stage} median (ms)", ms, baseline["latency"]["stage_ms_median"].get(stage))
+    old_levels = {level["concurrency"]: level for level in baseline["throughput"]}
+    for level in results["throughput"]:
+        old = old_levels.get(level["concurrency"])
+        if old:
+            change(f"img/s at concurrency {level['concurrency']}", level["images_per_second"], old["images_per_second"], higher_is_better=True)
+    if results["cold_start"] and baseline["cold_start"]:
+        change("cold start ready (s)", statistics.median(run["ready_s"] for run in results["cold_start"]), statistics.median(run["ready_s"] for run in baseline["cold_start"]))
+    change("peak RSS (MB)", results["memory"]["peak_rss_bytes"] / 1e6, baseline["memory"]["peak_rss_bytes"] / 1e6)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50, help="sequential requests for single-image latency")
+    parser.add_argument("--concurrency", default="1,2,4,8", help="comma-separated concurrent client counts for throughput")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per concurrency level")
+    parser.add_argument("--cold-starts", type=int, default=1, help="fresh server processes to time (0 to skip)")
+    parser.add_argument("--backend", default="eager", help="inference backend (AIHAB_INFERENCE_BACKEND)")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--model-dir", help="local model directory to serve, instead of a random stand-in")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    args = parser.parse_args()
+
+    import torch
+
+    images = make_images(16)
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir = os.path.join(tmp, "model")
+            save_stand_in_model(model_dir)
+        env = app_env(model_dir, tmp, args.backend)
+
+        cold_starts = [cold_start(env, images[0], args.startup_timeout) for _ in range(args.cold_starts)]
+        for run in cold_starts:
+            print(f"cold start: ready in {run['ready_s']:.2f} s, first prediction after {run['first_prediction_s']:.2f} s")
+
+        process, port = start_server(env)
+        try:
+            wait_until_ready(port, process, args.startup_timeout)
+            check_serving(port, model_dir)
+            memory_loaded = memory(process.pid)
+            # untimed requests, so lazy initialisation is not counted
+            for image in images[:4]:
+                post_image(port, image)
+
+            latency = measure_latency(port, images, args.requests)
+            print(
+                f"latency: median {latency['latency_ms']['median']:.1f} ms  p90 {latency['latency_ms']['p90']:.1f} ms  "
+                f"p99 {latency['latency_ms']['p99']:.1f} ms"
+            )
+            print("  stages: " + "  ".join(f"{stage} {ms:.2f}" for stage, ms in latency["stage_ms_median"].items()))
+
+            throughput = []
+            for concurrency in (int(count) for count in args.concurrency.split(",")):
+                level = {"concurrency": concurrency}
+                level.update(run_load(port, images, concurrency, args.duration))
+                level.update(memory(process.pid))
+                throughput.append(level)
+                print(
+                    f"{concurrency:3d} clients: {level['images_per_second']:6.2f} img/s  "
+                    f"median {level['latency_ms_median'] or 0:7.0f} ms  p95 {level['latency_ms_p95'] or 0:7.0f} ms  "
+                    f"RSS {level['rss_bytes'] / 1e6:6.0f} MB  ({level['failures']} failures)"
+                )
+            memory_final = memory(process.pid)
+        finally:
+            stop_server(process)
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "cpus": os.cpu_count(),
+            # the server's threads, which start from the same default as this process
+            "torch_threads": int(os.getenv("AIHAB_TORCH_THREADS", "0")) or torch.get_num_threads(),
+            "backend": args.backend,
+            "stand_in_model": args.model_dir is None,
+        },
+        "cold_start": cold_starts,
+        "latency": latency,
+        "throughput": throughput,
+        "memory": {"after_load_rss_bytes": memory_loaded["rss_bytes"], **memory_final},
+    }
+    print(f"memory: {memory_loaded['rss_bytes'] / 1e6:.0f} MB after load, peak {results['memory']['peak_rss_bytes'] / 1e6:.0f} MB")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
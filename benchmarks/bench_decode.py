@@ -0,0 +1,154 @@
+"""
+Benchmark image decoding: the original torchvision `transform` pipeline against
+`app.preprocess` (JPEG draft-mode decoding, then resize and normalisation in NumPy).
+
+Each pipeline runs in its own subprocess per image size, and peak memory is measured
+as the rise in the process's peak resident set size (VmHWM, so Linux only).
+
+Usage (from the repository root):
+    python -m benchmarks.bench_decode [--repeats 5] [--output decode.json]
+"""
+import argparse
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+# phone camera resolutions
+SIZES = {
+    "3MP": (2048, 1536),
+    "12MP": (4000, 3000),
+    "24MP": (6000, 4000),
+    "48MP": (8000, 6000),
+}
+
+
+def make_jpeg(width: int, height: int) -> bytes:
+    """Synthetic photo-like JPEG: smooth gradients with a little noise."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = np.stack([
+        127 + 100 * np.sin(x / 150),
+        127 + 100 * np.cos(y / 90),
+        127 + 60 * np.sin((x + y) / 200),
+    ], axis=-1)
+    base += rng.normal(0, 8, base.shape)
+    image = Image.fromarray(base.clip(0, 255).astype(np.uint8))
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def reference_pipeline():
+    # the preprocessing previously used by app.predict
+    from torchvision.transforms import v2
+    transform = v2.Compose([
+        v2.Resize((384, 384)),
+        v2.ToTensor(),
+        v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+    def run(image_bytes):
+        image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+        return transform(image)
+    return run
+
+
+def fast_pipeline():
+    from app.preprocess import decode_image, to_tensor
+
+    def run(image_bytes):
+        return to_tensor(decode_image(image_bytes))
+    return run
+
+
+PIPELINES = {"transform": reference_pipeline, "fast": fast_pipeline}
+
+
+def _status_mb(field: str) -> float:
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    raise KeyError(field)
+
+
+def reset_peak_rss() -> float:
+    """Reset the peak resident set size (Linux only) and return the current RSS in MB."""
+    with open("/proc/self/clear_refs", "w") as file:
+        file.write("5")
+    return _status_mb("VmRSS")
+
+
+def peak_rss_mb() -> float:
+    return _status_mb("VmHWM")
+
+
+def worker(pipeline: str, path: str, repeats: int):
+    run = PIPELINES[pipeline]()
+    with open(path, "rb") as file:
+        image_bytes = file.read()
+
+    baseline = reset_peak_rss()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(image_bytes)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    print(json.dumps({
+        "decode_ms_median": statistics.median(timings),
+        "decode_ms_min": min(timings),
+        "peak_rss_increase_mb": peak_rss_mb() - baseline,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--worker", nargs=2, metavar=("PIPELINE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], args.worker[1], args.repeats)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, (width, height) in SIZES.items():
+            image_bytes = make_jpeg(width, height)
+            path = os.path.join(tmp, f"{label}.jpg")
+            with open(path, "wb") as file:
+                file.write(image_bytes)
+
+            # how far the fast path's output is from the original pipeline's
+            reference = PIPELINES["transform"]()(image_bytes)
+            fast = PIPELINES["fast"]()(image_bytes)
+            max_abs_diff = float((reference - fast).abs().max())
+
+            for pipeline in PIPELINES:
+                output = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_decode", "--repeats", str(args.repeats), "--worker", pipeline, path],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                result = {"size": label, "width": width, "height": height, "pipeline": pipeline, **json.loads(output.splitlines()[-1])}
+                if pipeline == "fast":
+                    result["max_abs_diff_vs_transform"] = max_abs_diff
+                results.append(result)
+                print(f"{label:>5} {pipeline:>9}: {result['decode_ms_median']:8.1f} ms  peak +{result['peak_rss_increase_mb']:7.1f} MB")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
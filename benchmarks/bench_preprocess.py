@@ -0,0 +1,146 @@
+"""
+Microbenchmark per-image preprocessing of an already decoded 384x384 image: the
+original torchvision `transform` (Resize, ToTensor, Normalize) against normalising
+straight into a slot of `app.preprocess.BatchBuffer`, in contiguous and channels-last
+layout.
+
+For each pipeline it reports the time per image, the tensors allocated by torch ops
+and the peak Python/NumPy allocation, and checks that the output matches the original
+pipeline within `--tolerance` (exiting with status 1 if not). With `--forward` it also
+times a forward pass of a randomly initialised Swin-T on contiguous and channels-last
+batches, to decide whether AIHAB_CHANNELS_LAST is worth enabling.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_preprocess [--repeats 200] [--forward] [--output preprocess.json]
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.profiler import ProfilerActivity, profile
+
+from app.preprocess import IMAGE_SIZE, BatchBuffer, to_tensor
+
+
+def reference_transform():
+    # the preprocessing previously used by app.predict
+    from torchvision.transforms import v2
+    return v2.Compose([
+        v2.Resize(IMAGE_SIZE),
+        v2.ToTensor(),
+        v2.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+
+
+def pipelines(pixels: np.ndarray) -> dict:
+    """Functions preprocessing `pixels`, each returning a (3, height, width) tensor."""
+    transform = reference_transform()
+    image = Image.fromarray(pixels)
+    contiguous = BatchBuffer(1)
+    channels_last = BatchBuffer(1, channels_last=True)
+    return {
+        "transform": lambda: transform(image),
+        "to_tensor": lambda: to_tensor(pixels),
+        "batch_buffer": lambda: contiguous.fill([pixels])[0],
+        "batch_buffer_channels_last": lambda: channels_last.fill([pixels])[0],
+    }
+
+
+def measure_allocations(run) -> dict:
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        run()
+    allocations = [event.self_cpu_memory_usage for event in prof.events() if event.name != "[memory]" and event.self_cpu_memory_usage > 0]
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "torch_allocations": len(allocations),
+        "torch_allocated_bytes": sum(allocations),
+        "python_peak_bytes": peak,
+    }
+
+
+def measure_forward(batch_size: int, repeats: int) -> dict:
+    import timm
+    results = {}
+    for name, memory_format in (("contiguous", torch.contiguous_format), ("channels_last", torch.channels_last)):
+        torch.manual_seed(0)
+        model = timm.create_model("swin_tiny_patch4_window7_224", pretrained=False, num_classes=20, img_size=IMAGE_SIZE).eval()
+        model.to(memory_format=memory_format)
+        batch = torch.randn((batch_size, 3) + IMAGE_SIZE).contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            model(batch)
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                model(batch)
+                timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {"batch_size": batch_size, "forward_ms_median": statistics.median(timings)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    parser.add_argument("--forward", action="store_true", help="also time the model forward pass in each layout")
+    parser.add_argument("--forward-batch-size", type=int, default=8)
+    parser.add_argument("--forward-repeats", type=int, default=3)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, IMAGE_SIZE + (3,), dtype=np.uint8)
+    runs = pipelines(pixels)
+    reference = runs["transform"]()
+
+    results = {"preprocess": [], "forward": None}
+    matches = True
+    for name, run in runs.items():
+        run()
+        timings = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            run()
+            timings.append((time.perf_counter() - start) * 1e6)
+
+        max_abs_diff = float((run() - reference).abs().max())
+        matches &= max_abs_diff <= args.tolerance
+        result = {
+            "pipeline": name,
+            "us_median": statistics.median(timings),
+            "max_abs_diff_vs_transform": max_abs_diff,
+            **measure_allocations(run),
+        }
+        results["preprocess"].append(result)
+        print(
+            f"{name:>27}: {result['us_median']:8.0f} us  "
+            f"{result['torch_allocations']:2d} torch allocs ({result['torch_allocated_bytes'] / 1e6:5.2f} MB)  "
+            f"python peak {result['python_peak_bytes'] / 1e6:5.2f} MB  max diff {max_abs_diff:.2e}"
+        )
+
+    if args.forward:
+        results["forward"] = measure_forward(args.forward_batch_size, args.forward_repeats)
+        for name, result in results["forward"].items():
+            print(f"{'forward ' + name:>27}: {result['forward_ms_median']:8.1f} ms per batch of {result['batch_size']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if not matches:
+        print(f"Preprocessing output differs from the original transform by more than {args.tolerance}.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
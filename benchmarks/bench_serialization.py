@@ -0,0 +1,99 @@
+"""
+Benchmark serialising a /predict response: time and bytes on the wire for the
+current Pydantic-validated JSON, plain JSON, msgpack and CBOR, each for the full
+response and for the compact (codes and confidences only) response.
+
+Responses are built the same way as the API builds them (top 3 habitats from
+`app.labels.decoder`), with and without an inline base64 Grad-CAM image of the
+configured format and size. Encodings whose package (msgpack, cbor2) is not
+installed are skipped.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_serialization [--repeats 2000] [--output serialization.json]
+"""
+import argparse
+import base64
+import json
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from app.encoding import CBOR, ENCODERS, JSON, MSGPACK, encode
+from app.get_info import taxonomy
+from app.labels import HABITAT_CODES, decoder
+from app.models import PredictionResponse
+from app.predict import build_request_metadata, build_response
+from app.produce_gradcam_image import encode_gradcam
+
+
+def make_response(compact: bool, gradcam: bool) -> dict:
+    logits = torch.randn(1, len(HABITAT_CODES), generator=torch.Generator().manual_seed(0))
+    top_probs, top_nodes, node_probs = decoder.top_k(torch.softmax(logits, dim=1), 3, 3)
+    habitats = decoder.decode(top_probs, top_nodes, node_probs, compact)[0]
+    metadata = build_request_metadata("ukhab", None, "app", 3, None, None, None, "default", 3, False)
+
+    cam_base64 = None
+    cam_url = None
+    if gradcam:
+        rng = np.random.default_rng(0)
+        image = rng.integers(0, 256, (384, 384, 3), dtype=np.uint8)
+        cam = rng.random((12, 12), dtype=np.float32)
+        cam_url = "/gradcam/" + "0" * 32
+        if not compact:
+            cam_base64 = base64.b64encode(encode_gradcam(cam, image)).decode("utf-8")
+    return build_response(habitats, time.time(), "default", metadata, cam_base64, cam_url, compact)
+
+
+def serialisers() -> dict:
+    def pydantic_json(content):
+        # what FastAPI does with a response_model: validate, then dump to JSON
+        return PredictionResponse.model_validate(content).model_dump_json().encode()
+
+    # full responses the way /predict returns them by default, then the alternatives
+    runs = {"pydantic_json": pydantic_json}
+    for media_type, name in ((JSON, "json"), (MSGPACK, "msgpack"), (CBOR, "cbor")):
+        if media_type in ENCODERS:
+            runs[name] = lambda content, media_type=media_type: encode(content, media_type)
+    return runs
+
+
+def time_serialiser(run, content, repeats: int) -> tuple:
+    body = run(content)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(content)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return statistics.median(timings), len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=2000)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    taxonomy.load()
+    results = []
+    for gradcam in (False, True):
+        for compact in (False, True):
+            content = make_response(compact, gradcam)
+            for name, run in serialisers().items():
+                if compact and name == "pydantic_json":
+                    # compact responses are not validated against the full response model
+                    continue
+                repeats = args.repeats // 20 if gradcam else args.repeats
+                us, size = time_serialiser(run, content, max(repeats, 10))
+                result = {"encoding": name, "compact": compact, "gradcam": gradcam, "us_median": us, "bytes": size}
+                results.append(result)
+                print(f"{name:>14}  compact={compact!s:5}  gradcam={gradcam!s:5}  {us:9.1f} us  {size:8d} bytes")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
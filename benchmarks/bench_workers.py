@@ -0,0 +1,241 @@
+"""
+Benchmark multi-process serving (`python -m app.serve`) as the number of worker
+processes changes.
+
+For each worker count the server is started on a randomly initialised Swin-T saved
+as local safetensors (or on `--model-dir`), loaded with `--concurrency` concurrent
+/predict requests for `--duration` seconds, and measured for throughput, latency and
+the total memory of all its processes. Memory is reported both as the sum of RSS,
+which counts the shared memory-mapped weights once per worker, and as the sum of PSS,
+which splits shared pages between the processes using them and so shows what the
+workers really cost together. Linux only, as memory is read from /proc.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_workers [--workers 1,2,4] [--duration 30] [--output workers.json]
+"""
+import argparse
+import http.client
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+from PIL import Image
+
+from app.preprocess import IMAGE_SIZE
+from app.serve import threads_per_worker
+
+ARCHITECTURE = "swin_tiny_patch4_window7_224"
+
+
+def save_stand_in_model(directory: str):
+    import timm
+    import torch
+    from app.weights import save_model_local
+
+    torch.manual_seed(0)
+    model = timm.create_model(ARCHITECTURE, pretrained=False, num_classes=20, img_size=IMAGE_SIZE)
+    save_model_local(model, directory, {"architecture": ARCHITECTURE, "num_classes": 20, "model_args": {"img_size": list(IMAGE_SIZE)}})
+
+
+def make_images(count: int) -> list:
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)).save(buffer, format="JPEG")
+        images.append(buffer.getvalue())
+    return images
+
+
+def multipart(image: bytes) -> tuple:
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"image.jpg\"\r\n"
+        f"Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + image + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def request(port: int, method: str, path: str, body: bytes = None, content_type: str = None) -> int:
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        connection.request(method, path, body=body, headers={"Content-Type": content_type} if content_type else {})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def wait_until_ready(port: int, process: subprocess.Popen, timeout_s: float) -> float:
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout_s:
+        if process.poll() is not None:
+            raise SystemExit("Server exited during startup.")
+        try:
+            if request(port, "GET", "/status") == 200:
+                return time.perf_counter() - start
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise SystemExit(f"Server was not ready after {timeout_s} s.")
+
+
+def get_json(port: int, path: str):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request("GET", path)
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def check_serving(port: int, model_dir: str, threads: int = None):
+    """
+    Fail unless the server's default version is loaded from `model_dir`, rather than,
+    say, the Hub, and, if given, runs with `threads` torch threads.
+    """
+    status = get_json(port, "/status")
+    models = get_json(port, "/stats")["models"]
+    source = models["resident"].get(status["default_model_version"], {}).get("source")
+    if source != model_dir:
+        raise SystemExit(f"Server is serving '{source}', not the benchmark model '{model_dir}'.")
+    if threads is not None and models["torch_threads"] != threads:
+        raise SystemExit(f"Server runs {models['torch_threads']} torch threads, not {threads}.")
+
+
+def process_tree(pid: int) -> list:
+    pids = [pid]
+    for current in pids:
+        for task in os.listdir(f"/proc/{current}/task"):
+            try:
+                with open(f"/proc/{current}/task/{task}/children") as file:
+                    pids.extend(int(child) for child in file.read().split())
+            except FileNotFoundError:
+                pass
+    return pids
+
+
+def memory(pid: int) -> dict:
+    """Summed RSS and PSS, in bytes, of a process and all its descendants."""
+    totals = {"rss_bytes": 0, "pss_bytes": 0, "processes": 0}
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/smaps_rollup") as file:
+                fields = dict(line.split(":", 1) for line in file if ":" in line and not line.startswith(" "))
+        except FileNotFoundError:
+            continue
+        totals["rss_bytes"] += int(fields["Rss"].split()[0]) * 1024
+        totals["pss_bytes"] += int(fields["Pss"].split()[0]) * 1024
+        totals["processes"] += 1
+    return totals
+
+
+def run_load(port: int, images: list, concurrency: int, duration_s: float) -> dict:
+    latencies, failures = [], []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration_s
+
+    def client(offset: int):
+        index = offset
+        while time.perf_counter() < stop_at:
+            body, content_type = multipart(images[index % len(images)])
+            index += concurrency
+            start = time.perf_counter()
+            try:
+                status = request(port, "POST", "/predict", body, content_type)
+            except OSError as e:
+                status = str(e)
+            with lock:
+                if status == 200:
+                    latencies.append((time.perf_counter() - start) * 1000)
+                else:
+                    failures.append(status)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "requests": len(latencies),
+        "failures": len(failures),
+        "images_per_second": len(latencies) / elapsed,
+        "latency_ms_median": statistics.median(latencies) if latencies else None,
+        "latency_ms_p95": statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else None,
+    }
+
+
+def benchmark(workers: int, args, model_dir: str, images: list) -> dict:
+    env = dict(
+        os.environ,
+        AIHAB_MODELS=f"default={model_dir}",
+        # every request should reach the model
+        AIHAB_CACHE_MAX_ENTRIES="0",
+        AIHAB_INFERENCE_QUEUE_SIZE="1000",
+    )
+    command = [sys.executable, "-m", "app.serve", "--workers", str(workers), "--port", str(args.port)]
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready_s = wait_until_ready(args.port, process, args.startup_timeout)
+        # app.serve must hand its settings to the workers, including a single one
+        check_serving(args.port, model_dir, int(os.getenv("AIHAB_TORCH_THREADS", "0")) or threads_per_worker(workers))
+        # warm every worker before measuring
+        run_load(args.port, images, args.concurrency, args.warmup)
+        result = {"workers": workers, "concurrency": args.concurrency, "ready_s": ready_s}
+        result.update(run_load(args.port, images, args.concurrency, args.duration))
+        result.update(memory(process.pid))
+        return result
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated worker counts to compare")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of load per worker count")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds of untimed load before measuring")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--model-dir", help="local model directory to serve, instead of a random stand-in")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    images = make_images(16)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        model_dir = args.model_dir
+        if model_dir is None:
+            model_dir = os.path.join(tmp, "model")
+            save_stand_in_model(model_dir)
+
+        for workers in (int(count) for count in args.workers.split(",")):
+            result = benchmark(workers, args, model_dir, images)
+            results.append(result)
+            print(
+                f"{workers:2d} workers: {result['images_per_second']:6.2f} img/s  "
+                f"median {result['latency_ms_median'] or 0:7.0f} ms  p95 {result['latency_ms_p95'] or 0:7.0f} ms  "
+                f"RSS {result['rss_bytes'] / 1e6:7.0f} MB  PSS {result['pss_bytes'] / 1e6:7.0f} MB  "
+                f"({result['failures']} failures, ready in {result['ready_s']:.1f} s)"
+            )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""
+Compare the inference backends in `app.backends` on a local set of images.
+
+Every backend is checked against eager fp32 for top-1 agreement and the largest
+change in any class probability, and timed per batch. The fastest backend whose
+top-1 agreement is at least `--min-agreement` is reported as the recommendation
+for AIHAB_INFERENCE_BACKEND.
+
+By default the deployed model is loaded the same way as the API; `--random-init`
+uses a randomly initialised Swin-T with the same architecture instead, which is
+enough to compare latency but not accuracy.
+
+Usage (from the repository root):
+    python -m benchmarks.compare_backends --images path/to/images [--backends eager,int8,bf16] [--output backends.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import torch
+import torch.nn.functional as F
+
+from app.backends import BACKENDS, build_backend
+from app.preprocess import IMAGE_SIZE, BatchBuffer, decode_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp", ".bmp")
+
+
+def load_images(directory: str, limit: int) -> list:
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(directory)
+        for name in names
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )[:limit]
+    if not paths:
+        raise SystemExit(f"No images found in {directory}")
+    images = []
+    for path in paths:
+        with open(path, "rb") as file:
+            images.append(decode_image(file.read()))
+    return images
+
+
+def load_eager_model(random_init: bool) -> torch.nn.Module:
+    if random_init:
+        import timm
+        torch.manual_seed(0)
+        return timm.create_model("swin_tiny_patch4_window7_224", pretrained=False, num_classes=20, img_size=IMAGE_SIZE).eval()
+
+    from app import predict
+    try:
+        predict.login_hf()
+        return predict.registry.get().model
+    except Exception as e:
+        raise SystemExit(f"Error loading model: {e}")
+
+
+def run_backend(backend, batches: list) -> tuple:
+    # one untimed pass to warm up (and trigger compilation for torch.compile)
+    backend(batches[0])
+    probabilities, timings = [], []
+    for batch in batches:
+        start = time.perf_counter()
+        logits = backend(batch)
+        timings.append((time.perf_counter() - start) * 1000)
+        probabilities.append(F.softmax(logits.float(), dim=1))
+    return torch.cat(probabilities), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="directory of images to classify")
+    parser.add_argument("--limit", type=int, default=64, help="maximum number of images to use")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma-separated backends to compare")
+    parser.add_argument("--min-agreement", type=float, default=0.99, help="minimum top-1 agreement with eager fp32")
+    parser.add_argument("--random-init", action="store_true", help="use a randomly initialised stand-in model")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    images = load_images(args.images, args.limit)
+    buffer = BatchBuffer(args.batch_size)
+    batches = [
+        buffer.fill(images[start:start + args.batch_size]).clone()
+        for start in range(0, len(images), args.batch_size)
+    ]
+
+    model = load_eager_model(args.random_init)
+    reference, _ = run_backend(build_backend(model, "eager"), batches)
+    reference_top1 = reference.argmax(dim=1)
+
+    results = []
+    for name in args.backends.split(","):
+        start = time.perf_counter()
+        try:
+            backend = build_backend(model, name)
+        except Exception as e:
+            print(f"{name:>12}: unavailable ({e})")
+            results.append({"backend": name, "error": str(e)})
+            continue
+        build_s = time.perf_counter() - start
+
+        probabilities, timings = run_backend(backend, batches)
+        result = {
+            "backend": name,
+            "active_backend": backend.name,
+            "build_s": build_s,
+            "images": len(images),
+            "batch_size": args.batch_size,
+            "batch_ms_median": statistics.median(timings),
+            "images_per_second": len(images) / (sum(timings) / 1000),
+            "top1_agreement": float((probabilities.argmax(dim=1) == reference_top1).float().mean()),
+            "max_probability_diff": float((probabilities - reference).abs().max()),
+        }
+        results.append(result)
+        print(
+            f"{name:>12}: {result['batch_ms_median']:8.1f} ms/batch  {result['images_per_second']:6.2f} img/s  "
+            f"top-1 agreement {result['top1_agreement']:.3f}  max prob diff {result['max_probability_diff']:.4f}  "
+            f"(built in {build_s:.1f} s)"
+        )
+
+    eligible = [r for r in results if "error" not in r and r["top1_agreement"] >= args.min_agreement]
+    if eligible:
+        fastest = max(eligible, key=lambda r: r["images_per_second"])
+        print(f"Fastest backend within tolerance: {fastest['active_backend']}")
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
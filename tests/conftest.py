@@ -0,0 +1,34 @@
+"""
+Settings for the tests, applied before anything imports `app.config`: the app serves
+a randomly initialised stand-in model and keeps its jobs in a temporary directory,
+so the tests run offline and leave the repository's data directory alone.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="aihab-tests-")
+MODEL_DIR = os.path.join(DATA_DIR, "model")
+
+os.environ.update({
+    "AIHAB_MODELS": f"default={MODEL_DIR}",
+    # every request should reach the model
+    "AIHAB_CACHE_MAX_ENTRIES": "0",
+    "AIHAB_JOBS_DB": os.path.join(DATA_DIR, "jobs.sqlite3"),
+    "AIHAB_JOBS_DIR": os.path.join(DATA_DIR, "jobs"),
+})
+
+
+@pytest.fixture(scope="session")
+def stand_in_model() -> str:
+    """Directory of the stand-in model the app serves, saved on first use."""
+    from benchmarks.bench_workers import save_stand_in_model
+
+    save_stand_in_model(MODEL_DIR)
+    return MODEL_DIR
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
@@ -0,0 +1,45 @@
+"""
+Results of bulk jobs have the shape of the `/predict/batch` items for the same images.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.bench_workers import make_images
+
+
+@pytest.fixture(scope="module")
+def client(stand_in_model):
+    from app.main import app
+
+    # entering the client runs startup, which loads the model and starts the job runner
+    with TestClient(app) as client:
+        yield client
+
+
+def without_timing(item: dict) -> tuple:
+    result = {key: value for key, value in item["result"].items() if key not in ("timestamp", "inference_time_ms")}
+    return item["index"], item["filename"], result
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_job_results_match_batch_items(client, compact):
+    # one image, so both run it in a forward pass of its own and get the same logits
+    files = [("files", ("image.jpg", make_images(1)[0], "image/jpeg"))]
+    params = {"compact": str(compact).lower()}
+
+    response = client.post("/predict/batch", files=files, params=params)
+    assert response.status_code == 200
+    batch_items = response.json()["items"]
+
+    response = client.post("/jobs", files=files, params=params)
+    assert response.status_code == 202
+    job = response.json()
+    while job["status"] not in ("completed", "failed"):
+        job = client.get(job["status_url"], params={"wait": 10}).json()
+    assert job["status"] == "completed"
+    job_items = client.get(job["results_url"]).json()["items"]
+
+    assert [without_timing(item) for item in job_items] == [without_timing(item) for item in batch_items]
@@ -0,0 +1,33 @@
+"""
+Parity of the fast preprocessing path with the original torchvision transform, the
+check `python -m benchmarks.bench_preprocess` also makes, so it runs with the tests.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from app.preprocess import IMAGE_SIZE
+from benchmarks.bench_preprocess import pipelines
+
+# the benchmark's default --tolerance
+TOLERANCE = 1e-5
+
+FAST_PIPELINES = ("to_tensor", "batch_buffer", "batch_buffer_channels_last")
+
+
+@pytest.fixture(scope="module", params=[0, 1, 2])
+def runs(request):
+    rng = np.random.default_rng(request.param)
+    pixels = rng.integers(0, 256, IMAGE_SIZE + (3,), dtype=np.uint8)
+    return pipelines(pixels)
+
+
+@pytest.mark.parametrize("name", FAST_PIPELINES)
+def test_matches_reference_transform(runs, name):
+    reference = runs["transform"]()
+    output = runs[name]()
+    assert output.shape == reference.shape
+    assert float((output - reference).abs().max()) <= TOLERANCE
+